@@ -145,6 +145,7 @@ class CATMAIDConfig(AppConfig):
         "PROFILE_SHOW_ONTOLOGY_TOOL": bool,
         "PROFILE_SHOW_ROI_TOOL": bool,
         "ROI_AUTO_CREATE_IMAGE": bool,
+        "ROI_IMAGE_CACHE_MAXIMUM_SIZE": int,
         "NODE_LIST_MAXIMUM_COUNT": int,
         "IMPORTER_DEFAULT_TILE_WIDTH": int,
         "IMPORTER_DEFAULT_TILE_HEIGHT": int,
@@ -374,6 +374,45 @@ def can_edit_all_or_fail(user, ob_ids, table_name):
     raise ObjectDoesNotExist('One or more of the %s unique objects were not found in table %s' % (len(ob_ids), table_name))
 
 
+def can_edit_skeletons_or_fail(user, skeleton_ids, cursor=None):
+    """ Like can_edit_class_instance_or_fail() for the neurons modeled by all
+    passed in skeletons, but the 'locked' annotations of all neurons are
+    retrieved with a single query. Raises an Exception if one of the neurons is
+    locked by a user whose work the passed in user can't edit.
+    """
+    # Implicit: a super user belongs to all users' groups
+    if user.is_superuser:
+        return True
+    skeleton_ids = list(set(int(s) for s in skeleton_ids))
+    if not skeleton_ids:
+        return True
+
+    cursor = cursor or connection.cursor()
+    cursor.execute("""
+        SELECT DISTINCT model.class_instance_b, lck.user_id
+        FROM class_instance_class_instance model
+        JOIN relation r1 ON r1.id = model.relation_id
+        JOIN class_instance_class_instance lck
+          ON lck.class_instance_a = model.class_instance_b
+        JOIN relation r2 ON r2.id = lck.relation_id
+        JOIN class_instance a ON a.id = lck.class_instance_b
+        WHERE model.class_instance_a = ANY(%s::integer[])
+          AND r1.relation_name = 'model_of'
+          AND r2.relation_name = 'annotated_with'
+          AND a.name = 'locked'
+          AND lck.user_id <> %s
+    """, (skeleton_ids, user.id))
+    locked_by_other = cursor.fetchall()
+    if locked_by_other:
+        # Check if the user belongs to groups with the names of all owners
+        domain = user_domain(cursor, user.id)
+        for neuron_id, owner_id in locked_by_other:
+            if owner_id not in domain:
+                raise Exception('User %s with id #%s cannot edit neuron #%s' % \
+                    (user.username, user.id, neuron_id))
+    return True
+
+
 def user_can_edit(cursor, user_id, other_user_id):
     """ Determine whether the user with id 'user_'id' can edit the work of the user with id 'other_user_id'. This will be the case when the user_id belongs to a group whose name is identical to ther username of other_user_id.
     This function is equivalent to 'other_user_id in user_domain(cursor, user_id), but consumes less resources."""
@@ -1,19 +1,32 @@
-import json
+import logging
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required
+from django.db.models import Q
+from django.utils import timezone
 
-from catmaid.models import Stack, Project, ProjectStack, Message, User
+from catmaid.models import Stack, Project, ProjectStack, Message, User, \
+        CroppingJob
 from catmaid.control.common import id_generator, json_error_response
+from catmaid.control.tilecache import ImageRetrievalError, TileFetcher, \
+        TileFetchMetrics
 
-import urllib2 as urllib
+import os
 import os.path
 import glob
+import struct
+import numpy as np
+from cStringIO import StringIO
+from datetime import timedelta
+from fractions import Fraction
 from time import time
 from math import cos, sin, radians
 
+from PIL import Image as PILImage
+
 # The libuuid import is a workaround for a bug with GraphicsMagick
 # which expects the library to be loaded already. Therefore, it
 # has to be loaded before pgmagick.
@@ -22,6 +35,9 @@ from pgmagick import Blob, Image, ImageList, Geometry, ChannelType, \
 
 from celery.task import task
 
+
+logger = logging.getLogger(__name__)
+
 # Prefix for stored microstacks
 file_prefix = "crop_"
 # File extension of the stored microstacks
@@ -67,6 +83,10 @@ class CropJob:
             output_path = os.path.join(crop_output_path, file_name)
         self.single_channel = single_channel
         self.output_path = output_path
+        # Translations of the stacks relative to the project, loaded on demand
+        self.stack_translations = {}
+        # The ID of the CroppingJob that tracks this job, if any
+        self.record_id = None
         # State that extra initialization is needed
         self.needs_initialization = True
 
@@ -91,6 +111,10 @@ class CropJob:
             self.stack_specific_path_getters[s.id] = getter
         # Attach actual path getter
         self.get_tile_path = self.get_tile_path_initialized
+        # Tiles are loaded through the tile cache of the current process,
+        # statistics on this are collected per job.
+        self.fetch_metrics = TileFetchMetrics()
+        self.tile_fetcher = TileFetcher(metrics=self.fetch_metrics)
         # Initialization is done
         self.needs_initialization = False
 
@@ -153,12 +177,6 @@ class CropJob:
         raise StandardError("Tile source %s is currently not supported " \
                 "by cropping module" % stack.tile_source_type)
 
-class ImageRetrievalError(IOError):
-    def __init__(self, path, error):
-        IOError.__init__(self, "Couldn't access %s" % (path))
-        self.path = path
-        self.error = error
-
 class ImagePart:
     """ A part of a 2D image where height and width are not necessarily
     of the same size. Provides readout of the defined sub-area of the image.
@@ -179,16 +197,14 @@ class ImagePart:
             raise ValueError( "An image part must have an area, hence no " \
                     "extent should be zero!" )
 
-    def get_image( self ):
-        # Open the image
-        try:
-            img_file = urllib.urlopen( self.path )
-            img_data = img_file.read()
-            bytes_read = len(img_data)
-        except urllib.HTTPError as e:
-            raise ImageRetrievalError(self.path, "Error code: %s" % e.code)
-        except urllib.URLError as e:
-            raise ImageRetrievalError(self.path, e.reason)
+    def get_image( self, img_data=None ):
+        """ Returns the (cropped) image of this part. If the encoded tile data
+        has been retrieved already, it can be passed in as <img_data>.
+        Otherwise it is loaded through the tile cache.
+        """
+        if img_data is None:
+            img_data = TileFetcher().fetch( self.path )
+        bytes_read = len(img_data)
 
         blob = Blob( img_data )
         image = Image( blob )
@@ -233,26 +249,19 @@ def to_z_index( z, job, enforce_bounds=True ):
         section = min(max(section, 0.0), job.ref_stack.dimension.z - 1.0)
     return int( section )
 
-def addMetaData( path, job, result ):
-    """ Use this method to add meta data to the image. Due to a bug in
-    exiv2, its python wrapper pyexiv2 is of no use to us. This bug
-    (http://dev.exiv2.org/issues/762) hinders us to work on multi-page
-    TIFF files. Instead, we use a separate tool called exiftool to write
-    meta data. Currently, there seems no better solution than this. If the
-    tool is not found, no meta data is produced and no error is raised.
+def get_pixel_per_nm( job ):
+    """ Returns the resolution of the output in pixel per nanometer along X
+    and Y. The stack info available is nm/px and refers to a zoom-level of
+    zero.
     """
-    # Add resolution information in pixel per nanometer. The stack info
-    # available is nm/px and refers to a zoom-level of zero.
     res_x_scaled = job.ref_stack.resolution.x * 2**job.zoom_level
     res_y_scaled = job.ref_stack.resolution.y * 2**job.zoom_level
-    res_x_nm_px = 1.0 / res_x_scaled
-    res_y_nm_px = 1.0 / res_y_scaled
-    res_args = "-EXIF:XResolution={0} -EXIF:YResolution={1} -EXIF:" \
-            "ResolutionUnit=None".format( str(res_x_nm_px), str(res_y_nm_px) )
+    return 1.0 / res_x_scaled, 1.0 / res_y_scaled
 
-    # ImageJ specific meta data to allow easy embedding of units and
-    # display options.
-    n_images = len( result )
+def get_imagej_description( job, n_images ):
+    """ Returns ImageJ specific meta data to allow easy embedding of units and
+    display options for a result with <n_images> slices.
+    """
     ij_version= "1.45p"
     unit = "nm"
     newline = "\n"
@@ -267,6 +276,25 @@ def addMetaData( path, job, result ):
                     "modulo the channel count is not zero" )
         n_slices = n_images / n_channels
         ij_data += "images={1}{0}channels={2}{0}slices={3}{0}hyperstack=true{0}mode=color{0}".format( newline, str(n_images), str(n_channels), str(n_slices) )
+    return ij_data
+
+def addMetaData( path, job, result ):
+    """ Use this method to add meta data to the image. Due to a bug in
+    exiv2, its python wrapper pyexiv2 is of no use to us. This bug
+    (http://dev.exiv2.org/issues/762) hinders us to work on multi-page
+    TIFF files. Instead, we use a separate tool called exiftool to write
+    meta data. Currently, there seems no better solution than this. If the
+    tool is not found, no meta data is produced and no error is raised.
+    """
+    # Add resolution information in pixel per nanometer.
+    res_x_nm_px, res_y_nm_px = get_pixel_per_nm( job )
+    res_args = "-EXIF:XResolution={0} -EXIF:YResolution={1} -EXIF:" \
+            "ResolutionUnit=None".format( str(res_x_nm_px), str(res_y_nm_px) )
+
+    # ImageJ specific meta data to allow easy embedding of units and
+    # display options.
+    n_images = len( result )
+    ij_data = get_imagej_description( job, n_images )
     ij_args = "-EXIF:ImageDescription=\"{0}\"".format( ij_data )
 
     # Information about the software used
@@ -290,10 +318,11 @@ def addMetaData( path, job, result ):
     images.readImages( path )
     images.writeImages( path )
 
-def extract_substack( job ):
+def extract_substack( job, fast_path=True ):
     """ Extracts a sub-stack as specified in the passed job while respecting
     rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+    slice, starting on top. Slices that lie within a single tile are cut out
+    of it directly, unless <fast_path> is false.
     """
 
     # Make sure tile source getters have been initialized on the job
@@ -303,20 +332,20 @@ def extract_substack( job ):
     # Treat rotation requests special
     if abs(job.rotation_cw) < 0.00001:
         # No rotation, create the sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
+        cropped_stack = extract_substack_no_rotation( job, fast_path )
     elif abs(job.rotation_cw - 90.0) < 0.00001:
         # 90 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
+        cropped_stack = extract_substack_no_rotation( job, fast_path )
         for img in cropped_stack:
             img.rotate(270.0)
     elif abs(job.rotation_cw - 180.0) < 0.00001:
         # 180 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
+        cropped_stack = extract_substack_no_rotation( job, fast_path )
         for img in cropped_stack:
             img.rotate(180.0)
     elif abs(job.rotation_cw - 270.0) < 0.00001:
         # 270 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
+        cropped_stack = extract_substack_no_rotation( job, fast_path )
         for img in cropped_stack:
             img.rotate(90.0)
     else:
@@ -347,7 +376,7 @@ def extract_substack( job ):
         job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
         job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
         # Create the enlarged sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
+        cropped_stack = extract_substack_no_rotation( job, fast_path )
 
         # Next, rotate the whole result stack counterclockwise to have the
         # actual ROI axis aligned.
@@ -397,12 +426,10 @@ def extract_substack( job ):
 
     return cropped_stack
 
-def extract_substack_no_rotation( job ):
-    """ Extracts a sub-stack as specified in the passed job without respecting
-    rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+def get_stack_bounding_boxes( job ):
+    """ Returns a dictionary that maps the ID of each stack of the job to its
+    bounding box in pixel space as well as the number of slices to export.
     """
-
     # The actual bounding boxes used for creating the images of each stack
     # depend not only on the request, but also on the translation of the stack
     # wrt. the project. Therefore, a dictionary with bounding box information for
@@ -410,8 +437,11 @@ def extract_substack_no_rotation( job ):
     s_to_bb = {}
     for stack in job.stacks:
         # Retrieve translation relative to current project
-        translation = ProjectStack.objects.get(
-                project_id=job.project_id, stack_id=stack.id).translation
+        translation = job.stack_translations.get(stack.id)
+        if translation is None:
+            translation = ProjectStack.objects.get(
+                    project_id=job.project_id, stack_id=stack.id).translation
+            job.stack_translations[stack.id] = translation
         x_min_t = job.x_min - translation.x
         x_max_t = job.x_max - translation.x
         y_min_t = job.y_min - translation.y
@@ -457,72 +487,31 @@ def extract_substack_no_rotation( job ):
     px_z_max = to_z_index(job.z_max, job)
     n_slices = px_z_max + 1 - px_z_min
 
-    # The images are generated per slice, so most of the following
-    # calculations refer to 2d images.
+    return s_to_bb, n_slices
+
+def extract_substack_no_rotation( job, fast_path=True ):
+    """ Extracts a sub-stack as specified in the passed job without respecting
+    rotation requests. A list of pgmagick images is returned -- one for each
+    slice, starting on top. If <fast_path> is true, slices that are covered
+    completely by a single tile are used as they are cut from the tile,
+    without composing them on a new canvas.
+    """
+
+    s_to_bb, n_slices = get_stack_bounding_boxes( job )
+    slices = plan_slices( job, s_to_bb, n_slices )
 
-    # Each stack to export is treated as a separate channel. The order
-    # of the exported dimensions is XYCZ. This means all the channels of
-    # one slice are exported, then the next slice follows, etc.
     cropped_stack = []
     # Accumulator for estimated result size
     estimated_total_size = 0
-    # Iterate over all slices
-    for nz in range(n_slices):
-        for stack in job.stacks:
-            bb = s_to_bb[stack.id]
-            # Shortcut for tile width and height
-            tile_width = stack.tile_width
-            tile_height = stack.tile_height
-            # Get indices for bounding tiles (0 indexed)
-            tile_x_min = int(bb.px_x_min / tile_width)
-            tile_x_max = int(bb.px_x_max / tile_width)
-            tile_y_min = int(bb.px_y_min / tile_height)
-            tile_y_max = int(bb.px_y_max / tile_height)
-            # Get the number of needed tiles for each direction
-            num_x_tiles = tile_x_max - tile_x_min + 1
-            num_y_tiles = tile_y_max - tile_y_min + 1
-            # Associate image parts with all tiles
-            image_parts = []
-            x_dst = bb.px_x_offset
-            for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
-                # The min x,y for the image part in the current tile are 0
-                # for all tiles except the first one.
-                cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
-                # The max x,y for the image part of current tile are the tile
-                # size minus one except for the last one.
-                if nx < (num_x_tiles - 1):
-                    cur_px_x_max = tile_width - 1
-                else:
-                    cur_px_x_max = bb.px_x_max - x * tile_width
-                # Reset y destination component
-                y_dst = bb.px_y_offset
-                for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
-                    cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
-                    if ny < (num_y_tiles - 1):
-                        cur_px_y_max = tile_height - 1
-                    else:
-                        cur_px_y_max = bb.px_y_max - y * tile_height
-                    # Create an image part definition
-                    z = bb.px_z_min + nz
-                    path = job.get_tile_path(stack, (x, y, z))
-                    try:
-                        part = ImagePart(path, cur_px_x_min, cur_px_x_max,
-                                cur_px_y_min, cur_px_y_max, x_dst, y_dst)
-                        image_parts.append( part )
-                    except:
-                        # ignore failed slices
-                        pass
-                    # Update y component of destination position
-                    y_dst += cur_px_y_max - cur_px_y_min
-                # Update x component of destination position
-                x_dst += cur_px_x_max - cur_px_x_min
-
+    for channels, tile_data in iter_slice_tiles( job, slices ):
+        for bb, image_parts in channels:
             # Write out the image parts and make sure the maximum allowed file
             # size isn't exceeded.
             cropped_slice = None
+            single_part = get_single_tile_part( bb, image_parts ) if fast_path else None
             for ip in image_parts:
                 # Get (correctly cropped) image
-                image = ip.get_image()
+                image = ip.get_image(next(tile_data))
 
                 # Estimate total file size and abort if this exceeds the
                 # maximum allowed file size.
@@ -534,6 +523,15 @@ def extract_substack_no_rotation( job ):
                                      (estimated_total_size,
                                       settings.GENERATED_FILES_MAXIMUM_SIZE))
 
+                # A part that covers the whole slice is the slice already,
+                # unless the tile is smaller than expected.
+                if single_part and bb.width == image.size().width() and \
+                        bb.height == image.size().height():
+                    # Don't keep the offset of the cropped region
+                    image.page( Geometry(0, 0, 0, 0) )
+                    cropped_slice = image
+                    continue
+
                 # It is unfortunately not possible to create proper composite
                 # images based on a canvas image newly created like this:
                 # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
@@ -558,6 +556,367 @@ def extract_substack_no_rotation( job ):
 
     return cropped_stack
 
+def plan_slices( job, s_to_bb, n_slices ):
+    """ Returns a list with an entry for each slice. Each entry is a list of
+    (bounding box, image parts) tuples, one for each stack.
+    """
+    # The images are generated per slice, so most of the following
+    # calculations refer to 2d images.
+
+    # Each stack to export is treated as a separate channel. The order
+    # of the exported dimensions is XYCZ. This means all the channels of
+    # one slice are exported, then the next slice follows, etc.
+    slices = []
+    for nz in range(n_slices):
+        channels = []
+        for stack in job.stacks:
+            bb = s_to_bb[stack.id]
+            channels.append((bb, plan_image_parts(job, stack, bb, nz)))
+        slices.append(channels)
+    return slices
+
+def iter_slice_tiles( job, slices ):
+    """ Yields a tuple for each planned slice: its list of channels and an
+    iterator over the encoded data of all tiles of all its image parts, in
+    order. The tiles of a slice are fetched in parallel. While the tiles of
+    one slice are processed, the tiles of the next slice are fetched already.
+    """
+    fetcher = job.tile_fetcher
+    get_paths = lambda channels: [ip.path for _, parts in channels for ip in parts]
+    pending = fetcher.fetch_many_async(get_paths(slices[0])) if slices else None
+    for nz, channels in enumerate(slices):
+        tile_data = iter(pending.get())
+        if nz + 1 < len(slices):
+            pending = fetcher.fetch_many_async(get_paths(slices[nz + 1]))
+        yield channels, tile_data
+
+def plan_image_parts( job, stack, bb, nz ):
+    """ Returns a list of image parts that make up the slice <nz> (relative
+    to the bounding box start) of the passed in stack. Each part references
+    the tile it is read from and its destination in the output image.
+    """
+    # Shortcut for tile width and height
+    tile_width = stack.tile_width
+    tile_height = stack.tile_height
+    # Get indices for bounding tiles (0 indexed)
+    tile_x_min = int(bb.px_x_min / tile_width)
+    tile_x_max = int(bb.px_x_max / tile_width)
+    tile_y_min = int(bb.px_y_min / tile_height)
+    tile_y_max = int(bb.px_y_max / tile_height)
+    # Get the number of needed tiles for each direction
+    num_x_tiles = tile_x_max - tile_x_min + 1
+    num_y_tiles = tile_y_max - tile_y_min + 1
+    # Associate image parts with all tiles
+    image_parts = []
+    x_dst = bb.px_x_offset
+    for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
+        # The min x,y for the image part in the current tile are 0
+        # for all tiles except the first one.
+        cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
+        # The max x,y for the image part of current tile are the tile
+        # size minus one except for the last one.
+        if nx < (num_x_tiles - 1):
+            cur_px_x_max = tile_width - 1
+        else:
+            cur_px_x_max = bb.px_x_max - x * tile_width
+        # Reset y destination component
+        y_dst = bb.px_y_offset
+        for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
+            cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
+            if ny < (num_y_tiles - 1):
+                cur_px_y_max = tile_height - 1
+            else:
+                cur_px_y_max = bb.px_y_max - y * tile_height
+            # Create an image part definition
+            z = bb.px_z_min + nz
+            path = job.get_tile_path(stack, (x, y, z))
+            try:
+                part = ImagePart(path, cur_px_x_min, cur_px_x_max,
+                        cur_px_y_min, cur_px_y_max, x_dst, y_dst)
+                image_parts.append( part )
+            except:
+                # ignore failed slices
+                pass
+            # Update y component of destination position
+            y_dst += cur_px_y_max - cur_px_y_min
+        # Update x component of destination position
+        x_dst += cur_px_x_max - cur_px_x_min
+
+    return image_parts
+
+def get_rot90_count( rotation_cw ):
+    """ Returns how often an image has to be rotated by 90 degrees counter-
+    clockwise to match the passed in clockwise rotation. If the rotation
+    isn't a multiple of 90 degrees, None is returned.
+    """
+    for angle, count in ((0.0, 0), (90.0, 1), (180.0, 2), (270.0, 3)):
+        if abs(rotation_cw - angle) < 0.00001:
+            return count
+    return None
+
+def decode_tile( img_data, single_channel=False ):
+    """ Decodes encoded tile data into a NumPy array of shape (height, width,
+    samples) with eight bit per sample. There are three samples (RGB) per
+    pixel or, if <single_channel> is true, only the red one.
+    """
+    image = PILImage.open( StringIO(img_data) ).convert('RGB')
+    data = np.asarray( image, dtype=np.uint8 )
+    if single_channel:
+        data = data[:, :, :1]
+    return data
+
+def decode_tile_region( img_data, ip, single_channel=False ):
+    """ Decodes the region of the encoded tile data that is referenced by the
+    image part <ip> into a NumPy array like decode_tile() does. Only the
+    region is converted, parts of it outside of the tile are black.
+    """
+    image = PILImage.open( StringIO(img_data) )
+    if 'P' == image.mode:
+        # Padding is only black after palette lookup
+        image = image.convert('RGB')
+    image = image.crop((ip.x_min_src, ip.y_min_src,
+            ip.x_min_src + ip.width, ip.y_min_src + ip.height)).convert('RGB')
+    data = np.asarray( image, dtype=np.uint8 )
+    if single_channel:
+        data = data[:, :, :1]
+    return data
+
+def get_single_tile_part( bb, image_parts ):
+    """ Returns the only image part of a slice if it covers the whole bounding
+    box <bb> of the slice, otherwise None. Such a slice can be cut out of a
+    single tile directly, no other tiles need to be composed with it.
+    """
+    if 1 != len(image_parts):
+        return None
+    ip = image_parts[0]
+    if ip.x_dst != 0 or ip.y_dst != 0 or ip.width != bb.width or \
+            ip.height != bb.height:
+        return None
+    return ip
+
+def blit_image_part( target, ip, tile ):
+    """ Copies the region of the decoded <tile> that is referenced by the
+    image part <ip> to its destination in the <target> array. Parts of the
+    region outside of the tile or the target are ignored.
+    """
+    src = tile[ip.y_min_src:ip.y_min_src + ip.height,
+               ip.x_min_src:ip.x_min_src + ip.width]
+    height = min(src.shape[0], target.shape[0] - ip.y_dst)
+    width = min(src.shape[1], target.shape[1] - ip.x_dst)
+    if height > 0 and width > 0:
+        target[ip.y_dst:ip.y_dst + height, ip.x_dst:ip.x_dst + width] = \
+                src[:height, :width]
+
+class TiffWriter:
+    """ Writes an uncompressed multi-page TIFF file one page at a time,
+    without keeping previous pages in memory. Every page is an array of shape
+    (height, width, samples) with eight bit per sample and one or three
+    samples. An image description, a software note and a resolution (pixel
+    per unit along X and Y) can optionally be added to every page. Because
+    no compression is used, the final file size is known in advance.
+    """
+    def __init__( self, path, description=None, software=None, resolution=None ):
+        self.path = path
+        self.description = description
+        self.software = software
+        self.resolution = resolution
+        self.file = None
+
+    def _entries( self, width, height, samples, strip_offset ):
+        """ Returns a list of (tag, type, count, packed value) tuples, sorted by
+        tag, for a page with the passed in geometry.
+        """
+        SHORT, LONG, RATIONAL, ASCII = 3, 4, 5, 2
+        def ascii(text):
+            return (ASCII, len(text) + 1, text.encode('ascii') + b'\0')
+        def rational(value):
+            f = Fraction(value).limit_denominator(1000000)
+            return (RATIONAL, 1, struct.pack('<II', f.numerator, f.denominator))
+
+        entries = [
+            (256, LONG, 1, struct.pack('<I', width)),
+            (257, LONG, 1, struct.pack('<I', height)),
+            (258, SHORT, samples, struct.pack('<%sH' % samples, *([8] * samples))),
+            # No compression
+            (259, SHORT, 1, struct.pack('<H', 1)),
+            # RGB or BlackIsZero
+            (262, SHORT, 1, struct.pack('<H', 2 if samples == 3 else 1)),
+        ]
+        if self.description:
+            entries.append((270,) + ascii(self.description))
+        entries.extend([
+            (273, LONG, 1, struct.pack('<I', strip_offset)),
+            (277, SHORT, 1, struct.pack('<H', samples)),
+            (278, LONG, 1, struct.pack('<I', height)),
+            (279, LONG, 1, struct.pack('<I', width * height * samples)),
+        ])
+        if self.resolution:
+            entries.append((282,) + rational(self.resolution[0]))
+            entries.append((283,) + rational(self.resolution[1]))
+        # Chunky planar configuration
+        entries.append((284, SHORT, 1, struct.pack('<H', 1)))
+        if self.resolution:
+            # No absolute unit of measurement
+            entries.append((296, SHORT, 1, struct.pack('<H', 1)))
+        if self.software:
+            entries.append((305,) + ascii(self.software))
+        return entries
+
+    def _layout( self, width, height, samples, strip_offset, extra_offset ):
+        """ Returns the extra data block that holds values not fitting into an
+        IFD entry, starting at <extra_offset>, and the IFD itself without the
+        offset to the next IFD.
+        """
+        extra = b''
+        ifd = struct.pack('<H', 0)
+        n_entries = 0
+        for tag, value_type, count, value in self._entries(width, height,
+                samples, strip_offset):
+            n_entries += 1
+            if len(value) <= 4:
+                ifd += struct.pack('<HHI', tag, value_type, count) + \
+                        value.ljust(4, b'\0')
+            else:
+                ifd += struct.pack('<HHII', tag, value_type, count,
+                        extra_offset + len(extra))
+                extra += value
+                # Keep values word aligned
+                if len(extra) % 2:
+                    extra += b'\0'
+        return extra, struct.pack('<H', n_entries) + ifd[2:]
+
+    def get_page_size( self, width, height, samples ):
+        """ Returns the number of bytes a page with the passed in geometry
+        occupies in the file.
+        """
+        n_bytes = width * height * samples
+        extra, ifd = self._layout(width, height, samples, 0, 0)
+        return n_bytes + (n_bytes % 2) + len(extra) + len(ifd) + 4
+
+    def get_file_size( self, pages ):
+        """ Returns the exact size in bytes of a file with the passed in pages,
+        each given as (width, height, samples) tuple.
+        """
+        return 8 + sum(self.get_page_size(*p) for p in pages)
+
+    def open( self, file_obj=None ):
+        """ Opens the output path for writing. Alternatively, a seekable
+        <file_obj> can be passed in, which won't be closed by close().
+        """
+        self.owns_file = file_obj is None
+        self.file = open(self.path, 'wb') if self.owns_file else file_obj
+        # Little endian header, the offset to the first IFD is updated when
+        # the first page is written.
+        self.file.write(b'II' + struct.pack('<HI', 42, 0))
+        self.next_ifd_pointer = 4
+
+    def write_page( self, data ):
+        height, width, samples = data.shape
+        strip_offset = self.file.tell()
+        self.file.write(np.ascontiguousarray(data, dtype=np.uint8).tobytes())
+        if self.file.tell() % 2:
+            self.file.write(b'\0')
+        extra, ifd = self._layout(width, height, samples, strip_offset,
+                self.file.tell())
+        self.file.write(extra)
+        ifd_offset = self.file.tell()
+        self.file.write(ifd + struct.pack('<I', 0))
+        # Link the new IFD from the previous one (or the header)
+        self.file.seek(self.next_ifd_pointer)
+        self.file.write(struct.pack('<I', ifd_offset))
+        self.file.seek(0, os.SEEK_END)
+        self.next_ifd_pointer = ifd_offset + len(ifd)
+
+    def close( self ):
+        if self.file:
+            if self.owns_file:
+                self.file.close()
+            self.file = None
+
+def extract_substack_arrays( job, slices, fast_path=True ):
+    """ Yields the planned <slices> of the passed in job as NumPy arrays, one
+    for each slice and channel in XYCZ order. Tiles are decoded and copied
+    into a buffer allocated for each slice of a channel, rotations by
+    multiples of 90 degrees are applied. Slices without any image part are
+    skipped. If <fast_path> is true, only the needed region of slices that
+    lie within a single tile is decoded and no buffer is allocated.
+    """
+    rot90_count = get_rot90_count( job.rotation_cw )
+    if rot90_count is None:
+        raise ValueError("Only rotations by multiples of 90 degrees are supported")
+    samples = 1 if job.single_channel else 3
+    for channels, tile_data in iter_slice_tiles( job, slices ):
+        for bb, image_parts in channels:
+            if not image_parts:
+                continue
+            single_part = get_single_tile_part( bb, image_parts ) if fast_path else None
+            if single_part:
+                cropped_slice = decode_tile_region( next(tile_data),
+                        single_part, job.single_channel )
+            else:
+                cropped_slice = np.zeros((bb.height, bb.width, samples), dtype=np.uint8)
+                for ip in image_parts:
+                    tile = decode_tile( next(tile_data), job.single_channel )
+                    blit_image_part( cropped_slice, ip, tile )
+                    del tile
+            if rot90_count:
+                cropped_slice = np.rot90( cropped_slice, rot90_count )
+            yield cropped_slice
+
+def write_substack( job, progress=None ):
+    """ Extracts the sub-stack of the passed in job and streams it slice by
+    slice into a TIFF file at the output path of the job, including meta
+    data. At most one slice per channel is kept in memory. The exact size of
+    the result is calculated from the slice geometry before any tile is
+    loaded. If it is larger than the maximum allowed file size, a ValueError
+    is raised. Only rotations by multiples of 90 degrees are supported. If
+    passed in, <progress> is called with the number of written slices and
+    bytes after each slice. Returns the number of written slices.
+    """
+    # Make sure tile source getters have been initialized on the job
+    if job.needs_initialization:
+        job.initialize()
+
+    rot90_count = get_rot90_count( job.rotation_cw )
+    if rot90_count is None:
+        raise ValueError("Only rotations by multiples of 90 degrees are supported")
+
+    s_to_bb, n_slices = get_stack_bounding_boxes( job )
+    slices = plan_slices( job, s_to_bb, n_slices )
+
+    samples = 1 if job.single_channel else 3
+    pages = []
+    for channels in slices:
+        for bb, image_parts in channels:
+            if image_parts:
+                if rot90_count % 2:
+                    pages.append((bb.height, bb.width, samples))
+                else:
+                    pages.append((bb.width, bb.height, samples))
+    if not pages:
+        return 0
+
+    writer = TiffWriter( job.output_path,
+            description=get_imagej_description( job, len(pages) ),
+            software="Created with CATMAID",
+            resolution=get_pixel_per_nm( job ) )
+    total_size = writer.get_file_size( pages )
+    if total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+        raise ValueError("The size of the requested image region is larger "
+                         "than the maximum allowed file size: %s > %s Bytes" % \
+                         (total_size, settings.GENERATED_FILES_MAXIMUM_SIZE))
+
+    writer.open()
+    try:
+        for n, cropped_slice in enumerate(extract_substack_arrays( job, slices )):
+            writer.write_page( cropped_slice )
+            if progress:
+                progress( n + 1, writer.file.tell() )
+    finally:
+        writer.close()
+
+    return len(pages)
+
 def rotate2d(degrees, point, origin):
     """ A rotation function that rotates a point counter-clockwise around
     a point. To rotate around the origin use [0,0].
@@ -577,34 +936,62 @@ def process_crop_job(job, create_message=True):
     """ This method does the actual cropping. It controls the data extraction
     and the creation of the sub-stack. It can be executed as Celery task.
     """
-    try:
-        # Create the sub-stack
-        cropped_stack = extract_substack( job )
-
-        # Create tho output image
-        outputImage = ImageList()
-        for img in cropped_stack:
-            outputImage.append( img )
+    progress = None
+    if job.record_id is not None:
+        update_cropping_job( job.record_id, status='running' )
+        progress = lambda slices_done, bytes_written: update_cropping_job(
+                job.record_id, slices_done=slices_done,
+                bytes_written=bytes_written )
 
-        # Save the resulting micro_stack to a temporary location
+    try:
         no_error_occured = True
         error_message = ""
-        # Only produce an image if parts of stacks are within the output
-        if len( cropped_stack ) > 0:
-            outputImage.writeImages( job.output_path )
-            # Add some meta data to the image
-            addMetaData( job.output_path, job, cropped_stack )
+        if get_rot90_count( job.rotation_cw ) is not None:
+            # Stream the sub-stack slice by slice into the output file,
+            # including meta data.
+            n_images = write_substack( job, progress )
         else:
+            # Arbitrary rotations need the whole sub-stack in memory.
+            cropped_stack = extract_substack( job )
+            n_images = len( cropped_stack )
+
+            # Create tho output image
+            outputImage = ImageList()
+            for img in cropped_stack:
+                outputImage.append( img )
+
+            # Save the resulting micro_stack to a temporary location
+            if n_images > 0:
+                outputImage.writeImages( job.output_path )
+                # Add some meta data to the image
+                addMetaData( job.output_path, job, cropped_stack )
+
+        # Only produce an image if parts of stacks are within the output
+        if 0 == n_images:
             no_error_occured = False
             error_message = "A region outside the stack has been selected. " \
                     "Therefore, no image was produced."
-    except (IOError, OSError, ValueError), e:
+    except Exception, e:
+        if not isinstance( e, (IOError, OSError, ValueError) ):
+            logger.exception( "Crop job %s failed" % job.output_path )
         no_error_occured = False
         error_message = str(e)
         # Delete the file if parts of it have been written already
         if os.path.exists( job.output_path ):
             os.remove( job.output_path )
 
+    if not job.needs_initialization:
+        logger.info("Crop job %s: %s" % (job.output_path, job.fetch_metrics))
+
+    if job.record_id is not None:
+        if no_error_occured:
+            update_cropping_job( job.record_id, status='finished',
+                    slices_done=n_images,
+                    bytes_written=os.path.getsize( job.output_path ) )
+        else:
+            update_cropping_job( job.record_id, status='failed',
+                    error=error_message )
+
     if create_message:
         # Create a notification message
         bb_text = "( %s, %s, %s ) -> ( %s, %s, %s )" % (job.x_min, job.y_min, \
@@ -631,17 +1018,193 @@ def process_crop_job(job, create_message=True):
 
     return None if no_error_occured else error_message
 
-def start_asynch_process( job ):
-    """ It launches the data extraction and sub-stack building as a seperate process.
-    This process uses the addmessage command with manage.py to write a message for the
-    user into the data base once the process is done.
+def update_cropping_job( record_id, **fields ):
+    """ Updates the passed in fields of a CroppingJob and its edition time.
     """
-    result = process_crop_job.delay( job )
+    fields['edition_time'] = timezone.now()
+    CroppingJob.objects.filter( id=record_id ).update( **fields )
 
-    # Create closing response
-    closingResponse = HttpResponse(json.dumps(""), content_type="application/json")
+def estimate_crop_size( job ):
+    """ Returns the size in bytes of the uncompressed sub-stack of the passed
+    in job, which is calculated from its bounding box, zoom level and number
+    of stacks. Parts of the bounding box outside the stack are included.
+    """
+    width = to_x_index( job.x_max, job, False ) - to_x_index( job.x_min, job, False )
+    height = to_y_index( job.y_max, job, False ) - to_y_index( job.y_min, job, False )
+    n_slices = get_slice_count( job )
+    samples = 1 if job.single_channel else 3
+    return max(width, 1) * max(height, 1) * n_slices * len(job.stacks) * samples
+
+def get_slice_count( job ):
+    return max(to_z_index( job.z_max, job ) + 1 - to_z_index( job.z_min, job ), 1)
+
+def is_small_crop_job( job_type, estimated_size ):
+    return 'roi_images' == job_type or \
+            estimated_size <= settings.CROPPING_SMALL_JOB_SIZE
+
+def schedule_crop_job( job ):
+    """ Creates a CroppingJob record for the passed in job, if the quotas of
+    its user allow it, and starts it once the current transaction is
+    committed. A ValueError is raised if the job is too large or the user has
+    too many active jobs. Returns the new record.
+    """
+    estimated_size = estimate_crop_size( job )
+    if estimated_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+        raise ValueError("The estimated size of the requested image region "
+                "is larger than the maximum allowed file size: %s > %s Bytes" % \
+                (estimated_size, settings.GENERATED_FILES_MAXIMUM_SIZE))
+
+    return schedule_job( job.user.id, job.project_id, 'crop', {
+                'stack_ids': job.stack_ids,
+                'x_min': job.x_min,
+                'x_max': job.x_max,
+                'y_min': job.y_min,
+                'y_max': job.y_max,
+                'z_min': job.z_min,
+                'z_max': job.z_max,
+                'rotation_cw': job.rotation_cw,
+                'zoom_level': job.zoom_level,
+                'single_channel': job.single_channel,
+            }, estimated_size, get_slice_count( job ), job.output_path )
+
+def schedule_job( user_id, project_id, job_type, parameters, estimated_size,
+        n_slices, output_path='', check_quotas=True ):
+    """ Creates a CroppingJob record of the passed in type, which is started
+    once the current transaction is committed. Cropping jobs and node exports
+    are limited by the quotas of their user, a ValueError is raised if the
+    user has too many active jobs. ROI images are rendered on behalf of users
+    and aren't checked. Returns the new record.
+    """
+    if check_quotas:
+        # Lock the user to check quotas without interference from parallel
+        # requests of the same user.
+        User.objects.select_for_update().get( id=user_id )
+        active_jobs = CroppingJob.objects.filter( user_id=user_id,
+                status__in=('queued', 'running') ).exclude(
+                        job_type='roi_images' ).values_list( 'estimated_size',
+                                flat=True )
+        if len(active_jobs) >= settings.CROPPING_MAX_JOBS_PER_USER:
+            raise ValueError("You can only have %s cropping or export jobs at "
+                    "the same time, please wait until one of them is "
+                    "finished." % settings.CROPPING_MAX_JOBS_PER_USER)
+        if sum(active_jobs) + estimated_size > settings.CROPPING_MAX_ACTIVE_SIZE_PER_USER:
+            raise ValueError("The size of all your active cropping and export "
+                    "jobs would be larger than the allowed %s Bytes, please "
+                    "wait until some of them are finished." % \
+                    settings.CROPPING_MAX_ACTIVE_SIZE_PER_USER)
+
+    record = CroppingJob.objects.create( user_id=user_id,
+            project_id=project_id, job_type=job_type, output_path=output_path,
+            estimated_size=estimated_size, n_slices=n_slices,
+            parameters=parameters )
+    transaction.on_commit( dispatch_crop_jobs )
+
+    return record
+
+def dispatch_crop_jobs():
+    """ Starts queued jobs, ROI images first and then the smallest ones. ROI
+    images and other small jobs are always started right away. To keep
+    workers available for interactive tasks, at most CROPPING_MAX_LARGE_JOBS
+    larger jobs run at the same time, others wait until a running job is done.
+    """
+    started = []
+    with transaction.atomic():
+        # Jobs whose worker was lost don't report progress anymore. They
+        # would count against the quotas of their user forever.
+        min_time = timezone.now() - timedelta( seconds=settings.CROPPING_JOB_TIMEOUT )
+        CroppingJob.objects.filter( status='running',
+                edition_time__lt=min_time ).update( status='failed',
+                        edition_time=timezone.now(),
+                        error="The job didn't make progress for %s seconds" % \
+                                settings.CROPPING_JOB_TIMEOUT )
+
+        queued = sorted( CroppingJob.objects.select_for_update().filter(
+                status='queued' ), key=lambda r: ( 'roi_images' != r.job_type,
+                        r.estimated_size, r.id ) )
+        n_large_running = sum(1 for job_type, size in CroppingJob.objects.filter(
+                status='running' ).values_list( 'job_type', 'estimated_size' )
+                if not is_small_crop_job( job_type, size ))
+        for record in queued:
+            if not is_small_crop_job( record.job_type, record.estimated_size ):
+                if n_large_running >= settings.CROPPING_MAX_LARGE_JOBS:
+                    continue
+                n_large_running += 1
+            update_cropping_job( record.id, status='running' )
+            started.append( record.id )
+
+    for record_id in started:
+        process_scheduled_crop_job.delay( record_id )
 
-    return closingResponse
+@task()
+def process_scheduled_crop_job( record_id ):
+    """ Runs the job tracked by the passed in CroppingJob and starts waiting
+    jobs afterwards. The job is marked as failed if it can't be run.
+    """
+    try:
+        record = CroppingJob.objects.get( id=record_id )
+        p = record.parameters
+        if 'crop' == record.job_type:
+            job = CropJob( record.user, record.project_id, p['stack_ids'],
+                    p['x_min'], p['x_max'], p['y_min'], p['y_max'], p['z_min'],
+                    p['z_max'], p['rotation_cw'], p['zoom_level'],
+                    p['single_channel'], record.output_path )
+            job.record_id = record_id
+            return process_crop_job( job )
+        elif record.job_type in ('treenode_export', 'connector_export'):
+            from catmaid.control.treenodeexport import process_scheduled_export_job
+            return process_scheduled_export_job( record )
+        elif 'roi_images' == record.job_type:
+            from catmaid.control.roi import process_scheduled_roi_images
+            return process_scheduled_roi_images( record )
+        raise ValueError( "Unknown job type: %s" % record.job_type )
+    except Exception, e:
+        logger.exception( "Cropping job %s failed" % record_id )
+        update_cropping_job( record_id, status='failed', error=str(e) )
+        return str(e)
+    finally:
+        dispatch_crop_jobs()
+
+def get_cropping_job_info( record ):
+    info = {
+        'id': record.id,
+        'job_type': record.job_type,
+        'status': record.status,
+        'creation_time': record.creation_time.isoformat(),
+        'edition_time': record.edition_time.isoformat(),
+        'estimated_size': record.estimated_size,
+        'n_slices': record.n_slices,
+        'slices_done': record.slices_done,
+        'bytes_written': record.bytes_written,
+        'error': record.error,
+    }
+    if 'finished' == record.status and record.output_path:
+        file_name = os.path.basename( record.output_path )
+        if 'crop' == record.job_type:
+            info['url'] = os.path.join( settings.CATMAID_URL, "crop/download/" + file_name + "/")
+        else:
+            info['url'] = os.path.join( settings.CATMAID_URL, settings.MEDIA_URL,
+                    settings.MEDIA_TREENODE_SUBDIRECTORY, file_name )
+    return info
+
+@login_required
+def cropping_jobs( request ):
+    """ Returns the status and progress of all cropping, export and ROI image
+    jobs of the requesting user that are queued or running or have been
+    created within the last day.
+    """
+    min_time = timezone.now() - timedelta( days=1 )
+    records = CroppingJob.objects.filter( user=request.user ).filter(
+            Q(status__in=('queued', 'running')) | Q(creation_time__gt=min_time)
+            ).order_by( 'id' )
+    return JsonResponse( [get_cropping_job_info( r ) for r in records], safe=False )
+
+@login_required
+def cropping_job( request, job_id=None ):
+    """ Returns the status and progress of a single cropping, export or ROI
+    image job of the requesting user.
+    """
+    record = get_object_or_404( CroppingJob, id=job_id, user=request.user )
+    return JsonResponse( get_cropping_job_info( record ) )
 
 def sanity_check( job ):
     """ Tests the job parameters for obvious problems.
@@ -712,8 +1275,12 @@ def crop(request, project_id=None, stack_ids=None, x_min=None, x_max=None,
         err_response = json_error_response( err_message )
         return err_response
         
-    result = start_asynch_process( job )
-    return result
+    try:
+        record = schedule_crop_job( job )
+    except ValueError as e:
+        return json_error_response( str(e) )
+
+    return JsonResponse( get_cropping_job_info( record ) )
 
 def cleanup( max_age=1209600 ):
     """ Cleans up the temporarily space of the cropped stacks.
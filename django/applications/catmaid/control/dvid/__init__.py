@@ -1,8 +1,6 @@
-import json
-import urllib2
-
 from collections import defaultdict
 
+from catmaid.control.metadatacache import get_metadata_client
 from catmaid.models import Stack
 
 # These DVID instance types are supported by CATMAID
@@ -143,16 +141,12 @@ class DVIDClient:
 
 
 def get_server_info(url):
-    """Return the parsed JSON result of a DVID server's info endpoint.
+    """Return the parsed JSON result of a DVID server's info endpoint. Results
+    are cached for REMOTE_METADATA_CACHE_TTL seconds and must not be modified.
     """
     try:
-        info_url = '%s/api/repos/info' % url
-        req = urllib2.Request(info_url, headers={'Content-Type': 'application/json'})
-        opener = urllib2.build_opener()
-        info_json = opener.open(req).read()
-    except urllib2.HTTPError as e:
-        raise ValueError("Couldn't retrieve DVID project information from %s" % url)
-    except urllib2.URLError as e:
+        info_url = '%s/api/repos/info' % url.rstrip('/')
+        return get_metadata_client().get_json(info_url,
+                headers={'Content-Type': 'application/json'})
+    except ValueError as e:
         raise ValueError("Couldn't retrieve DVID project information from %s" % url)
-
-    return json.loads(info_json)
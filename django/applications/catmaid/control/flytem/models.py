@@ -1,18 +1,16 @@
-import json
-import urllib2
-
 from django.conf import settings
 
+from catmaid.control.metadatacache import get_metadata_client
+
 
 def load_json(url):
+    """ Returns the parsed JSON document at <url>. Results are cached for
+    REMOTE_METADATA_CACHE_TTL seconds and must not be modified.
+    """
     try:
-        json_text = urllib2.urlopen(url).read()
-    except urllib2.HTTPError as e:
+        return get_metadata_client().get_json(url)
+    except ValueError as e:
         raise ValueError("Couldn't retrieve render service data from %s. Error: %s" % (url, e))
-    except urllib2.URLError as e:
-        raise ValueError("Couldn't retrieve render service data from %s. Error: %s" % (url, e))
-
-    return json.loads(json_text)
 
 
 class FlyTEMDimension:
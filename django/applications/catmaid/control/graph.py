@@ -18,7 +18,8 @@ from django.http import HttpResponse
 from catmaid.models import Relation, UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
-from catmaid.control.review import get_treenodes_to_reviews
+from catmaid.control.review import get_packed_treenode_reviews, \
+        merge_treenode_reviews
 from catmaid.control.tree_util import simplify, find_root, reroot, partition, \
         spanning_tree, cable_length
 
@@ -123,17 +124,19 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
            location_x, location_y, location_z
     FROM treenode
     WHERE skeleton_id IN (%s)
+    ORDER BY id
     ''' % skeletons_string)
     rows = tuple(cursor.fetchall())
     # Each skeleton is represented with a DiGraph
     arbors = defaultdict(nx.DiGraph)
 
-    # Get reviewers for the requested skeletons
-    reviews = get_treenodes_to_reviews(skeleton_ids=skeleton_ids)
+    # Stream reviewers for the requested skeletons, packed per node and
+    # ordered by node ID like the treenode rows.
+    reviews = get_packed_treenode_reviews(skeleton_ids)
 
     # Create a DiGraph for every skeleton
-    for row in rows:
-        arbors[row[3]].add_node(row[0], {'reviewer_ids': reviews.get(row[0], [])})
+    for row, reviewer_ids in merge_treenode_reviews(rows, reviews):
+        arbors[row[3]].add_node(row[0], {'reviewer_ids': reviewer_ids})
 
     # Dictionary of skeleton IDs vs list of DiGraph instances
     arbors = split_by_confidence_and_add_edges(confidence_threshold, arbors, rows)
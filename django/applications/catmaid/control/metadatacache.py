@@ -0,0 +1,112 @@
+import threading
+
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+
+class PendingRequest(object):
+    """ A request for a URL that is currently running. Other threads that
+    need the same URL wait for its result instead of sending their own
+    request.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MetadataClient(object):
+    """ Retrieves JSON documents from remote services like DVID or the FlyTEM
+    render service. Parsed documents are cached for <ttl> seconds and
+    connections are kept alive. If a document is requested by multiple threads
+    at the same time, only one request is sent and all threads share its
+    result. Cached documents are shared as well and must not be modified.
+    """
+    def __init__(self, ttl, timeout=None, pool_size=10):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # Maps URLs to (expiration time, document) tuples
+        self.entries = {}
+        # Maps URLs to requests that are currently running
+        self.pending = {}
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_json(self, url, headers=None):
+        """ Returns the parsed JSON document at <url>. A ValueError is raised
+        if it can't be retrieved.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry and entry[0] > time():
+                return entry[1]
+            request = self.pending.get(url)
+            is_owner = request is None
+            if is_owner:
+                request = PendingRequest()
+                self.pending[url] = request
+
+        if not is_owner:
+            request.event.wait()
+            if request.error:
+                raise request.error
+            return request.result
+
+        try:
+            request.result = self._load(url, headers)
+            with self.lock:
+                self._prune()
+                self.entries[url] = (time() + self.ttl, request.result)
+        except ValueError as e:
+            request.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[url]
+            request.event.set()
+
+        return request.result
+
+    def _load(self, url, headers):
+        try:
+            response = self.session.get(url, headers=headers,
+                    timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except requests.RequestException as e:
+            raise ValueError("Couldn't retrieve %s: %s" % (url, e))
+
+    def _prune(self):
+        """ Removes expired entries, needs to be called with the lock held.
+        """
+        now = time()
+        expired = [url for url, entry in self.entries.iteritems() if entry[0] <= now]
+        for url in expired:
+            del self.entries[url]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# The client is shared by all requests handled by the same process
+_shared_lock = threading.Lock()
+_shared_client = None
+
+
+def get_metadata_client():
+    """ Returns the metadata client of this process.
+    """
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            _shared_client = MetadataClient(settings.REMOTE_METADATA_CACHE_TTL,
+                    settings.REMOTE_METADATA_TIMEOUT)
+        return _shared_client
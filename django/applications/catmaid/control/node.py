@@ -16,8 +16,9 @@ from catmaid import state
 from catmaid.models import UserRole, Treenode, Connector, \
         ClassInstanceClassInstance, Review
 from catmaid.control.authentication import requires_user_role, \
-        can_edit_all_or_fail
+        can_edit_skeletons_or_fail, user_domain
 from catmaid.control.common import get_relation_to_id_map, get_request_list
+from catmaid.control.review import get_review_status
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -512,6 +513,90 @@ def update_location_reviewer(request, project_id=None, node_id=None):
     }), content_type='application/json')
 
 
+@api_view(['POST'])
+@requires_user_role(UserRole.Annotate)
+def update_location_reviewer_batch(request, project_id=None):
+    """Mark a set of treenodes as reviewed by the requesting user.
+
+    All reviews are created or updated with a single statement, existing
+    reviews of the same reviewer get their review time updated. The review
+    status of all skeletons affected by this change is returned with respect
+    to the reviews of the requesting user.
+    ---
+    parameters:
+        - name: treenode_ids[]
+          description: IDs of the treenodes to mark as reviewed
+          required: true
+          type: array
+          items:
+            type: integer
+          paramType: form
+    type:
+      reviewer_id:
+        description: ID of the user that reviewed the nodes
+        type: integer
+        required: true
+      review_time:
+        description: The time the reviews were recorded
+        type: string
+        format: date-time
+        required: true
+      reviewed_nodes:
+        description: IDs of all treenodes that were marked as reviewed
+        type: array
+        items:
+          type: integer
+        required: true
+      review_status:
+        description: |
+          Maps the IDs of all affected skeletons to a tuple of total node
+          count and number of nodes reviewed by the requesting user.
+        type: object
+        required: true
+    """
+    treenode_ids = set(get_request_list(request.POST, 'treenode_ids',
+            map_fn=int) or [])
+    if not treenode_ids:
+        raise ValueError("Need at least one treenode ID")
+
+    review_time = timezone.now()
+    cursor = connection.cursor()
+    cursor.execute("""
+        INSERT INTO review (project_id, reviewer_id, review_time,
+            skeleton_id, treenode_id)
+        SELECT %(project_id)s, %(reviewer_id)s, %(review_time)s,
+            t.skeleton_id, t.id
+        FROM treenode t
+        JOIN UNNEST(%(treenode_ids)s::bigint[]) node(id)
+          ON t.id = node.id
+        WHERE t.project_id = %(project_id)s
+        ON CONFLICT (treenode_id, reviewer_id) DO UPDATE
+        SET review_time = EXCLUDED.review_time
+        RETURNING treenode_id, skeleton_id
+    """, {
+        'project_id': project_id,
+        'reviewer_id': request.user.id,
+        'review_time': review_time,
+        'treenode_ids': list(treenode_ids),
+    })
+    reviewed = cursor.fetchall()
+
+    missing = treenode_ids - set(r[0] for r in reviewed)
+    if missing:
+        raise ValueError("Could not find treenodes: " +
+                ", ".join(map(str, missing)))
+
+    skeleton_ids = set(r[1] for r in reviewed)
+    review_status = get_review_status(skeleton_ids, user_ids=[request.user.id])
+
+    return JsonResponse({
+        'reviewer_id': request.user.id,
+        'review_time': review_time.isoformat(),
+        'reviewed_nodes': [r[0] for r in reviewed],
+        'review_status': review_status,
+    })
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def most_recent_treenode(request, project_id=None):
     treenode_id = int(request.POST.get('treenode_id', -1))
@@ -544,41 +629,76 @@ def most_recent_treenode(request, project_id=None):
 def _update_location(table, nodes, now, user, cursor):
     if not nodes:
         return
+    if table not in ('treenode', 'connector'):
+        raise ValueError("Invalid table: " + table)
     # 0: id
     # 1: X
     # 2: Y
     # 3: Z
-    can_edit_all_or_fail(user, (node[0] for node in nodes), table)
-
     # Sanitize node details
     nodes = [(int(i), float(x), float(y), float(z)) for i,x,y,z in nodes]
+    ids, xs, ys, zs = (list(c) for c in zip(*nodes))
 
-    node_template = "(" + "),(".join(["%s, %s, %s, %s"] * len(nodes)) + ")"
-    node_table = [v for k in nodes for v in k]
+    # Owners of all nodes and, for treenodes, their skeletons are retrieved
+    # with a single query. Besides owning the nodes (or being allowed to edit
+    # the work of their owners), the user needs permission to edit the neurons
+    # of all affected skeletons.
+    cursor.execute("""
+        SELECT DISTINCT user_id, {} FROM {}
+        WHERE id = ANY(%s::bigint[])
+    """.format('skeleton_id' if table == 'treenode' else 'NULL', table), (ids,))
+    owners = cursor.fetchall()
+    if not user.is_superuser and not set(o[0] for o in owners).issubset(
+            user_domain(cursor, user.id)):
+        raise Exception('User %s cannot edit all of the %s unique objects '
+                'from table %s' % (user.username, len(set(ids)), table))
+    if table == 'treenode':
+        can_edit_skeletons_or_fail(user, set(o[1] for o in owners), cursor)
 
     cursor.execute("""
-        UPDATE location n
+        UPDATE {0} n
         SET editor_id = %s, location_x = target.x,
             location_y = target.y, location_z = target.z
         FROM (SELECT x.id, x.location_x AS old_loc_x,
                      x.location_y AS old_loc_y, x.location_z AS old_loc_z,
                      y.new_loc_x AS x, y.new_loc_y AS y, y.new_loc_z AS z
-              FROM location x
-              INNER JOIN (VALUES {}) y(id, new_loc_x, new_loc_y, new_loc_z)
-              ON x.id = y.id FOR NO KEY UPDATE) target
+              FROM {0} x
+              INNER JOIN UNNEST(%s::bigint[], %s::real[], %s::real[],
+                                %s::real[]) y(id, new_loc_x, new_loc_y, new_loc_z)
+              ON x.id = y.id FOR NO KEY UPDATE OF x) target
         WHERE n.id = target.id
         RETURNING n.id, n.edition_time, target.old_loc_x, target.old_loc_y,
                   target.old_loc_z
-    """.format(node_template), [user.id] + node_table)
+    """.format(table), (user.id, ids, xs, ys, zs))
 
     updated_rows = cursor.fetchall()
     if len(nodes) != len(updated_rows):
         raise ValueError('Coudn\'t update node ' +
                          ','.join(frozenset([str(r[0]) for r in nodes]) -
                                   frozenset([str(r[0]) for r in updated_rows])))
+
+    if table == 'treenode':
+        # Row triggers update the edges of moved nodes and their connector
+        # links, edges of children are updated for all nodes at once.
+        _update_child_edges(ids, cursor)
+
     return updated_rows
 
 
+def _update_child_edges(parent_ids, cursor):
+    """Recreate the treenode_edge entries of all children of the passed in
+    nodes, e.g. after they were moved."""
+    cursor.execute("""
+        UPDATE treenode_edge e
+        SET edge = ST_MakeLine(
+            ST_MakePoint(c.location_x, c.location_y, c.location_z),
+            ST_MakePoint(p.location_x, p.location_y, p.location_z))
+        FROM treenode c
+        JOIN treenode p ON p.id = c.parent_id
+        WHERE p.id = ANY(%s::bigint[]) AND e.id = c.id
+    """, (list(parent_ids),))
+
+
 @requires_user_role(UserRole.Annotate)
 def node_update(request, project_id=None):
     treenodes = get_request_list(request.POST, "t") or []
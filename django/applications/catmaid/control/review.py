@@ -1,4 +1,5 @@
 import json
+import uuid
 
 from collections import defaultdict
 
@@ -59,6 +60,73 @@ def get_treenodes_to_reviews_with_time(treenode_ids=None, skeleton_ids=None,
 
     return treenode_to_reviews
 
+def get_packed_treenode_reviews(skeleton_ids, with_time=False,
+                                batch_size=10000):
+    """ Returns a generator over all reviewed nodes of the passed in
+    <skeleton_ids>, ordered by treenode ID. For each node, a tuple of the
+    treenode ID and a list of its reviewer IDs is yielded. If <with_time> is
+    true, a third element holds the list of matching review times. Reviews are
+    aggregated per node by the database. Within a transaction, they are read
+    through a server-side cursor in batches of <batch_size> rows, which
+    avoids loading all reviews into memory. Use merge_treenode_reviews() to
+    combine the result with a cursor over treenodes that are ordered by ID,
+    too.
+    """
+    if not skeleton_ids:
+        return
+    if connection.in_atomic_block:
+        # Named cursors of psycopg2 are server-side cursors, which only
+        # exist within a transaction.
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(
+                name='packed_reviews_%s' % uuid.uuid4().hex)
+        cursor.itersize = batch_size
+    else:
+        cursor = connection.cursor()
+    cursor.execute('''
+        SELECT treenode_id, array_agg(reviewer_id ORDER BY id)
+        {}
+        FROM review
+        WHERE skeleton_id = ANY(%s)
+        GROUP BY treenode_id
+        ORDER BY treenode_id
+    '''.format(', array_agg(review_time ORDER BY id)' if with_time else ''),
+        (list(skeleton_ids),))
+
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+def merge_treenode_reviews(treenodes, reviews, with_time=False):
+    """ Merges an iterable of treenode rows with packed reviews as returned
+    by get_packed_treenode_reviews(). Both inputs are expected to be ordered
+    by treenode ID, which is the first element of every treenode row. A tuple
+    of treenode row and the list of its reviewer IDs is yielded for every
+    treenode. If <with_time> is true, the reviewer list contains tuples of
+    reviewer ID and review time, like get_treenodes_to_reviews_with_time().
+    """
+    reviews = iter(reviews)
+    review = next(reviews, None)
+    for treenode in treenodes:
+        treenode_id = treenode[0]
+        # Skip reviews of nodes that are not part of the treenode list
+        while review is not None and review[0] < treenode_id:
+            review = next(reviews, None)
+        if review is not None and review[0] == treenode_id:
+            if with_time:
+                yield treenode, zip(review[1], review[2])
+            else:
+                yield treenode, review[1]
+            review = next(reviews, None)
+        else:
+            yield treenode, []
+
 def get_review_count(skeleton_ids):
     """ Returns a dictionary that maps skelton IDs to dictonaries that map
     user_ids to a review count for this particular skeleton.
@@ -1,10 +1,17 @@
+import fcntl
 import json
 import os.path
+import threading
+
+from collections import defaultdict
+from datetime import datetime
+from time import time
 
 from django.conf import settings
+from django.db import transaction
 from django.http import HttpResponse
-from django.shortcuts import redirect
-from django.core.cache import cache
+from django.shortcuts import get_object_or_404, redirect
+from django.utils import timezone
 
 from catmaid.control import cropping
 from catmaid.control.authentication import requires_user_role
@@ -12,7 +19,6 @@ from catmaid.control.common import urljoin
 from catmaid.models import UserRole, RegionOfInterest, Project, Relation, \
         Stack, ClassInstance, RegionOfInterestClassInstance
 
-from celery.task import task
 from celery.utils.log import get_task_logger
 
 # Prefix for stored ROIs
@@ -24,8 +30,9 @@ roi_path = os.path.join(settings.MEDIA_ROOT,
     settings.MEDIA_ROI_SUBDIRECTORY)
 # A common logger for the celery tasks
 logger = get_task_logger(__name__)
-# Locks will expire after two minutes
-LOCK_EXPIRE = 60 * 2
+# A requested ROI image is queued again, if it hasn't been rendered after
+# this many seconds.
+pending_roi_image_timeout = 600
 
 @requires_user_role([UserRole.Browse])
 def get_roi_info(request, project_id=None, roi_id=None):
@@ -71,13 +78,9 @@ def _add_roi(project_id, stack_id, user_id, x_min, x_max, y_min, y_max, z,
     roi.width = width
     roi.height = height
     roi.rotation_cw = rotation_cw
+    # If wanted, the cropped image is created after saving
     roi.save()
 
-    # Create cropped image, if wanted
-    if settings.ROI_AUTO_CREATE_IMAGE:
-        file_name, file_path = create_roi_path(roi.id)
-        create_roi_image(request.user, project_id, roi.id, file_path)
-
     return roi
 
 @requires_user_role(UserRole.Annotate)
@@ -152,9 +155,10 @@ def remove_roi_link(request, project_id=None, roi_id=None):
         region_of_interest=roi_link.region_of_interest)
     if remaining_links.count() == 0:
         # Delete the ROI class instance
-        roi_link.region_of_interest.delete()
+        roi = roi_link.region_of_interest
+        file_name, file_path = create_roi_path(roi.id)
+        roi.delete()
         # Make sure, there is no cropped image left
-        file_name, file_path = create_roi_path(roi_id)
         file_info = ""
         if os.path.exists(file_path) and os.path.isfile(file_path):
             try:
@@ -162,6 +166,11 @@ def remove_roi_link(request, project_id=None, roi_id=None):
                 file_info = " The same goes for its cropped image."
             except OSError, e:
                 file_info = " However, its cropped image couldn't be removed."
+        for extra_path in (file_path + '.lock', file_path + '.pending'):
+            try:
+                os.remove(extra_path)
+            except OSError:
+                pass
         # Create status data
         status = {'status': "Removed ROI link with ID %s. The ROI " \
             "itself has been deleted as well.%s" % (roi_id, file_info)}
@@ -172,60 +181,248 @@ def remove_roi_link(request, project_id=None, roi_id=None):
 
     return HttpResponse(json.dumps(status))
 
-def create_lock_name(roi_id):
-    """ Creates a name for the image creation lock.
+class RoiImageBatch(object):
+    """ Collects the IDs of ROIs whose images should be created after the
+    current transaction is committed. The batch is registered as commit hook
+    for each queued ROI. The first hook that runs schedules all queued ROIs
+    for rendering, the others find the batch empty. ROIs queued in a
+    transaction that is rolled back are rendered with the next batch, which
+    only recreates images that aren't current.
     """
-    return "%s-lock-%s" % ('catmaid.create_roi_image', roi_id)
+    def __init__(self):
+        self.roi_ids = set()
 
-def create_roi_image(user, project_id, roi_id, file_path):
-    """ Tries to acquire a lock for a creating the cropped image
-    of a certain ROI. If able to do this, launches the celery task
-    which removes the lock when done.
+    def add(self, roi_id):
+        self.roi_ids.add(roi_id)
+        transaction.on_commit(self.dispatch)
+
+    def dispatch(self):
+        if self.roi_ids:
+            roi_ids = sorted(self.roi_ids)
+            self.roi_ids.clear()
+            schedule_roi_images(roi_ids)
+
+# Database connections are bound to threads, so is the ROI image batch
+_local = threading.local()
+
+def get_roi_image_batch():
+    """ Returns the ROI image batch of the current thread.
+    """
+    batch = getattr(_local, 'roi_image_batch', None)
+    if batch is None:
+        batch = RoiImageBatch()
+        _local.roi_image_batch = batch
+    return batch
+
+def queue_roi_image(roi_id):
+    """ Schedules the creation of the cropped image of a ROI. ROIs queued in
+    the same transaction are rendered together, once it is committed.
     """
-    lock_id = create_lock_name(roi_id)
-    # cache.add fails if the key is already exists
-    acquire_lock = lambda: cache.add(lock_id, "true", LOCK_EXPIRE)
-    if not acquire_lock():
-        logger.debug("ROI %s is already taken care of by another worker" % roi_id)
+    get_roi_image_batch().add(roi_id)
+
+def on_roi_save(sender, instance, created, **kwargs):
+    """ Renders the image of a ROI eagerly, if enabled. An existing image of
+    an updated ROI is removed first.
+    """
+    if not settings.ROI_AUTO_CREATE_IMAGE:
+        return
+    if not created:
+        file_name, file_path = create_roi_path(instance.id)
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+    queue_roi_image(instance.id)
+
+def is_roi_image_current(roi, file_path):
+    """ Returns whether the image at <file_path> exists and has been created
+    after the last edit of the ROI.
+    """
+    try:
+        mtime = os.path.getmtime(file_path)
+    except OSError:
         return False
-    else:
-        create_roi_image_task.delay(user, project_id, roi_id, file_path)
-        return True
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return mtime >= (roi.edition_time - epoch).total_seconds()
 
-@task(name='catmaid.create_roi_image')
-def create_roi_image_task(user, project_id, roi_id, file_path):
-    lock_id = create_lock_name(roi_id)
-    # memcache delete is very slow, but we have to use it to take
-    # advantage of using add() for atomic locking
-    release_lock = lambda: cache.delete(lock_id)
-    logger.debug("Creating cropped image for ROI with ID %s" % roi_id)
+def render_roi_image(roi):
+    """ Creates the cropped image of a ROI, unless it is current already or
+    another worker creates it at the same time. Returns whether an image was
+    written.
+    """
+    file_name, file_path = create_roi_path(roi.id)
+    lock_path = file_path + '.lock'
+    # An exclusive lock on a file next to the image makes sure only one worker
+    # creates it. The lock is released automatically if the worker dies.
+    with open(lock_path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logger.debug("ROI %s is already taken care of by another worker" % roi.id)
+            return False
+        try:
+            # The lock file is removed by the worker that held the lock
+            # before, in which case the lock doesn't protect anything.
+            try:
+                if not os.path.samestat(os.fstat(lock_file.fileno()),
+                        os.stat(lock_path)):
+                    return False
+            except OSError:
+                return False
+            try:
+                return _write_roi_image(roi, file_path)
+            finally:
+                os.remove(lock_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _write_roi_image(roi, file_path):
+    """ Creates the cropped image of a ROI at <file_path>, unless it is current
+    already. Returns whether an image was written.
+    """
+    if is_roi_image_current(roi, file_path):
+        return False
+    logger.debug("Creating cropped image for ROI with ID %s" % roi.id)
+    # Prepare parameters
+    hwidth = roi.width * 0.5
+    x_min = roi.location_x - hwidth
+    x_max = roi.location_x + hwidth
+    hheight = roi.height * 0.5
+    y_min = roi.location_y - hheight
+    y_max = roi.location_y + hheight
+    z_min = z_max = roi.location_z
+    single_channel = False
+    # Create a cropping job
+    job = cropping.CropJob(roi.user, roi.project_id, [roi.stack_id],
+        x_min, x_max, y_min, y_max, z_min, z_max, roi.rotation_cw,
+        roi.zoom_level, single_channel)
+    # Create the pgmagick images
+    cropped_stacks = cropping.extract_substack( job )
+    if len(cropped_stacks) == 0:
+        raise StandardError("Couldn't create ROI image")
+    # There is only one image here. It is written to a temporary file
+    # first so that no partially written image is served.
+    img = cropped_stacks[0]
+    tmp_path = "%s.tmp.%s" % (file_path, file_extension)
+    img.write(str(tmp_path))
+    os.rename(tmp_path, file_path)
+    return True
+
+def evict_roi_images(image_path=roi_path):
+    """ Removes the least recently used ROI images in <image_path> until all
+    of them together take up at most ROI_IMAGE_CACHE_MAXIMUM_SIZE bytes.
+    Serving an image updates its modification time. Returns the number of
+    removed images.
+    """
+    images = []
+    for name in os.listdir(image_path):
+        # Images that are still being written are ignored
+        if name.startswith(file_prefix) and name.endswith("." + file_extension) \
+                and ".tmp." not in name:
+            path = os.path.join(image_path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            images.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for mtime, size, path in images)
+    n_removed = 0
+    for mtime, size, path in sorted(images):
+        if total_size <= settings.ROI_IMAGE_CACHE_MAXIMUM_SIZE:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+            n_removed += 1
+        except OSError:
+            pass
+    return n_removed
+
+def estimate_roi_image_size(roi):
+    """ Returns the size in bytes of the uncompressed image of a ROI.
+    """
+    resolution = roi.stack.resolution
+    scale = 2 ** roi.zoom_level
+    width = int(roi.width / (resolution.x * scale)) + 1
+    height = int(roi.height / (resolution.y * scale)) + 1
+    return width * height * 3
+
+def schedule_roi_images(roi_ids):
+    """ Creates a CroppingJob record that renders the images of the passed in
+    ROIs for each of their projects and editors. These jobs are small, they
+    are started right away by the scheduler of cropping jobs and before
+    larger cropping and export jobs. Returns the new records.
+    """
+    rois = defaultdict(list)
+    for roi in RegionOfInterest.objects.filter(id__in=roi_ids).select_related('stack'):
+        rois[(roi.project_id, roi.editor_id)].append(roi)
+    records = []
+    for (project_id, user_id), group in rois.iteritems():
+        records.append(cropping.schedule_job(user_id, project_id,
+                'roi_images', {'roi_ids': sorted(r.id for r in group)},
+                sum(estimate_roi_image_size(r) for r in group), len(group),
+                check_quotas=False))
+    return records
+
+def render_roi_images(roi_ids, progress=None):
+    """ Creates the images of all passed in ROIs that don't have a current
+    one and evicts old images if the cache grows too large. The progress
+    function is called with the number of handled ROIs. Returns the number of
+    created and removed images.
+    """
+    n_created = 0
     try:
-        # Get ROI
-        roi = RegionOfInterest.objects.get(id=roi_id)
-        # Prepare parameters
-        hwidth = roi.width * 0.5
-        x_min = roi.location_x - hwidth
-        x_max = roi.location_x + hwidth
-        hheight = roi.height * 0.5
-        y_min = roi.location_y - hheight
-        y_max = roi.location_y + hheight
-        z_min = z_max = roi.location_z
-        single_channel = False
-        # Create a cropping job
-        job = cropping.CropJob(user, project_id, [roi.stack.id],
-            x_min, x_max, y_min, y_max, z_min, z_max, roi.rotation_cw,
-            roi.zoom_level, single_channel)
-        # Create the pgmagick images
-        cropped_stacks = cropping.extract_substack( job )
-        if len(cropped_stacks) == 0:
-            raise StandardError("Couldn't create ROI image")
-        # There is only one image here
-        img = cropped_stacks[0]
-        img.write(str(file_path))
+        for n, roi in enumerate(RegionOfInterest.objects.filter(id__in=roi_ids)):
+            try:
+                if render_roi_image(roi):
+                    n_created += 1
+            except (IOError, OSError, StandardError) as e:
+                logger.error("Couldn't create image of ROI %s: %s" % (roi.id, e))
+            if progress:
+                progress(n + 1)
     finally:
-        release_lock()
+        for roi_id in roi_ids:
+            file_name, file_path = create_roi_path(roi_id)
+            try:
+                os.remove(file_path + '.pending')
+            except OSError:
+                pass
+    n_removed = evict_roi_images()
+
+    return n_created, n_removed
 
-    return "Created image of ROI %s" % roi_id
+def process_scheduled_roi_images(record):
+    """ Renders the images of the ROIs of the passed in CroppingJob record.
+    """
+    roi_ids = record.parameters['roi_ids']
+    n_created, n_removed = render_roi_images(roi_ids, lambda n:
+            cropping.update_cropping_job(record.id, slices_done=n))
+    cropping.update_cropping_job(record.id, status='finished',
+            slices_done=len(roi_ids))
+
+    return "Created %s images of %s ROIs, removed %s old images" % \
+            (n_created, len(roi_ids), n_removed)
+
+def mark_roi_image_pending(file_path):
+    """ Marks the image at <file_path> as requested with a file next to it.
+    Returns False if the image has been requested already within the last
+    pending_roi_image_timeout seconds, True otherwise.
+    """
+    marker_path = file_path + '.pending'
+    try:
+        if time() - os.path.getmtime(marker_path) < pending_roi_image_timeout:
+            return False
+        # The render task of an outdated request didn't finish
+        os.remove(marker_path)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(marker_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except OSError:
+        # Another request created the marker first
+        return False
 
 def create_roi_path(roi_id):
     """ Creates a tuple (file name, file path) for the given ROI ID.
@@ -237,19 +434,27 @@ def create_roi_path(roi_id):
 
 @requires_user_role([UserRole.Browse])
 def get_roi_image(request, project_id=None, roi_id=None):
-    """ Returns the URL to the cropped image, described by the ROI.  These
-    images are cached, and won't get removed automatically. If the image is
-    already present its URL is used and returned. For performance reasons it
-    might be a good idea, to add this test to the web-server config.
+    """ Returns the URL to the cropped image, described by the ROI. These
+    images are cached, least recently used images are removed if the cache
+    grows too large. If the image is present and was created after the last
+    edit of the ROI, its URL is used and returned. Otherwise, a new image is
+    created asynchronously.
     """
-    file_name, file_path = create_roi_path(roi_id)
-    if not os.path.exists(file_path):
-        # Start async processing
-        create_roi_image(request.user, project_id, roi_id, file_path)
+    roi = get_object_or_404(RegionOfInterest, id=roi_id)
+    file_name, file_path = create_roi_path(roi.id)
+    if not is_roi_image_current(roi, file_path):
+        # Start async processing, unless this image is requested already
+        if mark_roi_image_pending(file_path):
+            queue_roi_image(roi.id)
         # Use waiting image
         url = urljoin(settings.STATIC_URL,
             "images/wait_bgwhite.gif")
     else:
+        # Mark the image as recently used
+        try:
+            os.utime(file_path, None)
+        except OSError:
+            pass
         # Create real image di
         url_base = urljoin(settings.MEDIA_URL,
             settings.MEDIA_ROI_SUBDIRECTORY)
@@ -1,11 +1,12 @@
 import json
 import networkx as nx
+import numpy as np
 import pytz
 import re
 from operator import itemgetter
 from datetime import datetime, timedelta
 from collections import defaultdict
-from itertools import chain
+from cStringIO import StringIO
 
 from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
@@ -24,14 +25,15 @@ from catmaid.objects import Skeleton, SkeletonGroup, \
         compartmentalize_skeletongroup_by_edgecount, \
         compartmentalize_skeletongroup_by_confidence
 from catmaid.control.authentication import requires_user_role, \
-        can_edit_class_instance_or_fail, can_edit_or_fail
-from catmaid.control.common import insert_into_log, get_class_to_id_map, \
-        get_relation_to_id_map, _create_relation
+        can_edit_class_instance_or_fail, can_edit_or_fail, \
+        can_edit_skeletons_or_fail
+from catmaid.control.common import insert_into_log, get_relation_to_id_map
 from catmaid.control.neuron import _delete_if_empty
+from catmaid.control.treenode import _allocate_ids, _create_skeletons
 from catmaid.control.neuron_annotations import create_annotation_query, \
         _annotate_entities, _update_neuron_annotations
 from catmaid.control.review import get_review_status
-from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
+from catmaid.control.tree_util import reroot, edge_count_to_root
 
 
 def get_skeleton_permissions(request, project_id, skeleton_id):
@@ -611,33 +613,37 @@ def split_skeleton(request, project_id=None):
     # Make sure the user has permissions to edit
     can_edit_class_instance_or_fail(request.user, neuron.id, 'neuron')
 
-    # Retrieve the id, parent_id of all nodes in the skeleton. Also
-    # pre-emptively lock all treenodes and connectors in the skeleton to prevent
-    # race conditions resulting in inconsistent skeleton IDs from, e.g., node
-    # creation or update.
-    cursor.execute('''
-        SELECT 1 FROM treenode_connector tc WHERE tc.skeleton_id = %s
-        ORDER BY tc.id
-        FOR NO KEY UPDATE OF tc;
-        SELECT t.id, t.parent_id FROM treenode t WHERE t.skeleton_id = %s
-        ORDER BY t.id
-        FOR NO KEY UPDATE OF t
-        ''', (skeleton_id, skeleton_id)) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
-    # find downstream nodes starting from target treenode_id
-    # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
+    # The nodes downstream of the split node, including it, are found by
+    # following child links in the database.
+    downstream_nodes = '''
+        WITH RECURSIVE downstream (id) AS (
+          SELECT %(treenode_id)s::bigint
+          UNION ALL
+          SELECT t.id
+          FROM treenode t
+          JOIN downstream d ON t.parent_id = d.id
+        )
+    '''
+
+    # Pre-emptively lock all treenodes and connector links downstream of the
+    # split node to prevent race conditions resulting in inconsistent skeleton
+    # IDs from, e.g., node creation or update. Nodes upstream stay unlocked.
+    cursor.execute(downstream_nodes + '''
+        , locked_nodes AS (
+          SELECT t.id FROM treenode t
+          JOIN downstream d ON t.id = d.id
+          ORDER BY t.id
+          FOR NO KEY UPDATE OF t
+        ), locked_links AS (
+          SELECT tc.id FROM treenode_connector tc
+          JOIN downstream d ON tc.treenode_id = d.id
+          ORDER BY tc.id
+          FOR NO KEY UPDATE OF tc
+        )
+        SELECT (SELECT count(*) FROM locked_nodes),
+               (SELECT count(*) FROM locked_links)
+        ''', {'treenode_id': treenode_id})
+
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
@@ -666,18 +672,33 @@ def split_skeleton(request, project_id=None):
     cici.project_id = project_id
     cici.save()
 
-    # Update skeleton IDs for treenodes, treenode_connectors, and reviews.
-    cursor.execute("""
-        UPDATE treenode
+    # Update skeleton IDs for downstream treenodes, treenode_connectors, and
+    # reviews in a single statement. The downstream nodes are found again,
+    # because nodes could have been added to them before they were locked.
+    cursor.execute(downstream_nodes + '''
+        , moved_nodes AS (
+          UPDATE treenode t
           SET skeleton_id = %(new_skeleton_id)s
-          WHERE id = ANY(%(change_list)s::bigint[]);
-        UPDATE treenode_connector
+          FROM downstream d
+          WHERE t.id = d.id
+          RETURNING t.id
+        ), moved_links AS (
+          UPDATE treenode_connector tc
           SET skeleton_id = %(new_skeleton_id)s
-          WHERE treenode_id = ANY(%(change_list)s::bigint[]);
-        UPDATE review
+          FROM downstream d
+          WHERE tc.treenode_id = d.id
+          RETURNING tc.id
+        ), moved_reviews AS (
+          UPDATE review r
           SET skeleton_id = %(new_skeleton_id)s
-          WHERE treenode_id = ANY(%(change_list)s::bigint[]);
-        """, {'new_skeleton_id': new_skeleton.id, 'change_list': change_list})
+          FROM downstream d
+          WHERE r.treenode_id = d.id
+          RETURNING r.id
+        )
+        SELECT (SELECT count(*) FROM moved_nodes),
+               (SELECT count(*) FROM moved_links),
+               (SELECT count(*) FROM moved_reviews)
+        ''', {'treenode_id': treenode_id, 'new_skeleton_id': new_skeleton.id})
 
     # setting new root treenode's parent to null
     Treenode.objects.filter(id=treenode_id).update(parent=None, editor=request.user)
@@ -1162,9 +1183,13 @@ def reroot_skeleton(request, project_id=None):
         raise Exception(response_on_error + ':' + str(e))
 
 
-def _reroot_skeleton(treenode_id, project_id):
+def _reroot_skeleton(treenode_id, project_id, new_parent_id=None,
+        new_skeleton_id=None, editor_id=None):
     """ Returns the treenode instance that is now root,
-    or False if the treenode was root already. """
+    or False if the treenode was root already. If <new_parent_id> is given,
+    the rerooted skeleton is attached to this node instead. The nodes on the
+    rerooted path then take <new_skeleton_id> and the treenode is marked as
+    edited by <editor_id>. """
     if treenode_id is None:
         raise Exception('A treenode id has not been provided!')
 
@@ -1177,49 +1202,51 @@ def _reroot_skeleton(treenode_id, project_id):
         first_parent = rootnode.parent_id
 
         # If no parent found it is assumed this node is already root
-        if first_parent is None:
+        if first_parent is None and new_parent_id is None:
             return False
 
         response_on_error = 'An error occured while rerooting.'
-        q_treenode = Treenode.objects.filter(
-                skeleton_id=rootnode.skeleton_id,
-                project=project_id).values_list('id', 'parent_id', 'confidence')
-        nodes = {tnid: (parent_id, confidence) for (tnid, parent_id, confidence) in list(q_treenode)}
-
-        # Traverse up the chain of parents, reversing the parent relationships so
-        # that the selected treenode (with ID treenode_id) becomes the root.
-        new_parents = []
-        new_parent = rootnode.id
-        new_confidence = rootnode.confidence
-        node = first_parent
-
-        while True:
-            # Store current values to be used in next iteration
-            parent, confidence = nodes[node]
-
-            # Set new values
-            new_parents.append((node, new_parent, new_confidence))
-
-            if parent is None:
-                # Root has been reached
-                break
-            else:
-                # Prepare next iteration
-                new_parent = node
-                new_confidence = confidence
-                node = parent
-
-        # Finally make treenode root
-        new_parents.append((rootnode.id, 'NULL', 5)) # Reset to maximum confidence.
-
+        # Walk up the chain of parents from the new root to the old root and
+        # reverse the parent relationships along it, so that the selected
+        # treenode (with ID treenode_id) becomes the root. Each node on the
+        # path takes its former child as parent, together with the confidence
+        # of the edge, which is stored on the child. The new root is reset to
+        # maximum confidence, unless it is attached to a new parent without
+        # being rerooted. No other node of the skeleton is read.
         cursor = connection.cursor()
         cursor.execute('''
+                WITH RECURSIVE path (id, parent_id, confidence, child_id,
+                                     child_confidence) AS (
+                  SELECT t.id, t.parent_id, t.confidence,
+                         %(new_parent_id)s::bigint,
+                         CASE WHEN %(new_parent_id)s IS NOT NULL
+                                   AND t.parent_id IS NULL
+                              THEN t.confidence
+                              ELSE 5::smallint END
+                  FROM treenode t
+                  WHERE t.id = %(treenode_id)s
+                  UNION ALL
+                  SELECT t.id, t.parent_id, t.confidence, p.id, p.confidence
+                  FROM path p
+                  JOIN treenode t ON t.id = p.parent_id
+                )
                 UPDATE treenode
-                SET parent_id = v.parent_id,
-                    confidence = v.confidence
-                FROM (VALUES %s) v(id, parent_id, confidence)
-                WHERE treenode.id = v.id
-                ''' % ','.join(['(%s,%s,%s)' % node for node in new_parents]))
+                SET parent_id = path.child_id,
+                    confidence = path.child_confidence,
+                    skeleton_id = COALESCE(%(new_skeleton_id)s,
+                                           treenode.skeleton_id),
+                    editor_id = CASE WHEN treenode.id = %(treenode_id)s
+                                     THEN COALESCE(%(editor_id)s,
+                                                   treenode.editor_id)
+                                     ELSE treenode.editor_id END
+                FROM path
+                WHERE treenode.id = path.id
+                ''', {
+                    'treenode_id': rootnode.id,
+                    'new_parent_id': new_parent_id,
+                    'new_skeleton_id': new_skeleton_id,
+                    'editor_id': editor_id
+                })
 
         return rootnode
 
@@ -1289,6 +1316,10 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
     reviews of the skeleton that changes ID are changed to refer to the new
     skeleton ID. If annotation_map is None, the resulting skeleton will have
     all annotations available on both skeletons combined.
+
+    Only the path from to_treenode to its root is read and updated to reroot
+    the joined skeleton. All other rows change their skeleton ID with one
+    statement per table, keyed by the indexed skeleton_id column.
     """
     if from_treenode_id is None or to_treenode_id is None:
         raise Exception('Missing arguments to _join_skeleton')
@@ -1298,39 +1329,54 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         from_treenode_id = int(from_treenode_id)
         to_treenode_id = int(to_treenode_id)
 
-        try:
-            from_treenode = Treenode.objects.get(pk=from_treenode_id)
-        except Treenode.DoesNotExist:
-            raise Exception("Could not find a skeleton for treenode #%s" % from_treenode_id)
+        # Get both nodes along with their skeletons and the neurons modeled by
+        # them in a single query.
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT t.id, t.skeleton_id, t.location_x, t.location_y,
+                   t.location_z, n.id, n.name
+            FROM treenode t
+            LEFT JOIN (class_instance_class_instance cici
+                JOIN relation r
+                  ON r.id = cici.relation_id AND r.relation_name = 'model_of'
+                JOIN class_instance n
+                  ON n.id = cici.class_instance_b)
+              ON cici.class_instance_a = t.skeleton_id
+            WHERE t.id IN (%s, %s)
+              AND t.project_id = %s
+        """, (from_treenode_id, to_treenode_id, project_id))
+        nodes = {}
+        for row in cursor.fetchall():
+            nodes.setdefault(row[0], row)
 
-        try:
-            to_treenode = Treenode.objects.get(pk=to_treenode_id)
-        except Treenode.DoesNotExist:
-            raise Exception("Could not find a skeleton for treenode #%s" % to_treenode_id)
+        for treenode_id in (from_treenode_id, to_treenode_id):
+            if treenode_id not in nodes:
+                raise Exception("Could not find a skeleton for treenode #%s" % treenode_id)
+            if nodes[treenode_id][5] is None:
+                raise Exception("Couldn't find a neuron linking to a skeleton " \
+                        "with ID %s" % nodes[treenode_id][1])
 
-        from_skid = from_treenode.skeleton_id
-        from_neuron = _get_neuronname_from_skeletonid( project_id, from_skid )
+        from_treenode = nodes[from_treenode_id]
+        from_skid = from_treenode[1]
+        from_neuron = {'neuronid': from_treenode[5], 'neuronname': from_treenode[6]}
 
-        to_skid = to_treenode.skeleton_id
-        to_neuron = _get_neuronname_from_skeletonid( project_id, to_skid )
+        to_treenode = nodes[to_treenode_id]
+        to_skid = to_treenode[1]
+        to_neuron = {'neuronid': to_treenode[5], 'neuronname': to_treenode[6]}
 
         if from_skid == to_skid:
             raise Exception('Cannot join treenodes of the same skeleton, this would introduce a loop.')
 
         # Make sure the user has permissions to edit both neurons
-        can_edit_class_instance_or_fail(
-                user, from_neuron['neuronid'], 'neuron')
-        can_edit_class_instance_or_fail(
-                user, to_neuron['neuronid'], 'neuron')
+        can_edit_skeletons_or_fail(user, (from_skid, to_skid), cursor)
 
         # Check if annotations are valid, if there is a particular selection
         if annotation_map is None:
             # Get all current annotations of both skeletons and merge them for
             # a complete result set.
-            from_annotation_info = get_annotation_info(project_id, (from_skid,),
-                    annotations=True, metaannotations=False, neuronnames=False)
-            to_annotation_info = get_annotation_info(project_id, (to_skid,),
-                    annotations=True, metaannotations=False, neuronnames=False)
+            annotation_info = get_annotation_info(project_id,
+                    (from_skid, to_skid), annotations=True,
+                    metaannotations=False, neuronnames=False)
             # Create a new annotation map with the expected structure of
             # 'annotationname' vs. 'annotator id'.
             def merge_into_annotation_map(source, skid, target):
@@ -1342,8 +1388,8 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
             # Merge from after to, so that it overrides entries from the merged
             # in skeleton.
             annotation_map = dict()
-            merge_into_annotation_map(to_annotation_info, to_skid, annotation_map)
-            merge_into_annotation_map(from_annotation_info, from_skid, annotation_map)
+            merge_into_annotation_map(annotation_info, to_skid, annotation_map)
+            merge_into_annotation_map(annotation_info, from_skid, annotation_map)
         else:
             if not check_annotations_on_join(project_id, user,
                     from_neuron['neuronid'], to_neuron['neuronid'],
@@ -1351,11 +1397,15 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
                 raise Exception("Annotation distribution is not valid for joining. " \
                 "Annotations for which you don't have permissions have to be kept!")
 
-        # Reroot to_skid at to_treenode if necessary
+        # Reroot to_skid at to_treenode and make from_treenode its parent. The
+        # nodes on the path from to_treenode to the old root also get the new
+        # skeleton ID, so that every treenode is updated only once.
         response_on_error = 'Could not reroot at treenode %s' % to_treenode_id
-        _reroot_skeleton(to_treenode_id, project_id)
+        _reroot_skeleton(to_treenode_id, project_id,
+                new_parent_id=from_treenode_id, new_skeleton_id=from_skid,
+                editor_id=user.id)
 
-        # The target skeleton is removed and its treenode assumes
+        # The target skeleton is removed and its remaining treenodes assume
         # the skeleton id of the from-skeleton.
 
         response_on_error = 'Could not update Treenode table with new skeleton id for joined treenodes.'
@@ -1377,18 +1427,13 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         # Remove the 'losing' neuron if it is empty
         _delete_if_empty(to_neuron['neuronid'])
 
-        # Update the parent of to_treenode.
-        response_on_error = 'Could not update parent of treenode with ID %s' % to_treenode_id
-        Treenode.objects.filter(id=to_treenode_id).update(parent=from_treenode_id, editor=user)
-
         # Update linked annotations of neuron
         response_on_error = 'Could not update annotations of neuron ' \
                 'with ID %s' % from_neuron['neuronid']
         _update_neuron_annotations(project_id, user, from_neuron['neuronid'],
                 annotation_map)
 
-        from_location = (from_treenode.location_x, from_treenode.location_y,
-                         from_treenode.location_z)
+        from_location = from_treenode[2:5]
         insert_into_log(project_id, user.id, 'join_skeleton',
                 from_location, 'Joined skeleton with ID %s (neuron: ' \
                 '%s) into skeleton with ID %s (neuron: %s, annotations: %s)' % \
@@ -1409,7 +1454,9 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
 def import_skeleton(request, project_id=None):
     """Import a neuron modeled by a skeleton from an uploaded file.
 
-    Currently only SWC representation is supported.
+    Currently only SWC representation is supported. If more than one file is
+    uploaded, each file is imported as a separate skeleton in the same
+    transaction.
     ---
     consumes: multipart/form-data
     parameters:
@@ -1437,94 +1484,124 @@ def import_skeleton(request, project_id=None):
             description: >
                 An object whose properties are node IDs in the import file and
                 whose values are IDs of the created nodes.
+        skeletons:
+            required: false
+            description: >
+                Only if multiple files are uploaded: a list with the file name,
+                neuron_id, skeleton_id and node_id_map of each imported file,
+                instead of the fields above.
     """
 
     neuron_id = request.POST.get('neuron_id', None)
     if neuron_id is not None:
         neuron_id = int(neuron_id)
 
-    if len(request.FILES) == 1:
-        for uploadedfile in request.FILES.itervalues():
-            if uploadedfile.size > settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE:
-                return HttpResponse('File too large. Maximum file size is {} bytes.'.format(settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE), status=413)
+    uploaded_files = [f for key in request.FILES
+            for f in request.FILES.getlist(key)]
+    if not uploaded_files:
+        return HttpResponseBadRequest('No file received.')
 
-            filename = uploadedfile.name
-            extension = filename.split('.')[-1].strip().lower()
-            if extension == 'swc':
-                swc_string = '\n'.join(uploadedfile)
-                return import_skeleton_swc(request.user, project_id, swc_string, neuron_id)
-            else:
-                return HttpResponse('File type "{}" not understood. Known file types: swc'.format(extension), status=415)
+    names = []
+    swc_strings = []
+    for uploadedfile in uploaded_files:
+        if uploadedfile.size > settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE:
+            return HttpResponse('File too large. Maximum file size is {} bytes.'.format(settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE), status=413)
+
+        filename = uploadedfile.name
+        extension = filename.split('.')[-1].strip().lower()
+        if extension != 'swc':
+            return HttpResponse('File type "{}" not understood. Known file types: swc'.format(extension), status=415)
+        names.append(filename)
+        swc_strings.append(uploadedfile.read())
+
+    imported = import_skeletons_swc(request.user, project_id, swc_strings,
+            neuron_id)
+
+    if 1 == len(imported):
+        return JsonResponse(imported[0])
 
-    return HttpResponseBadRequest('No file received.')
+    for name, import_info in zip(names, imported):
+        import_info['file'] = name
+    return JsonResponse({'skeletons': imported})
 
 
 def import_skeleton_swc(user, project_id, swc_string, neuron_id=None):
     """Import a neuron modeled by a skeleton in SWC format.
     """
+    return JsonResponse(import_skeletons_swc(user, project_id, [swc_string],
+            neuron_id)[0])
 
-    g = nx.DiGraph()
-    for line in swc_string.splitlines():
-        if line.startswith('#') or not line.strip():
-            continue
-        row = line.strip().split()
-        if len(row) != 7:
-            raise ValueError('SWC has a malformed line: {}'.format(line))
-
-        node_id = int(row[0])
-        parent_id = int(row[6])
-        g.add_node(node_id, {'x': float(row[2]),
-                             'y': float(row[3]),
-                             'z': float(row[4]),
-                             'radius': float(row[5])})
-
-        if parent_id != -1:
-            g.add_edge(parent_id, node_id)
-
-    if not nx.is_directed_acyclic_graph(g):
-        raise ValueError('SWC skeleton is malformed: it contains a cycle.')
-
-    import_info = _import_skeleton(user, project_id, g, neuron_id)
-    node_id_map = {n: d['id'] for n, d in import_info['graph'].nodes_iter(data=True)}
 
-    return JsonResponse({
-            'neuron_id': import_info['neuron_id'],
-            'skeleton_id': import_info['skeleton_id'],
-            'node_id_map': node_id_map,
-        })
+def parse_swc(swc_string):
+    """Parse an SWC string into NumPy arrays. Returned is a dictionary with the
+    node IDs of the file ("ids"), the location and radius of each node ("x",
+    "y", "z" and "radius") and for each node the index of its parent in these
+    arrays ("parent_index", -1 for the root). A ValueError is raised if the
+    nodes don't form a single tree.
+    """
+    try:
+        data = np.loadtxt(swc_string.splitlines(), comments='#', ndmin=2)
+    except ValueError as e:
+        raise ValueError('SWC has a malformed line: {}'.format(e))
+    if 0 == data.size:
+        raise ValueError('SWC contains no nodes')
+    if data.shape[1] != 7:
+        raise ValueError('SWC has malformed lines, seven columns are expected')
+
+    ids = data[:, 0].astype(np.int64)
+    parent_ids = data[:, 6].astype(np.int64)
+    if np.any(ids != data[:, 0]) or np.any(parent_ids != data[:, 6]):
+        raise ValueError('SWC skeleton is malformed: node IDs have to be integers.')
+
+    order = np.argsort(ids)
+    sorted_ids = ids[order]
+    if np.any(sorted_ids[1:] == sorted_ids[:-1]):
+        raise ValueError('SWC skeleton is malformed: node IDs are not unique.')
+
+    is_root = parent_ids == -1
+    if 1 != np.count_nonzero(is_root):
+        raise ValueError('SWC skeleton is malformed: it needs exactly one root.')
+
+    # Find the index of each parent by looking it up in the sorted IDs
+    position = np.clip(np.searchsorted(sorted_ids, parent_ids), 0, len(ids) - 1)
+    if np.any((sorted_ids[position] != parent_ids) & ~is_root):
+        raise ValueError('SWC skeleton is malformed: it references missing parents.')
+    parent_index = order[position]
+    parent_index[is_root] = -1
+
+    # With a single root and a parent for every other node, the nodes form a
+    # tree if every node reaches the root. This is tested by following
+    # parents with pointer jumping, which doubles the distance in each step.
+    root = np.flatnonzero(is_root)[0]
+    ancestor = np.where(is_root, root, parent_index)
+    for _ in range(int(np.ceil(np.log2(len(ids)))) + 1):
+        ancestor = ancestor[ancestor]
+    if np.any(ancestor != root):
+        raise ValueError('SWC skeleton is malformed: it contains a cycle.')
 
+    return {
+        'ids': ids,
+        'x': data[:, 2],
+        'y': data[:, 3],
+        'z': data[:, 4],
+        'radius': data[:, 5],
+        'parent_index': parent_index
+    }
 
-def _import_skeleton(user, project_id, arborescence, neuron_id=None, name=None):
-    """Create a skeleton from a networkx directed tree.
 
-    Associate the skeleton to the specified neuron, or a new one if none is
-    provided. Returns a dictionary of the neuron and skeleton IDs, and the
-    original arborescence with attributes added for treenode IDs.
+def import_skeletons_swc(user, project_id, swc_strings, neuron_id=None):
+    """Import each of the passed in SWC strings as a new skeleton. All
+    skeletons model the passed in neuron or a new neuron each. The nodes of
+    all skeletons are written with a single COPY. Returns a list with the
+    neuron ID, skeleton ID and a map of SWC node IDs to new treenode IDs for
+    every SWC string.
     """
-    # TODO: There is significant reuse here of code from create_treenode that
-    # could be DRYed up.
-    relation_map = get_relation_to_id_map(project_id)
-    class_map = get_class_to_id_map(project_id)
-
-    new_skeleton = ClassInstance()
-    new_skeleton.user = user
-    new_skeleton.project_id = project_id
-    new_skeleton.class_column_id = class_map['skeleton']
-    if name is not None:
-        new_skeleton.name = name
-    else:
-        new_skeleton.name = 'skeleton'
-        new_skeleton.save()
-        new_skeleton.name = 'skeleton %d' % new_skeleton.id
-    new_skeleton.save()
-
-    def relate_neuron_to_skeleton(neuron, skeleton):
-        return _create_relation(user, project_id,
-                relation_map['model_of'], skeleton, neuron)
+    project_id = int(project_id)
+    arbors = [parse_swc(s) for s in swc_strings]
 
     if neuron_id is not None:
         # Check that the neuron to use exists
-        if 0 == ClassInstance.objects.filter(pk=neuron_id).count():
+        if not ClassInstance.objects.filter(pk=neuron_id).exists():
             neuron_id = None
 
     if neuron_id is not None:
@@ -1532,83 +1609,47 @@ def _import_skeleton(user, project_id, arborescence, neuron_id=None, name=None):
         # edit the existing neuron.
         can_edit_class_instance_or_fail(user, neuron_id, 'neuron')
 
-    else:
-        # A neuron does not exist, therefore we put the new skeleton
-        # into a new neuron.
-        new_neuron = ClassInstance()
-        new_neuron.user = user
-        new_neuron.project_id = project_id
-        new_neuron.class_column_id = class_map['neuron']
-        if name is not None:
-            new_neuron.name = name
-        else:
-            new_neuron.name = 'neuron'
-            new_neuron.save()
-            new_neuron.name = 'neuron %d' % new_neuron.id
-        new_neuron.save()
-
-        neuron_id = new_neuron.id
-
-    relate_neuron_to_skeleton(neuron_id, new_skeleton.id)
-
-    # For pathological networks this can error, so do it before inserting
-    # treenodes.
-    root = find_root(arborescence)
-    if root is None:
-        raise Exception('No root, provided graph is malformed!')
-
-    # Bulk create the required number of treenodes. This must be done in two
-    # steps because treenode IDs are not known.
     cursor = connection.cursor()
-    cursor.execute("""
-        INSERT INTO treenode (project_id, location_x, location_y, location_z,
-            editor_id, user_id, skeleton_id)
-        SELECT t.project_id, t.x, t.x, t.x, t.user_id, t.user_id, t.skeleton_id
-        FROM (VALUES (%(project_id)s, 0, %(user_id)s, %(skeleton_id)s))
-            AS t (project_id, x, user_id, skeleton_id),
-            generate_series(1, %(num_treenodes)s)
-        RETURNING treenode.id;
-        """ % {
-            'project_id': project_id,
-            'user_id': user.id,
-            'skeleton_id': new_skeleton.id,
-            'num_treenodes': arborescence.number_of_nodes()})
-    treenode_ids = cursor.fetchall()
-    # Flatten IDs
-    treenode_ids = list(chain.from_iterable(treenode_ids))
-    nx.set_node_attributes(arborescence, 'id', dict(zip(arborescence.nodes(), treenode_ids)))
-
-    # Set parent node ID
-    for n, nbrs in arborescence.adjacency_iter():
-        for nbr in nbrs:
-            arborescence.node[nbr]['parent_id'] = arborescence.node[n]['id']
-            if not 'radius' in arborescence.node[nbr]:
-                arborescence.node[nbr]['radius'] = -1
-    arborescence.node[root]['parent_id'] = 'NULL'
-    if not 'radius' in arborescence.node[root]:
-        arborescence.node[root]['radius'] = -1
-    new_location = tuple([arborescence.node[root][k] for k in ('x', 'y', 'z')])
-
-    treenode_values = \
-            '),('.join([','.join(map(str, [d[k] for k in ('id', 'x', 'y', 'z', 'parent_id', 'radius')])) \
-            for n, d in arborescence.nodes_iter(data=True)])
-    cursor.execute("""
-        UPDATE treenode SET
-            location_x = v.x,
-            location_y = v.y,
-            location_z = v.z,
-            parent_id = v.parent_id,
-            radius = v.radius
-        FROM (VALUES (%s)) AS v(id, x, y, z, parent_id, radius)
-        WHERE treenode.id = v.id AND treenode.skeleton_id = %s
-        """ % (treenode_values, new_skeleton.id)) # Include skeleton ID for index performance.
-
-    # Log import.
-    insert_into_log(project_id, user.id, 'create_neuron',
-                    new_location, 'Create neuron %d and skeleton '
-                    '%d via import' % (new_neuron.id, new_skeleton.id))
-
-    return {'neuron_id': neuron_id, 'skeleton_id': new_skeleton.id, 'graph': arborescence}
+    models = _create_skeletons(project_id, user,
+            [(neuron_id, None)] * len(arbors), cursor)
+
+    # Treenode IDs are taken from the location sequence before writing, which
+    # allows to set parent IDs right away.
+    counts = [len(a['ids']) for a in arbors]
+    ids = np.array(_allocate_ids('location_id_seq', sum(counts), cursor),
+            dtype=np.int64)
+    offsets = np.cumsum([0] + counts)
+    parent_ids = np.concatenate([np.where(a['parent_index'] >= 0,
+            ids[offset + a['parent_index']], -1)
+            for a, offset in zip(arbors, offsets)])
+    skeleton_ids = np.repeat([m[0] for m in models], counts)
+
+    columns = [ids.astype(str), skeleton_ids.astype(str),
+            np.where(parent_ids >= 0, parent_ids.astype(str), '\\N')]
+    columns.extend(np.concatenate([a[k] for a in arbors]).astype(str)
+            for k in ('x', 'y', 'z', 'radius'))
+    lines = np.char.add('%s\t%s\t%s\t' % (project_id, user.id, user.id),
+            reduce(lambda a, b: np.char.add(np.char.add(a, '\t'), b), columns))
+    cursor.copy_from(StringIO('\n'.join(lines) + '\n'), 'treenode',
+            columns=('project_id', 'user_id', 'editor_id', 'id',
+                'skeleton_id', 'parent_id', 'location_x', 'location_y',
+                'location_z', 'radius'))
+
+    imported = []
+    for arbor, (skeleton_id, model_neuron_id), offset in zip(arbors, models, offsets):
+        new_ids = ids[offset:offset + len(arbor['ids'])]
+        root = np.flatnonzero(arbor['parent_index'] < 0)[0]
+        insert_into_log(project_id, user.id, 'create_neuron',
+                tuple(float(arbor[k][root]) for k in ('x', 'y', 'z')),
+                'Create neuron %d and skeleton %d via import' % \
+                (model_neuron_id, skeleton_id))
+        imported.append({
+            'neuron_id': model_neuron_id,
+            'skeleton_id': skeleton_id,
+            'node_id_map': dict(zip(arbor['ids'].tolist(), new_ids.tolist()))
+        })
+
+    return imported
 
 
 @requires_user_role(UserRole.Annotate)
@@ -19,8 +19,8 @@ from catmaid.models import UserRole, ClassInstance, Treenode, \
 from catmaid.control import export_NeuroML_Level3
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
-from catmaid.control.review import get_treenodes_to_reviews, \
-        get_treenodes_to_reviews_with_time
+from catmaid.control.review import get_packed_treenode_reviews, \
+        merge_treenode_reviews
 
 from tree_util import edge_count_to_root, partition
 try:
@@ -273,7 +273,9 @@ def compact_arbor_with_minutes(request, project_id=None, skeleton_id=None, with_
 # DEPRECATED. Will be removed.
 def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=0, all_field=False):
     """ with_connectors: when False, connectors are not returned
-        lean: when not zero, both connectors and tags are returned as empty arrays. """
+        lean: when not zero, both connectors and tags are returned as empty arrays.
+        The last element of each node is the list of its reviewer IDs, which
+        are paired with their review times if all_field is set. """
     skeleton_id = int(skeleton_id) # sanitize
     cursor = connection.cursor()
 
@@ -306,20 +308,22 @@ def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=
         '''SELECT id, parent_id, user_id, location_x, location_y, location_z, radius, confidence %s
           FROM treenode
           WHERE skeleton_id = %s
+          ORDER BY id
         ''' % (added_fields, skeleton_id) )
 
-    # array of properties: id, parent_id, user_id, x, y, z, radius, confidence
-    nodes = tuple(cursor.fetchall())
+    # Stream all reviews for this skeleton, aggregated per node by the
+    # database and ordered by node ID like the nodes, and add the reviewers to
+    # each node.
+    packed_reviews = get_packed_treenode_reviews([skeleton_id],
+            with_time=all_field)
+    # array of properties: id, parent_id, user_id, x, y, z, radius, confidence,
+    # reviewers
+    nodes = tuple(node + (rids,) for node, rids in merge_treenode_reviews(
+            cursor.fetchall(), packed_reviews, with_time=all_field))
 
     tags = defaultdict(list) # node ID vs list of tags
     connectors = []
 
-    # Get all reviews for this skeleton
-    if all_field:
-        reviews = get_treenodes_to_reviews_with_time(skeleton_ids=[skeleton_id])
-    else:
-        reviews = get_treenodes_to_reviews(skeleton_ids=[skeleton_id])
-
     if 0 == lean: # meaning not lean
         # Text tags
         cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='labeled_as'" % int(project_id))
@@ -365,9 +369,9 @@ def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=
                                    0 if 'r' == row[2][1] else 1,
                                    x, y, z,
                                    row[6] if all_field else None))
-            return name, nodes, tags, connectors, reviews
+            return name, nodes, tags, connectors
 
-    return name, nodes, tags, connectors, reviews
+    return name, nodes, tags, connectors
 
 
 # DEPRECATED. Will be removed.
@@ -730,15 +734,18 @@ def _export_review_skeleton(project_id=None, skeleton_id=None,
             LEFT OUTER JOIN suppressed_virtual_treenode svt
               ON (t.id = svt.child_id)
             WHERE t.skeleton_id = %s
-            GROUP BY t.id;
+            GROUP BY t.id
+            ORDER BY t.id;
             """, (skeleton_id,))
     treenodes = cursor.fetchall()
-    # Get all reviews for the requested skeleton
-    reviews = get_treenodes_to_reviews_with_time(skeleton_ids=[skeleton_id])
 
     if 0 == len(treenodes):
         return []
 
+    # Get all reviews for the requested skeleton, ordered by node ID like the
+    # treenodes so that both can be merged while iterating.
+    reviews = get_packed_treenode_reviews([skeleton_id], with_time=True)
+
     # The root node will be assigned below, depending on retrieved nodes and
     # sub-arbor requests
     root_id = None
@@ -747,16 +754,16 @@ def _export_review_skeleton(project_id=None, skeleton_id=None,
     # it.
     g = nx.DiGraph()
     reviewed = set()
-    for t in treenodes:
+    for t, rids in merge_treenode_reviews(treenodes, reviews, with_time=True):
         # While at it, send the reviewer IDs, which is useful to iterate fwd
         # to the first unreviewed node in the segment.
         g.add_node(t[0], {'id': t[0],
                           'x': t[2],
                           'y': t[3],
                           'z': t[4],
-                          'rids': reviews[t[0]],
+                          'rids': rids,
                           'sup': [[o, l] for [o, l] in zip(t[5], t[6]) if o is not None]})
-        if reviews[t[0]]:
+        if rids:
             reviewed.add(t[0])
         if t[1]: # if parent
             g.add_edge(t[1], t[0]) # edge from parent to child
@@ -15,7 +15,7 @@ from rest_framework.decorators import api_view
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
 from catmaid.models import ClassInstance, Connector, Treenode, User, UserRole, \
-        Review, Relation, TreenodeConnector
+        Review, TreenodeConnector
 
 
 def _process(query, minus1name):
@@ -119,39 +119,175 @@ def stats_history(request, project_id=None):
 
     return HttpResponse(json.dumps(stats), content_type='application/json')
 
+
+@api_view(['GET'])
 def stats_user_activity(request, project_id=None):
+    """Get the creation times of all nodes and synaptic links of a user
+
+    By default, the creation time of every treenode as well as of every pre-
+    and postsynaptic link created by the given user is returned as a list of
+    UNIX timestamps. For users with a long history this list can get very
+    large. Therefore two more compact representations are available: with
+    <format=columnar>, time stamps are returned in milliseconds as delta
+    encoded integers, i.e. the first element is an absolute time stamp and
+    every following element is the difference to its predecessor. With
+    <format=histogram>, the counts of created elements are binned in the
+    database into intervals of <bin_size> seconds. Only elements created after
+    <since> are returned, which allows to fetch updates incrementally.
+    ---
+    parameters:
+    - name: username
+      description: Name of the user to return activity information for
+      required: true
+      type: string
+      paramType: form
+    - name: since
+      description: |
+        Only return activity strictly after this point in time, either as
+        UNIX timestamp in seconds or as date string (e.g. 2016-08-30T12:00Z).
+      required: false
+      type: string
+      paramType: form
+    - name: format
+      description: |
+        Either "list" (default), "columnar" or "histogram".
+      required: false
+      type: string
+      paramType: form
+    - name: bin_size
+      description: |
+        Bin size in seconds for the histogram format, defaults to 3600.
+      required: false
+      type: integer
+      paramType: form
+    """
     username = request.GET.get('username', None)
-    all_users = User.objects.filter().values('username', 'id')
-    map_name_to_userid = {}
-    for user in all_users:
-        map_name_to_userid[user['username']] = user['id']
-    relations = dict((r.relation_name, r.id) for r in Relation.objects.filter(project=project_id))
-    # Retrieve all treenodes and creation time
-    stats = Treenode.objects \
-        .filter(
-            project=project_id,
-            user=map_name_to_userid[username] ) \
-        .order_by('creation_time') \
-        .values('creation_time')
-    # Extract the timestamps from the datetime objects
-    timepoints = [time.mktime(ele['creation_time'].timetuple()) for ele in stats]
-    # Retrieve TreenodeConnector creation times
-    stats_prelink = TreenodeConnector.objects \
-        .filter(
-            project=project_id,
-            user=map_name_to_userid[username],
-            relation=relations['presynaptic_to'] ) \
-        .order_by('creation_time').values('creation_time')
-    stats_postlink = TreenodeConnector.objects \
-        .filter(
-            project=project_id,
-            user=map_name_to_userid[username],
-            relation=relations['postsynaptic_to'] ) \
-        .order_by('creation_time').values('creation_time')
-    prelinks = [time.mktime(ele['creation_time'].timetuple()) for ele in stats_prelink]
-    postlinks = [time.mktime(ele['creation_time'].timetuple()) for ele in stats_postlink]
-    return HttpResponse(json.dumps({'skeleton_nodes': timepoints,
-         'presynaptic': prelinks, 'postsynaptic': postlinks}), content_type='application/json')
+    if not username:
+        raise ValueError("Need username")
+    user = User.objects.get(username=username)
+
+    response_format = request.GET.get('format', 'list')
+    if response_format not in ('list', 'columnar', 'histogram'):
+        raise ValueError("Unknown format: " + response_format)
+
+    since = request.GET.get('since', None)
+    if since:
+        try:
+            since = datetime.utcfromtimestamp(float(since)).replace(tzinfo=pytz.utc)
+        except ValueError:
+            since = dateparser.parse(since)
+            if not since.tzinfo:
+                since = since.replace(tzinfo=pytz.utc)
+
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'))
+
+    # The three time series share their table and filter structure. The
+    # treenode query has no relation constraint.
+    sources = (
+        ('skeleton_nodes', 'treenode', None),
+        ('presynaptic', 'treenode_connector', relations['presynaptic_to']),
+        ('postsynaptic', 'treenode_connector', relations['postsynaptic_to']),
+    )
+
+    if 'list' == response_format:
+        result = {}
+        for name, table, relation_id in sources:
+            stats = Treenode.objects if 'treenode' == table else \
+                    TreenodeConnector.objects.filter(relation=relation_id)
+            stats = stats.filter(project=project_id, user=user.id)
+            if since:
+                stats = stats.filter(creation_time__gt=since)
+            stats = stats.order_by('creation_time').values('creation_time')
+            # Extract the timestamps from the datetime objects
+            result[name] = [time.mktime(ele['creation_time'].timetuple())
+                    for ele in stats]
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    if 'histogram' == response_format:
+        bin_size = int(request.GET.get('bin_size', 3600))
+        if bin_size < 1:
+            raise ValueError("Bin size needs to be a positive number of seconds")
+        result = {
+            'format': response_format,
+            'bin_size': bin_size,
+        }
+        for name, table, relation_id in sources:
+            result[name] = _get_activity_histogram(project_id, user.id,
+                    table, relation_id, since, bin_size)
+    else:
+        result = {
+            'format': response_format,
+            'unit': 'ms',
+        }
+        for name, table, relation_id in sources:
+            result[name] = _get_activity_deltas(project_id, user.id,
+                    table, relation_id, since)
+
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+def _activity_constraints(table, relation_id, since):
+    """Create the WHERE clause used for activity queries on treenodes or
+    treenode-connector links.
+    """
+    constraints = ['project_id = %(project_id)s', 'user_id = %(user_id)s']
+    if relation_id is not None:
+        constraints.append('relation_id = %(relation_id)s')
+    if since:
+        constraints.append('creation_time > %(since)s')
+    return 'FROM {} WHERE {}'.format(table, ' AND '.join(constraints))
+
+
+def _get_activity_histogram(project_id, user_id, table, relation_id, since,
+        bin_size):
+    """Return a columnar histogram of element creation times. The start of
+    each bin is given as UNIX timestamp in seconds, empty bins are omitted.
+    """
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT bin * %(bin_size)s, count(*)
+        FROM (
+            SELECT floor(extract(epoch FROM creation_time) / %(bin_size)s)::bigint AS bin
+            {}
+        ) binned
+        GROUP BY bin
+        ORDER BY bin
+    '''.format(_activity_constraints(table, relation_id, since)), {
+        'project_id': project_id,
+        'user_id': user_id,
+        'relation_id': relation_id,
+        'since': since,
+        'bin_size': bin_size
+    })
+    rows = cursor.fetchall()
+    return {
+        'bins': [r[0] for r in rows],
+        'counts': [r[1] for r in rows]
+    }
+
+
+def _get_activity_deltas(project_id, user_id, table, relation_id, since):
+    """Return delta encoded creation times in milliseconds. The first value is
+    an absolute UNIX timestamp and every following value is the difference to
+    its predecessor. Both the conversion and the encoding are done by the
+    database.
+    """
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT ts - lag(ts, 1, 0::bigint) OVER (ORDER BY ts)
+        FROM (
+            SELECT (extract(epoch FROM creation_time) * 1000)::bigint AS ts
+            {}
+        ) stamps
+        ORDER BY ts
+    '''.format(_activity_constraints(table, relation_id, since)), {
+        'project_id': project_id,
+        'user_id': user_id,
+        'relation_id': relation_id,
+        'since': since
+    })
+    return [r[0] for r in cursor.fetchall()]
 
 @api_view(['GET'])
 def stats_user_history(request, project_id=None):
@@ -1,11 +1,21 @@
 import os
 import cStringIO
+import fcntl
+import glob
+import threading
+import uuid
+from collections import defaultdict, OrderedDict
 from contextlib import closing
+from time import time
 import logging
 import numpy as np
 import base64
 from django.conf import settings
 
+from catmaid.control.tilecache import TileCache
+
+from celery.task import task
+
 try:
     from PIL import Image
 except:
@@ -19,7 +29,133 @@ except ImportError, e:
     logger.warning("CATMAID was unable to load the h5py library. "
           "HDF5 tiles are therefore disabled.")
 
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+
+
+# Output formats of HDF5 tiles, mapped to their content type and PIL format.
+# Raw tiles are the plain 8 bit pixel values in row-major order.
+tile_formats = {
+    'png': ('image/png', 'PNG'),
+    'jpg': ('image/jpeg', 'JPEG'),
+    'jpeg': ('image/jpeg', 'JPEG'),
+    'raw': ('application/octet-stream', None),
+}
+
+# New label datasets are stored in chunks of this shape (y, x, z). Label
+# writes are aligned to the chunks of a dataset.
+label_chunk_shape = (256, 256, 1)
+
+
+class HDF5FilePool(object):
+    """ Keeps up to <max_files> HDF5 files open for reading, the least
+    recently used file is closed if more are needed. A file is reopened if
+    its modification time changed since it was opened.
+    """
+    def __init__(self, max_files):
+        self.max_files = max_files
+        # Maps paths to (file, mtime) tuples, least recently used first
+        self.files = OrderedDict()
+        # HDF5 files must not be closed while they are read from
+        self.lock = threading.RLock()
+
+    def get(self, path, mtime):
+        """ Returns the open file at <path>, which has to be called with the
+        lock of this pool held.
+        """
+        entry = self.files.pop(path, None)
+        if entry:
+            if entry[1] == mtime:
+                self.files[path] = entry
+                return entry[0]
+            entry[0].close()
+        hfile = h5py.File(path, 'r')
+        self.files[path] = (hfile, mtime)
+        while len(self.files) > self.max_files:
+            _, (old_file, _) = self.files.popitem(last=False)
+            old_file.close()
+        return hfile
+
+    def invalidate(self, path):
+        with self.lock:
+            entry = self.files.pop(path, None)
+            if entry:
+                entry[0].close()
+
+
+# The file pool and the tile cache are created lazily for each process
+_shared_lock = threading.Lock()
+_file_pool = None
+_tile_cache = None
+
+
+def get_file_pool():
+    global _file_pool
+    with _shared_lock:
+        if _file_pool is None:
+            _file_pool = HDF5FilePool(settings.HDF5_FILE_HANDLE_POOL_SIZE)
+        return _file_pool
+
+
+def get_tile_cache():
+    global _tile_cache
+    with _shared_lock:
+        if _tile_cache is None:
+            _tile_cache = TileCache(settings.HDF5_TILE_CACHE_SIZE)
+        return _tile_cache
+
+
+def encode_tile(data, file_extension):
+    """ Encodes a 2D array of 8 bit pixel values in the passed in format.
+    """
+    pil_format = tile_formats[file_extension][1]
+    if not pil_format:
+        return np.ascontiguousarray(data).tostring()
+    output = cStringIO.StringIO()
+    Image.fromarray(data, 'L').save(output, pil_format)
+    return output.getvalue()
+
+
+def get_blank_tile(width, height, file_extension):
+    """ Returns an encoded black tile of the passed in size, which is only
+    created once.
+    """
+    cache = get_tile_cache()
+    key = ('blank', width, height, file_extension)
+    tile, _ = cache.get(key)
+    if tile is None:
+        tile = encode_tile(np.zeros((height, width), dtype=np.uint8),
+                file_extension)
+        cache.put(key, tile)
+    return tile
+
+
+def read_tile(fpath, scale, z, x, y, width, height, file_extension):
+    """ Returns the encoded tile at the passed in location of an HDF5 file.
+    Encoded tiles are cached until the file changes. If the file doesn't
+    contain the requested scale level, a blank tile is returned.
+    """
+    mtime = os.stat(fpath).st_mtime
+    cache = get_tile_cache()
+    key = (fpath, mtime, scale, z, x, y, width, height, file_extension)
+    tile, _ = cache.get(key)
+    if tile is not None:
+        return tile
+
+    pool = get_file_pool()
+    with pool.lock:
+        hfile = pool.get(fpath, mtime)
+        if not str(scale) in hfile['/']:
+            return get_blank_tile(width, height, file_extension)
+        hdfpath = '/' + str(scale) + '/' + str(z) + '/data'
+        data = hfile[hdfpath][y:y+height,x:x+width]
+
+    # Tiles at the border of the image are filled up with black
+    tile_data = np.zeros((height, width), dtype=np.uint8)
+    tile_data[:data.shape[0], :data.shape[1]] = data
+    tile = encode_tile(tile_data, file_extension)
+    cache.put(key, tile)
+    return tile
+
 
 def get_tile(request, project_id=None, stack_id=None):
 
@@ -31,42 +167,198 @@ def get_tile(request, project_id=None, stack_id=None):
     z = int(request.GET.get('z', '0'))
     col = request.GET.get('col', 'y')
     row = request.GET.get('row', 'x')
-    file_extension = request.GET.get('file_extension', 'png')
+    file_extension = request.GET.get('file_extension', 'png').lower()
     basename = request.GET.get('basename', 'raw')
 
+    if file_extension not in tile_formats:
+        raise ValueError("Unsupported tile format: %s, expected one of: %s" % \
+                (file_extension, ', '.join(sorted(tile_formats.keys()))))
+    content_type = tile_formats[file_extension][0]
+
     # need to know the stack name
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}_{2}.hdf'.format( project_id, stack_id, basename ) )
 
     if not os.path.exists( fpath ):
-        data=np.zeros( (height, width) )
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-        # return HttpResponse(json.dumps({'error': 'HDF5 file does not exists: {0}'.format(fpath)}))
-
-    with closing(h5py.File(fpath, 'r')) as hfile:
-        #import math
-        #zoomlevel = math.log(int(scale), 2)
-        hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
-        if not str(int(scale)) in hfile['/'].keys():
-            data=np.zeros( (height, width) )
-            pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-            response = HttpResponse(content_type="image/png")
-            pilImage.save(response, "PNG")
-            return response            
-            # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
-        image_data=hfile[hdfpath]
-        data=image_data[y:y+height,x:x+width]
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-
-    return response
+        tile = get_blank_tile(width, height, file_extension)
+    else:
+        tile = read_tile(fpath, int(scale), z, x, y, width, height,
+                file_extension)
+
+    return HttpResponse(tile, content_type=content_type)
+
+def get_label_queue_path(fpath):
+    """ Returns the folder in which label patches for the HDF5 file at <fpath>
+    are queued.
+    """
+    return fpath + '.queue'
+
+
+def queue_label_patch(fpath, scale, x, y, z, labels):
+    """ Stores a 2D array of labels for the passed in location in the queue
+    of the HDF5 file at <fpath> and returns a token for it. Patches are
+    written in the order they were queued.
+    """
+    queue_path = get_label_queue_path(fpath)
+    try:
+        os.makedirs(queue_path)
+    except OSError:
+        if not os.path.isdir(queue_path):
+            raise
+    token = uuid.uuid4().hex
+    name = '%.6f_%s' % (time(), token)
+    # Write to a temporary file first so that the writer never reads
+    # partially written patches.
+    tmp_path = os.path.join(queue_path, name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, labels=labels, location=np.array([scale, x, y, z]))
+    os.rename(tmp_path, os.path.join(queue_path, name + '.npz'))
+    return token
+
+
+def create_label_dataset(hfile, hdfpath, shape, dtype=np.uint8):
+    return hfile.create_dataset(hdfpath, shape=shape, dtype=dtype,
+            maxshape=(None, None, None), chunks=label_chunk_shape,
+            compression='gzip', shuffle=True)
+
+
+def get_label_dataset(hfile, scale, shape):
+    """ Returns the label dataset of the passed in scale level, which is
+    enlarged to the passed in shape if needed. New datasets are chunked and
+    compressed. Existing datasets that can't be enlarged, like contiguous
+    ones, are replaced by a chunked copy if they have to grow.
+    """
+    hdfpath = '/labels/scale/' + str(scale) + '/data'
+    if hdfpath not in hfile:
+        return create_label_dataset(hfile, hdfpath, shape)
+    dataset = hfile[hdfpath]
+    new_shape = tuple(max(a, b) for a, b in zip(dataset.shape, shape))
+    if new_shape == dataset.shape:
+        return dataset
+
+    resizable = dataset.chunks is not None and all(m is None or m >= s
+            for m, s in zip(dataset.maxshape, new_shape))
+    if resizable:
+        dataset.resize(new_shape)
+        return dataset
+
+    # Copy the existing labels section by section to keep memory use low
+    tmp_path = hdfpath + '.tmp'
+    if tmp_path in hfile:
+        del hfile[tmp_path]
+    copy = create_label_dataset(hfile, tmp_path, new_shape, dataset.dtype)
+    for z in range(dataset.shape[2]):
+        copy[:dataset.shape[0], :dataset.shape[1], z] = dataset[:, :, z]
+    for name, value in dataset.attrs.items():
+        copy.attrs[name] = value
+    del hfile[hdfpath]
+    hfile.move(tmp_path, hdfpath)
+    return hfile[hdfpath]
+
+
+def write_label_patches(dataset, patches):
+    """ Writes a list of (x, y, z, labels) patches to a dataset. The patches
+    are combined per chunk of the dataset, so that each affected chunk is read
+    and written only once. Overlapping patches are applied in list order.
+    """
+    chunk_height, chunk_width, chunk_depth = dataset.chunks or label_chunk_shape
+    chunk_patches = defaultdict(list)
+    for i, (x, y, z, labels) in enumerate(patches):
+        height, width = labels.shape
+        for cy in range(y // chunk_height, (y + height - 1) // chunk_height + 1):
+            for cx in range(x // chunk_width, (x + width - 1) // chunk_width + 1):
+                chunk_patches[(cy, cx, z // chunk_depth)].append(i)
+
+    for (cy, cx, cz), patch_indices in sorted(chunk_patches.items()):
+        y_min, x_min, z_min = cy * chunk_height, cx * chunk_width, cz * chunk_depth
+        y_max = min(y_min + chunk_height, dataset.shape[0])
+        x_max = min(x_min + chunk_width, dataset.shape[1])
+        z_max = min(z_min + chunk_depth, dataset.shape[2])
+        block = dataset[y_min:y_max, x_min:x_max, z_min:z_max]
+        for i in patch_indices:
+            x, y, z, labels = patches[i]
+            y_start, y_end = max(y, y_min), min(y + labels.shape[0], y_max)
+            x_start, x_end = max(x, x_min), min(x + labels.shape[1], x_max)
+            block[y_start - y_min:y_end - y_min, x_start - x_min:x_end - x_min,
+                    z - z_min] = labels[y_start - y:y_end - y, x_start - x:x_end - x]
+        dataset[y_min:y_max, x_min:x_max, z_min:z_max] = block
+
+
+def remove_old_label_status(queue_path):
+    """ Removes status files of written patches that are older than
+    HDF5_LABEL_STATUS_RETENTION seconds.
+    """
+    min_time = time() - settings.HDF5_LABEL_STATUS_RETENTION
+    for name in os.listdir(queue_path):
+        if name.endswith('.done') or name.endswith('.failed'):
+            status_path = os.path.join(queue_path, name)
+            try:
+                if os.path.getmtime(status_path) < min_time:
+                    os.remove(status_path)
+            except OSError:
+                pass
+
+
+@task()
+def process_label_queue(fpath):
+    """ Writes all queued label patches of the HDF5 file at <fpath>. An
+    exclusive lock on the queue makes sure only one writer at a time accesses
+    the file, patches queued in the meantime are written by the next run. For
+    every written patch a status file named after its token is created.
+    Returns the number of written patches.
+    """
+    queue_path = get_label_queue_path(fpath)
+    with open(os.path.join(queue_path, 'lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            names = sorted(n for n in os.listdir(queue_path) if n.endswith('.npz'))
+            if not names:
+                return 0
+
+            status, error = 'done', ''
+            try:
+                scale_patches = defaultdict(list)
+                for name in names:
+                    with closing(np.load(os.path.join(queue_path, name))) as patch:
+                        scale, x, y, z = (int(v) for v in patch['location'])
+                        scale_patches[scale].append((x, y, z, patch['labels']))
+
+                # A file that is open for reading can't be opened for writing.
+                # Reads of this process wait until the labels are written,
+                # other processes reopen the file once its mtime changed.
+                pool = get_file_pool()
+                with pool.lock:
+                    pool.invalidate(fpath)
+                    with closing(h5py.File(fpath, 'a')) as hfile:
+                        for scale, patches in scale_patches.iteritems():
+                            shape = (max(y + l.shape[0] for x, y, z, l in patches),
+                                     max(x + l.shape[1] for x, y, z, l in patches),
+                                     max(z + 1 for x, y, z, l in patches))
+                            dataset = get_label_dataset(hfile, scale, shape)
+                            write_label_patches(dataset, patches)
+            except Exception as e:
+                # Every queued patch gets a status, also on unexpected errors
+                logger.exception("Could not write labels to %s" % fpath)
+                status, error = 'failed', str(e)
+
+            for name in names:
+                token = name[:-4].split('_', 1)[1]
+                with open(os.path.join(queue_path, token + '.' + status), 'w') as f:
+                    f.write(error)
+                os.remove(os.path.join(queue_path, name))
+
+            remove_old_label_status(queue_path)
+            return len(names)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 
 def put_tile(request, project_id=None, stack_id=None):
-    """ Store labels to HDF5 """
+    """ Store labels to HDF5
+
+    The labels are queued and written asynchronously by a single writer for
+    each file. The returned token can be used to query whether the labels
+    have been written.
+    """
 
     scale = float(request.POST.get('scale', '0'))
     height = int(request.POST.get('height', '0'))
@@ -80,9 +372,37 @@ def put_tile(request, project_id=None, stack_id=None):
 
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}.hdf'.format( project_id, stack_id ) )
 
-    with closing(h5py.File(fpath, 'a')) as hfile:
-        hdfpath = '/labels/scale/' + str(int(scale)) + '/data'
-        image_from_canvas = np.asarray( Image.open( cStringIO.StringIO(base64.decodestring(image)) ) )
-        hfile[hdfpath][y:y+height,x:x+width,z] = image_from_canvas[:,:,0]
+    image_from_canvas = np.asarray( Image.open( cStringIO.StringIO(base64.decodestring(image)) ) )
+    if image_from_canvas.ndim == 3:
+        image_from_canvas = image_from_canvas[:,:,0]
+    labels = np.ascontiguousarray(image_from_canvas[:height,:width], dtype=np.uint8)
+
+    token = queue_label_patch(fpath, int(scale), x, y, z, labels)
+    process_label_queue.delay(fpath)
+
+    return JsonResponse({
+        'token': token,
+        'status': 'queued'
+    })
+
+
+def put_tile_status(request, project_id=None, stack_id=None, token=None):
+    """ Returns whether the labels of a put_tile request, identified by the
+    returned token, are still queued, have been written or failed.
+    """
+    fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}.hdf'.format( project_id, stack_id ) )
+    queue_path = get_label_queue_path(fpath)
+
+    response = {'token': token}
+    if glob.glob(os.path.join(queue_path, '*_%s.npz' % token)):
+        response['status'] = 'queued'
+    elif os.path.exists(os.path.join(queue_path, token + '.done')):
+        response['status'] = 'written'
+    elif os.path.exists(os.path.join(queue_path, token + '.failed')):
+        with open(os.path.join(queue_path, token + '.failed')) as f:
+            response['status'] = 'failed'
+            response['error'] = f.read()
+    else:
+        raise ValueError("Unknown token: %s" % token)
 
-    return HttpResponse("Image pushed to HDF5.", content_type="plain/text")
+    return JsonResponse(response)
@@ -0,0 +1,335 @@
+import hashlib
+import logging
+import os
+import socket
+import tempfile
+import threading
+import urllib2 as urllib
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageRetrievalError(IOError):
+    def __init__(self, path, error):
+        IOError.__init__(self, "Couldn't access %s" % (path))
+        self.path = path
+        self.error = error
+
+
+class TileCache(object):
+    """ A thread safe least recently used (LRU) cache for encoded tile data,
+    keyed by tile path. At most <max_memory> bytes are kept in memory. Entries
+    that are evicted from memory are spilled to files in <disk_path>, which
+    can hold at most <max_disk> bytes before the least recently used files are
+    removed. Disk spilling is disabled if <max_disk> is zero.
+    """
+    def __init__(self, max_memory, max_disk=0, disk_path=None):
+        self.max_memory = max_memory
+        self.max_disk = max_disk if disk_path else 0
+        self.disk_path = disk_path
+        self.lock = threading.Lock()
+        # Maps keys to data, ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.memory_size = 0
+        # Maps keys to the size of their spilled file
+        self.disk_entries = OrderedDict()
+        self.disk_size = 0
+
+    def _disk_file(self, key):
+        return os.path.join(self.disk_path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        """ Returns a tuple of the cached data for <key> and the place it was
+        found, which is either 'memory' or 'disk'. If <key> isn't cached,
+        (None, None) is returned. Data read from disk is moved back to memory.
+        """
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.entries[key] = data
+                return data, 'memory'
+            size = self.disk_entries.pop(key, None)
+            if size is not None:
+                self.disk_size -= size
+
+        if size is None:
+            return None, None
+
+        disk_file = self._disk_file(key)
+        try:
+            with open(disk_file, 'rb') as f:
+                data = f.read()
+            os.remove(disk_file)
+        except (IOError, OSError):
+            # The file might have been removed by a concurrent eviction
+            return None, None
+
+        self.put(key, data)
+        return data, 'disk'
+
+    def put(self, key, data):
+        """ Adds <data> under <key> as most recently used entry. If this
+        exceeds the memory limit, least recently used entries are spilled to
+        disk.
+        """
+        spilled = []
+        with self.lock:
+            old_data = self.entries.pop(key, None)
+            if old_data is not None:
+                self.memory_size -= len(old_data)
+            self.entries[key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.max_memory and self.entries:
+                k, d = self.entries.popitem(last=False)
+                self.memory_size -= len(d)
+                spilled.append((k, d))
+
+        for k, d in spilled:
+            self._spill(k, d)
+
+    def _spill(self, key, data):
+        """ Writes an entry that was evicted from memory to disk, if enabled.
+        """
+        if not self.max_disk or len(data) > self.max_disk:
+            return
+
+        disk_file = self._disk_file(key)
+        try:
+            if not os.path.exists(self.disk_path):
+                os.makedirs(self.disk_path)
+            # Write to a temporary file first so that readers never see
+            # partially written data.
+            tmp_file = "%s.%s.tmp" % (disk_file, threading.current_thread().ident)
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_file, disk_file)
+        except (IOError, OSError) as e:
+            logger.warn("Could not spill tile to disk: %s" % str(e))
+            return
+
+        evicted = []
+        with self.lock:
+            old_size = self.disk_entries.pop(key, None)
+            if old_size is not None:
+                self.disk_size -= old_size
+            self.disk_entries[key] = len(data)
+            self.disk_size += len(data)
+            while self.disk_size > self.max_disk:
+                k, size = self.disk_entries.popitem(last=False)
+                self.disk_size -= size
+                evicted.append(k)
+
+        for k in evicted:
+            try:
+                os.remove(self._disk_file(k))
+            except OSError:
+                pass
+
+    def clear(self):
+        """ Removes all entries from memory and disk.
+        """
+        with self.lock:
+            disk_keys = list(self.disk_entries.keys())
+            self.entries.clear()
+            self.disk_entries.clear()
+            self.memory_size = 0
+            self.disk_size = 0
+        for k in disk_keys:
+            try:
+                os.remove(self._disk_file(k))
+            except OSError:
+                pass
+
+
+class TileFetchMetrics(object):
+    """ Collects statistics about the tiles requested by a single job. Fetch
+    latency refers to tiles that had to be retrieved from their source.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_fetched = 0
+        self.fetch_time = 0.0
+        self.max_fetch_time = 0.0
+
+    def record_hit(self, source):
+        with self.lock:
+            self.requests += 1
+            if 'memory' == source:
+                self.memory_hits += 1
+            else:
+                self.disk_hits += 1
+
+    def record_fetch(self, latency, size):
+        with self.lock:
+            self.requests += 1
+            self.misses += 1
+            self.bytes_fetched += size
+            self.fetch_time += latency
+            self.max_fetch_time = max(self.max_fetch_time, latency)
+
+    @property
+    def hit_rate(self):
+        if 0 == self.requests:
+            return 0.0
+        return float(self.memory_hits + self.disk_hits) / self.requests
+
+    @property
+    def mean_fetch_time(self):
+        if 0 == self.misses:
+            return 0.0
+        return self.fetch_time / self.misses
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'bytes_fetched': self.bytes_fetched,
+            'mean_fetch_time': self.mean_fetch_time,
+            'max_fetch_time': self.max_fetch_time,
+        }
+
+    def __str__(self):
+        return "%s tile requests, %.1f%% cache hits, %s tiles fetched " \
+                "(%s bytes) with a mean latency of %.3fs (max %.3fs)" % \
+                (self.requests, 100.0 * self.hit_rate, self.misses,
+                 self.bytes_fetched, self.mean_fetch_time, self.max_fetch_time)
+
+
+# The cache, the HTTP session and the thread pool are shared by all jobs
+# running in the same process. They are created lazily, so that forked
+# worker processes don't inherit them.
+_shared_lock = threading.Lock()
+_shared_tile_cache = None
+_shared_session = None
+_shared_pool = None
+
+
+def get_tile_cache():
+    """ Returns the tile cache of this process.
+    """
+    global _shared_tile_cache
+    with _shared_lock:
+        if _shared_tile_cache is None:
+            disk_path = settings.CROPPING_TILE_CACHE_PATH
+            if not disk_path:
+                disk_path = os.path.join(tempfile.gettempdir(),
+                        'catmaid-tile-cache-%s' % os.getpid())
+            _shared_tile_cache = TileCache(
+                    settings.CROPPING_TILE_CACHE_MEMORY_SIZE,
+                    settings.CROPPING_TILE_CACHE_DISK_SIZE, disk_path)
+        return _shared_tile_cache
+
+
+def _get_session():
+    """ Returns a HTTP session of this process that keeps connections alive
+    and allows as many parallel connections per host as there are fetching
+    threads.
+    """
+    global _shared_session
+    with _shared_lock:
+        if _shared_session is None:
+            n_threads = settings.CROPPING_TILE_FETCH_THREADS
+            adapter = HTTPAdapter(pool_connections=n_threads,
+                    pool_maxsize=n_threads)
+            _shared_session = requests.Session()
+            _shared_session.mount('http://', adapter)
+            _shared_session.mount('https://', adapter)
+        return _shared_session
+
+
+def _get_pool():
+    global _shared_pool
+    with _shared_lock:
+        if _shared_pool is None:
+            _shared_pool = ThreadPool(settings.CROPPING_TILE_FETCH_THREADS)
+        return _shared_pool
+
+
+class TileFetcher(object):
+    """ Retrieves encoded tile data through the tile cache of this process.
+    Tiles that aren't cached are loaded over keep-alive HTTP connections or,
+    for other URL schemes, through urllib. Multiple tiles can be fetched in
+    parallel by a bounded pool of threads. If <metrics> are passed in, cache
+    hits and fetch latency are recorded.
+    """
+    def __init__(self, cache=None, metrics=None):
+        self.cache = cache if cache is not None else get_tile_cache()
+        self.metrics = metrics
+
+    def fetch(self, path):
+        """ Returns the encoded data of the tile at <path>.
+        """
+        data, source = self.cache.get(path)
+        if data is not None:
+            if self.metrics:
+                self.metrics.record_hit(source)
+            return data
+
+        start = time()
+        data = self._load(path)
+        if self.metrics:
+            self.metrics.record_fetch(time() - start, len(data))
+        self.cache.put(path, data)
+        return data
+
+    def _load(self, path):
+        # A tile server that doesn't respond must not block the shared pool
+        timeout = settings.CROPPING_TILE_FETCH_TIMEOUT
+        if path.startswith('http://') or path.startswith('https://'):
+            try:
+                response = _get_session().get(path, timeout=timeout)
+            except requests.RequestException as e:
+                raise ImageRetrievalError(path, str(e))
+            if response.status_code != requests.codes.ok:
+                raise ImageRetrievalError(path, "Error code: %s" % response.status_code)
+            return response.content
+        else:
+            try:
+                img_file = urllib.urlopen(path, timeout=timeout)
+                return img_file.read()
+            except urllib.HTTPError as e:
+                raise ImageRetrievalError(path, "Error code: %s" % e.code)
+            except urllib.URLError as e:
+                raise ImageRetrievalError(path, e.reason)
+            except socket.timeout as e:
+                raise ImageRetrievalError(path, "Timeout: %s" % e)
+
+    def fetch_many(self, paths):
+        """ Returns a list with the encoded data of all tiles in <paths>, in
+        the same order. Tiles are fetched in parallel.
+        """
+        return self.fetch_many_async(paths).get()
+
+    def fetch_many_async(self, paths, catch_errors=False):
+        """ Starts to fetch all tiles in <paths> in parallel and returns
+        immediately. The get() method of the returned object waits for the
+        result, a list of encoded tile data in the order of <paths>. If a
+        tile couldn't be retrieved, get() raises an ImageRetrievalError. With
+        <catch_errors> set, the error is returned in place of the tile data
+        instead, so that the other tiles remain usable.
+        """
+        fetch = self._fetch_or_error if catch_errors else self.fetch
+        return _get_pool().map_async(fetch, paths)
+
+    def _fetch_or_error(self, path):
+        try:
+            return self.fetch(path)
+        except ImageRetrievalError as e:
+            return e
@@ -1,3 +1,5 @@
+import json
+
 from django.db import connection
 from django.http import HttpResponse
 
@@ -11,6 +13,11 @@ from rest_framework.response import Response
 @requires_user_role([UserRole.Browse])
 def transaction_collection(request, project_id):
     """Get a collection of all available transactions in the passed in project.
+
+    Transactions are returned newest first. To page through them, pass the
+    <next_cursor> value of a response as <cursor> parameter of the next
+    request. This uses an index and is faster than <range_start> for pages
+    far away from the first one.
     ---
     parameters:
       - name: range_start
@@ -23,6 +30,40 @@ def transaction_collection(request, project_id):
         type: integer
         paramType: form
         required: false
+      - name: cursor
+        description: >
+          Only return transactions that are older than the one this cursor was
+          returned for. Can't be combined with range_start.
+        type: string
+        paramType: form
+        required: false
+      - name: user_id
+        description: Only return transactions of this user.
+        type: integer
+        paramType: form
+        required: false
+      - name: label
+        description: Only return transactions with this label.
+        type: string
+        paramType: form
+        required: false
+      - name: start_date
+        description: Only return transactions executed at or after this time.
+        type: string
+        paramType: form
+        required: false
+      - name: end_date
+        description: Only return transactions executed at or before this time.
+        type: string
+        paramType: form
+        required: false
+      - name: count
+        description: >
+          How the total number of matching transactions is determined, one of
+          "exact" (default), "estimate" (based on table statistics) or "none".
+        type: string
+        paramType: form
+        required: false
     models:
       transaction_entity:
         id: transaction_entity
@@ -61,40 +102,122 @@ def transaction_collection(request, project_id):
         required: true
       total_count:
         type: integer
-        description: The total number of elements
+        description: >
+          The total number of matching transactions, null if count is "none"
+        required: true
+      next_cursor:
+        type: string
+        description: >
+          Cursor for the next page, null if there are no more transactions
         required: true
     """
     if request.method == 'GET':
         range_start = request.GET.get('range_start', None)
         range_length = request.GET.get('range_length', None)
-        params = [project_id]
-        constraints = []
+        page_cursor = request.GET.get('cursor', None)
+        count = request.GET.get('count', 'exact')
+        if count not in ('exact', 'estimate', 'none'):
+            raise ValueError("Unknown count mode: {}".format(count))
+        if page_cursor and range_start:
+            raise ValueError("Can't combine cursor and range_start")
 
-        if range_start:
-            constraints.append("OFFSET %s")
-            params.append(range_start)
+        filters = ["project_id = %s"]
+        filter_params = [int(project_id)]
+
+        user_id = request.GET.get('user_id', None)
+        if user_id:
+            filters.append("user_id = %s")
+            filter_params.append(int(user_id))
+
+        label = request.GET.get('label', None)
+        if label:
+            filters.append("label = %s")
+            filter_params.append(label)
+
+        start_date = request.GET.get('start_date', None)
+        if start_date:
+            filters.append("execution_time >= %s::timestamptz")
+            filter_params.append(start_date)
+
+        end_date = request.GET.get('end_date', None)
+        if end_date:
+            filters.append("execution_time <= %s::timestamptz")
+            filter_params.append(end_date)
 
-        if range_length:
-            constraints.append("LIMIT %s")
-            params.append(range_length)
+        constraints = list(filters)
+        params = list(filter_params)
+        if page_cursor:
+            execution_time, transaction_id = _parse_cursor(page_cursor)
+            constraints.append("(execution_time, transaction_id) < "
+                    "(%s::timestamptz, %s)")
+            params.extend((execution_time, transaction_id))
+
+        # Ask for one more transaction than needed to know if there are more
+        page_size = int(range_length) if range_length else None
+        limit = ""
+        if page_size is not None:
+            limit = "LIMIT %s"
+            params.append(page_size + 1)
+        if range_start:
+            limit += " OFFSET %s"
+            params.append(int(range_start))
 
         cursor = connection.cursor()
         cursor.execute("""
-            SELECT row_to_json(cti), COUNT(*) OVER() AS full_count
+            SELECT row_to_json(cti)
             FROM catmaid_transaction_info cti
-            WHERE project_id = %s
-            ORDER BY execution_time DESC {}
-        """.format(" ".join(constraints)), params)
-        result = cursor.fetchall()
-        json_data = [row[0] for row in result]
-        total_count = result[0][1] if len(json_data) > 0 else 0
+            WHERE {}
+            ORDER BY execution_time DESC, transaction_id DESC
+            {}
+        """.format(" AND ".join(constraints), limit), params)
+        json_data = [row[0] for row in cursor.fetchall()]
+
+        next_cursor = None
+        if page_size is not None and len(json_data) > page_size:
+            json_data = json_data[:page_size]
+            if json_data:
+                last = json_data[-1]
+                next_cursor = "{},{}".format(last['execution_time'],
+                        last['transaction_id'])
+
+        total_count = None
+        if 'exact' == count:
+            cursor.execute("""
+                SELECT COUNT(*) FROM catmaid_transaction_info
+                WHERE {}
+            """.format(" AND ".join(filters)), filter_params)
+            total_count = cursor.fetchone()[0]
+        elif 'estimate' == count:
+            # The planner's row estimate avoids scanning all transactions
+            cursor.execute("""
+                EXPLAIN (FORMAT JSON)
+                SELECT 1 FROM catmaid_transaction_info
+                WHERE {}
+            """.format(" AND ".join(filters)), filter_params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, basestring):
+                plan = json.loads(plan)
+            total_count = plan[0]['Plan']['Plan Rows']
 
         return Response({
             "transactions": json_data,
-            "total_count": total_count
+            "total_count": total_count,
+            "next_cursor": next_cursor
         })
 
 
+def _parse_cursor(page_cursor):
+    """Split a transaction page cursor into execution time and transaction ID.
+    """
+    execution_time, sep, transaction_id = page_cursor.rpartition(',')
+    if not sep or not execution_time:
+        raise ValueError("Invalid cursor: {}".format(page_cursor))
+    try:
+        return execution_time, int(transaction_id)
+    except ValueError:
+        raise ValueError("Invalid cursor: {}".format(page_cursor))
+
+
 @api_view(["GET"])
 @requires_user_role([UserRole.Browse])
 def get_location(request, project_id):
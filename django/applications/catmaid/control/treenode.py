@@ -1,7 +1,6 @@
 import itertools
 import json
 import math
-import networkx as nx
 import re
 
 from collections import defaultdict
@@ -16,14 +15,20 @@ from catmaid import state
 from catmaid.models import UserRole, Treenode, ClassInstance, \
         TreenodeConnector, Location
 from catmaid.control.authentication import requires_user_role, \
-        can_edit_class_instance_or_fail, can_edit_or_fail
+        can_edit_class_instance_or_fail, can_edit_or_fail, \
+        can_edit_all_or_fail, can_edit_skeletons_or_fail, user_domain
 from catmaid.control.common import get_relation_to_id_map, \
         get_class_to_id_map, insert_into_log, _create_relation, get_request_list
 from catmaid.control.neuron import _delete_if_empty
-from catmaid.control.node import _fetch_location, _fetch_locations
+from catmaid.control.node import _fetch_location, _fetch_locations, \
+        _update_child_edges
 from catmaid.control.link import create_connector_link
 from catmaid.util import Point3D, is_collinear
 
+# Branches are ordered by the size of their downstream arbor, which is counted
+# only up to this many nodes. Larger branches keep their order.
+branch_size_count_limit = 1000
+
 
 def can_edit_treenode_or_fail(user, project_id, treenode_id):
     """ Tests if a user has permissions to edit the neuron which the skeleton of
@@ -701,6 +706,717 @@ def delete_treenode(request, project_id=None):
     except Exception as e:
         raise Exception(response_on_error + ': ' + str(e))
 
+@api_view(['POST'])
+@requires_user_role(UserRole.Annotate)
+def delete_treenodes(request, project_id=None):
+    """Delete a set of treenodes, optionally including everything downstream
+    of them.
+
+    All nodes are deleted in one transaction. Children of deleted nodes are
+    connected to their closest remaining ancestor, connector links and reviews
+    of deleted nodes are removed. Skeletons without remaining nodes are deleted
+    and so are neurons without remaining skeletons. Deleting a root node fails
+    if it has children that are not deleted as well. For each deleted node the
+    same information as for a single deleted node is returned, which allows to
+    undo the deletion.
+    ---
+    parameters:
+      - name: treenode_ids
+        description: IDs of the treenodes to delete
+        type: array
+        items:
+          type: integer
+        required: true
+        paramType: form
+      - name: include_subtrees
+        description: Whether all nodes downstream of the passed in nodes should be deleted, too
+        type: boolean
+        required: false
+        defaultValue: false
+        paramType: form
+      - name: state
+        description: JSON encoded multi-node state of the passed in treenodes
+        type: string
+        required: true
+        paramType: form
+    type:
+      nodes:
+        description: |
+          For each deleted node its ID, location (x, y, z), parent_id, radius,
+          confidence, skeleton_id, links (lists of link ID, relation ID,
+          connector ID and confidence) and children (lists of child ID and
+          edition time of the reconnected children)
+        type: array
+        required: true
+      deleted_skeletons:
+        description: IDs of skeletons that were deleted, because they had no nodes left
+        type: array
+        items:
+          type: integer
+        required: true
+      deleted_neurons:
+        description: IDs of neurons that were deleted, because they had no skeletons left
+        type: array
+        items:
+          type: integer
+        required: true
+      success:
+        type: string
+        required: true
+    """
+    treenode_ids = get_request_list(request.POST, 'treenode_ids', map_fn=int)
+    if not treenode_ids:
+        raise ValueError("Need at least one treenode ID")
+    include_subtrees = request.POST.get('include_subtrees', 'false') == 'true'
+
+    # Make sure the back-end is in the expected state
+    cursor = connection.cursor()
+    state.validate_state(treenode_ids, request.POST.get('state'),
+            multinode=True, lock=True, cursor=cursor)
+
+    if include_subtrees:
+        # Find and lock all downstream nodes, the passed in nodes are locked
+        # already.
+        cursor.execute("""
+            WITH RECURSIVE downstream (id) AS (
+              SELECT UNNEST(%(treenode_ids)s::bigint[])
+              UNION
+              SELECT t.id
+              FROM treenode t
+              JOIN downstream d ON t.parent_id = d.id
+            )
+            SELECT t.id FROM treenode t
+            JOIN downstream d ON t.id = d.id
+            ORDER BY t.id
+            FOR UPDATE OF t
+        """, {'treenode_ids': treenode_ids})
+        treenode_ids = [r[0] for r in cursor.fetchall()]
+
+    # Permissions are checked once for all nodes and the neurons of their
+    # skeletons.
+    can_edit_all_or_fail(request.user, treenode_ids, 'treenode')
+    cursor.execute("""
+        SELECT DISTINCT skeleton_id FROM treenode
+        WHERE id = ANY(%s::bigint[])
+    """, (treenode_ids,))
+    can_edit_skeletons_or_fail(request.user, [r[0] for r in cursor.fetchall()],
+            cursor)
+
+    deleted = _delete_treenodes(int(project_id), request.user, treenode_ids,
+            cursor)
+
+    return JsonResponse({
+        'nodes': deleted['nodes'],
+        'deleted_skeletons': deleted['deleted_skeletons'],
+        'deleted_neurons': deleted['deleted_neurons'],
+        'success': "Removed %s treenodes successfully." % len(deleted['nodes'])
+    })
+
+
+# Operations of a batch are grouped by their type and applied in this order
+BATCH_OPERATION_TYPES = ('create', 'move', 'radius', 'unlink', 'link', 'delete')
+
+
+@api_view(['POST'])
+@requires_user_role(UserRole.Annotate)
+def apply_batch(request, project_id=None):
+    """Apply a list of tracing operations in a single transaction.
+
+    This is meant for scripts and imports that would otherwise need one request
+    per node. Nodes created in a batch are referenced by temporary IDs
+    (strings), which can be used by all other operations of the same batch.
+    Existing nodes and connectors are referenced by their (integer) ID.
+    Permissions are checked once for all affected skeletons and each type of
+    operation is written with a single statement. Operations are applied in
+    the order create, move, radius, unlink, link and delete and either all of
+    them succeed or none. Every operation is an object with a "type" field and
+    these fields:
+
+    - create: id (temporary ID), x, y, z, radius (default 0), confidence
+      (default 5), parent_id (optional, the parent can be created earlier in
+      the same batch), child_ids (optional, children of an existing parent
+      that become children of the new node), neuron_id and neuron_name
+      (optional, only used for nodes without parent)
+    - move: id, x, y, z
+    - radius: id, radius
+    - link: treenode_id, connector_id, relation (e.g. "presynaptic_to"),
+      confidence (default 5)
+    - unlink: treenode_id, connector_id
+    - delete: id, children of deleted nodes are connected to their closest
+      remaining ancestor
+
+    Changing the link of a node to a connector is an unlink and a link
+    operation in the same batch.
+    ---
+    parameters:
+      - name: operations
+        description: JSON encoded list of operations
+        type: string
+        required: true
+        paramType: form
+      - name: state
+        description: |
+          JSON encoded multi-node state of all existing nodes and connectors
+          referenced by the operations. It is required unless the batch only
+          creates nodes of new skeletons.
+        type: string
+        required: false
+        paramType: form
+    type:
+      id_map:
+        description: Maps temporary IDs to the IDs of the created nodes
+        type: object
+        required: true
+      created_skeletons:
+        description: Skeleton ID and neuron ID of all new skeletons
+        type: array
+        items:
+          type: array
+          items:
+            type: integer
+        required: true
+      edition_times:
+        description: Maps IDs of created and updated nodes to their edition time
+        type: object
+        required: true
+      created_links:
+        description: Link ID, treenode ID, connector ID and edition time of new links
+        type: array
+        required: true
+      deleted_links:
+        description: Link ID, treenode ID, connector ID, relation ID and confidence of removed links
+        type: array
+        required: true
+      deleted_nodes:
+        description: IDs of all deleted nodes
+        type: array
+        items:
+          type: integer
+        required: true
+      deleted_skeletons:
+        description: IDs of skeletons that were deleted, because they had no nodes left
+        type: array
+        items:
+          type: integer
+        required: true
+      deleted_neurons:
+        description: IDs of neurons that were deleted, because they had no skeletons left
+        type: array
+        items:
+          type: integer
+        required: true
+    """
+    operations = json.loads(request.POST.get('operations', '[]'))
+    if not operations or type(operations) != list:
+        raise ValueError("Need a list of operations")
+
+    cursor = connection.cursor()
+    result = _apply_batch(int(project_id), request.user, operations,
+            request.POST.get('state'), cursor)
+
+    return JsonResponse(result)
+
+
+def _apply_batch(project_id, user, operations, node_state, cursor):
+    """Validate and apply a list of batch operations, see apply_batch() for
+    their format."""
+    ops = defaultdict(list)
+    for op in operations:
+        if type(op) != dict or op.get('type') not in BATCH_OPERATION_TYPES:
+            raise ValueError("Unknown operation: {}".format(op))
+        ops[op['type']].append(op)
+
+    # IDs of new nodes are allocated first, which allows to resolve all
+    # temporary IDs before anything is written.
+    temp_ids = [op.get('id') for op in ops['create']]
+    if not all(isinstance(t, basestring) for t in temp_ids):
+        raise ValueError("Temporary node IDs have to be strings")
+    if len(set(temp_ids)) != len(temp_ids):
+        raise ValueError("Temporary node IDs have to be unique")
+    id_map = dict(zip(temp_ids,
+            _allocate_ids('location_id_seq', len(temp_ids), cursor)))
+
+    existing_ids = set()
+    def resolve(node_id):
+        if node_id is None:
+            raise ValueError("Operation without node ID")
+        if isinstance(node_id, basestring):
+            if node_id not in id_map:
+                raise ValueError("Unknown temporary node ID: {}".format(node_id))
+            return id_map[node_id]
+        node_id = int(node_id)
+        existing_ids.add(node_id)
+        return node_id
+
+    # Resolve parents and children of new nodes. Temporary parents have to be
+    # created before their children.
+    created = set()
+    new_nodes = []
+    takeovers = {}
+    for op in ops['create']:
+        parent_ref = op.get('parent_id')
+        if isinstance(parent_ref, basestring) and parent_ref not in created:
+            raise ValueError("Node {} has to be created before its child {}".format(
+                    parent_ref, op['id']))
+        parent_id = None if parent_ref is None else resolve(parent_ref)
+        node_id = id_map[op['id']]
+        created.add(op['id'])
+        for child_ref in op.get('child_ids') or []:
+            if parent_id is None or parent_ref in id_map:
+                raise ValueError("Only children of existing nodes can be "
+                        "taken over by node {}".format(op['id']))
+            child_id = resolve(child_ref)
+            if child_id in takeovers:
+                raise ValueError("Node {} can only be taken over once".format(child_id))
+            takeovers[child_id] = (node_id, parent_id)
+        new_nodes.append((node_id, parent_id, float(op['x']), float(op['y']),
+                float(op['z']), float(op.get('radius', 0)),
+                int(op.get('confidence', 5)), op))
+
+    moves = [(resolve(op.get('id')), float(op['x']), float(op['y']),
+            float(op['z'])) for op in ops['move']]
+    radii = [(resolve(op.get('id')), float(op['radius'])) for op in ops['radius']]
+    unlinks = [(resolve(op.get('treenode_id')), int(op['connector_id']))
+            for op in ops['unlink']]
+    links = [(resolve(op.get('treenode_id')), int(op['connector_id']),
+            op['relation'], int(op.get('confidence', 5))) for op in ops['link']]
+    deletes = set(resolve(op.get('id')) for op in ops['delete'])
+
+    invalid_radii = [r for n, r in radii if math.isnan(r)]
+    if invalid_radii:
+        raise ValueError("Some radii where not numbers: " +
+                ", ".join(str(r) for r in invalid_radii))
+
+    # Make sure the back-end is in the expected state and lock all existing
+    # nodes that are referenced.
+    connector_ids = set(l[1] for l in links) | set(l[1] for l in unlinks)
+    if existing_ids or connector_ids:
+        if not node_state:
+            raise ValueError("A state is needed for batches that reference "
+                    "existing nodes or connectors")
+        state.validate_state(list(existing_ids | connector_ids), node_state,
+                multinode=True, lock=True, cursor=cursor)
+
+    existing = {}
+    if existing_ids:
+        cursor.execute("""
+            SELECT id, parent_id, skeleton_id, user_id FROM treenode
+            WHERE project_id = %s AND id = ANY(%s::bigint[])
+        """, (project_id, list(existing_ids)))
+        existing = {r[0]: r for r in cursor.fetchall()}
+        missing = existing_ids - set(existing.keys())
+        if missing:
+            raise ValueError("Couldn't find treenodes " +
+                    ", ".join(str(n) for n in missing))
+
+    if connector_ids:
+        cursor.execute("""
+            SELECT id FROM connector
+            WHERE project_id = %s AND id = ANY(%s::bigint[])
+        """, (project_id, list(connector_ids)))
+        missing = connector_ids - set(r[0] for r in cursor.fetchall())
+        if missing:
+            raise ValueError("Couldn't find connectors " +
+                    ", ".join(str(n) for n in missing))
+
+    for child_id, (node_id, parent_id) in takeovers.iteritems():
+        if existing[child_id][1] != parent_id:
+            raise ValueError("Node {} is no child of node {}".format(
+                    child_id, parent_id))
+
+    # Permissions are checked once for the neurons of all affected skeletons.
+    # Moving and deleting nodes additionally requires permission to edit the
+    # work of their owners.
+    can_edit_skeletons_or_fail(user, set(r[2] for r in existing.itervalues()),
+            cursor)
+    neuron_ids = set(int(n[7]['neuron_id']) for n in new_nodes
+            if n[1] is None and n[7].get('neuron_id') not in (None, -1))
+    for neuron_id in neuron_ids:
+        can_edit_class_instance_or_fail(user, neuron_id, 'neuron')
+    if not user.is_superuser:
+        owner_ids = set(existing[n][3] for n in
+                set(m[0] for m in moves) | deletes if n in existing)
+        if not owner_ids.issubset(user_domain(cursor, user.id)):
+            raise Exception('User %s cannot edit all moved and deleted nodes' %
+                    user.username)
+
+    edition_times = {}
+
+    # New skeletons (and neurons) are created for all new root nodes, other
+    # nodes inherit the skeleton of their parent.
+    roots = [n for n in new_nodes if n[1] is None]
+    created_skeletons = _create_skeletons(project_id, user,
+            [(n[7].get('neuron_id') if n[7].get('neuron_id') != -1 else None,
+              n[7].get('neuron_name')) for n in roots], cursor)
+    skeleton_of = {r[0]: s[0] for r, s in zip(roots, created_skeletons)}
+    new_rows = []
+    for node_id, parent_id, x, y, z, radius, confidence, op in new_nodes:
+        if parent_id is not None:
+            skeleton_of[node_id] = skeleton_of[parent_id] \
+                    if parent_id in skeleton_of else existing[parent_id][2]
+        new_rows.append((node_id, parent_id, skeleton_of[node_id], x, y, z,
+                radius, confidence))
+    edition_times.update(_create_treenodes(project_id, user, new_rows, cursor))
+
+    if takeovers:
+        cursor.execute("""
+            UPDATE treenode t SET parent_id = c.parent_id, editor_id = %s
+            FROM UNNEST(%s::bigint[], %s::bigint[]) c(id, parent_id)
+            WHERE t.id = c.id
+            RETURNING t.id, t.edition_time
+        """, (user.id, takeovers.keys(), [v[0] for v in takeovers.values()]))
+        edition_times.update(cursor.fetchall())
+
+    if moves:
+        ids, xs, ys, zs = zip(*moves)
+        cursor.execute("""
+            UPDATE treenode t
+            SET location_x = m.x, location_y = m.y, location_z = m.z,
+                editor_id = %s
+            FROM UNNEST(%s::bigint[], %s::real[], %s::real[], %s::real[])
+                m(id, x, y, z)
+            WHERE t.id = m.id
+            RETURNING t.id, t.edition_time
+        """, (user.id, list(ids), list(xs), list(ys), list(zs)))
+        edition_times.update(cursor.fetchall())
+        # The update trigger only rebuilds the edge of a moved node itself,
+        # edges of its children are updated for all moved nodes at once.
+        _update_child_edges(ids, cursor)
+
+    if radii:
+        ids, values = zip(*radii)
+        cursor.execute("""
+            UPDATE treenode t SET radius = r.radius, editor_id = %s
+            FROM UNNEST(%s::bigint[], %s::real[]) r(id, radius)
+            WHERE t.id = r.id
+            RETURNING t.id, t.edition_time
+        """, (user.id, list(ids), list(values)))
+        edition_times.update(cursor.fetchall())
+
+    deleted_links = []
+    if unlinks:
+        treenode_ids, link_connector_ids = zip(*unlinks)
+        cursor.execute("""
+            SELECT tc.id, tc.treenode_id, tc.connector_id, tc.relation_id,
+                   tc.confidence, tc.user_id
+            FROM treenode_connector tc
+            JOIN UNNEST(%s::bigint[], %s::bigint[]) u(treenode_id, connector_id)
+              ON tc.treenode_id = u.treenode_id
+             AND tc.connector_id = u.connector_id
+        """, (list(treenode_ids), list(link_connector_ids)))
+        deleted_links = cursor.fetchall()
+        missing = set(unlinks) - set((l[1], l[2]) for l in deleted_links)
+        if missing:
+            raise ValueError("Couldn't find links between nodes and connectors: " +
+                    ", ".join("{}-{}".format(*m) for m in missing))
+        if not user.is_superuser and not set(l[5] for l in deleted_links) \
+                .issubset(user_domain(cursor, user.id)):
+            raise Exception('User %s cannot edit all removed links' %
+                    user.username)
+        cursor.execute("""
+            DELETE FROM treenode_connector WHERE id = ANY(%s::bigint[])
+        """, ([l[0] for l in deleted_links],))
+
+    created_links = []
+    if links:
+        relation_map = get_relation_to_id_map(project_id,
+                list(set(l[2] for l in links)), cursor)
+        unknown = set(l[2] for l in links) - set(relation_map.keys())
+        if unknown:
+            raise ValueError("Unknown relations: " + ", ".join(unknown))
+        treenode_ids, link_connector_ids, relations, confidences = zip(*links)
+        cursor.execute("""
+            INSERT INTO treenode_connector (user_id, project_id, relation_id,
+                    treenode_id, connector_id, skeleton_id, confidence)
+            SELECT %s, %s, l.relation_id, l.treenode_id, l.connector_id,
+                   t.skeleton_id, l.confidence
+            FROM UNNEST(%s::bigint[], %s::bigint[], %s::integer[],
+                        %s::smallint[]) l(treenode_id, connector_id,
+                        relation_id, confidence)
+            JOIN treenode t ON t.id = l.treenode_id
+            RETURNING id, treenode_id, connector_id, edition_time
+        """, (user.id, project_id, list(treenode_ids), list(link_connector_ids),
+              [relation_map[r] for r in relations], list(confidences)))
+        created_links = cursor.fetchall()
+        _check_connector_links(link_connector_ids, cursor)
+
+    deleted = _delete_treenodes(project_id, user, deletes, cursor)
+    edition_times.update((c[0], c[3]) for c in deleted['children'])
+    deleted_ids = [n['id'] for n in deleted['nodes']]
+    for node_id in deleted_ids:
+        edition_times.pop(node_id, None)
+
+    return {
+        'id_map': id_map,
+        'created_skeletons': created_skeletons,
+        'edition_times': edition_times,
+        'created_links': created_links,
+        'deleted_links': [l[:5] for l in deleted_links],
+        'deleted_nodes': deleted_ids,
+        'deleted_skeletons': deleted['deleted_skeletons'],
+        'deleted_neurons': deleted['deleted_neurons']
+    }
+
+
+def _allocate_ids(sequence, n, cursor):
+    """Get <n> new values of the passed in sequence."""
+    if not n:
+        return []
+    cursor.execute("""
+        SELECT nextval(%s::regclass) FROM generate_series(1, %s)
+    """, (sequence, n))
+    return [r[0] for r in cursor.fetchall()]
+
+
+def _create_skeletons(project_id, user, neurons, cursor):
+    """Create a new skeleton for each (neuron ID, neuron name) tuple in
+    <neurons>. For entries without neuron ID a new neuron is created as well,
+    which is named after the passed in name or its ID. Returns a list of
+    (skeleton ID, neuron ID) tuples in the order of <neurons>.
+    """
+    if not neurons:
+        return []
+    relation_map = get_relation_to_id_map(project_id, ('model_of',), cursor)
+    class_map = get_class_to_id_map(project_id, ('skeleton', 'neuron'), cursor)
+
+    neuron_ids = set(n[0] for n in neurons if n[0] is not None)
+    if neuron_ids:
+        cursor.execute("""
+            SELECT id FROM class_instance
+            WHERE project_id = %s AND class_id = %s
+              AND id = ANY(%s::integer[])
+        """, (project_id, class_map['neuron'], list(neuron_ids)))
+        missing = neuron_ids - set(r[0] for r in cursor.fetchall())
+        if missing:
+            raise ValueError("Couldn't find neurons " +
+                    ", ".join(str(n) for n in missing))
+
+    n_new_neurons = sum(1 for n in neurons if n[0] is None)
+    ids = _allocate_ids('concept_id_seq', len(neurons) + n_new_neurons, cursor)
+    new_neuron_ids = iter(ids[len(neurons):])
+    instances = []
+    models = []
+    for skeleton_id, (neuron_id, neuron_name) in zip(ids, neurons):
+        instances.append((skeleton_id, class_map['skeleton'],
+                'skeleton %d' % skeleton_id))
+        if neuron_id is None:
+            neuron_id = next(new_neuron_ids)
+            instances.append((neuron_id, class_map['neuron'],
+                    neuron_name or 'neuron %d' % neuron_id))
+        models.append((skeleton_id, int(neuron_id)))
+
+    instance_ids, class_ids, names = zip(*instances)
+    skeleton_ids, model_neuron_ids = zip(*models)
+    cursor.execute("""
+        INSERT INTO class_instance (id, user_id, project_id, class_id, name)
+        SELECT ci.id, %(user_id)s, %(project_id)s, ci.class_id, ci.name
+        FROM UNNEST(%(instance_ids)s::integer[], %(class_ids)s::integer[],
+                    %(names)s::text[]) ci(id, class_id, name);
+
+        INSERT INTO class_instance_class_instance (user_id, project_id,
+                relation_id, class_instance_a, class_instance_b)
+        SELECT %(user_id)s, %(project_id)s, %(model_of)s, m.skeleton_id,
+               m.neuron_id
+        FROM UNNEST(%(skeleton_ids)s::integer[], %(neuron_ids)s::integer[])
+            m(skeleton_id, neuron_id);
+    """, {
+        'user_id': user.id,
+        'project_id': project_id,
+        'model_of': relation_map['model_of'],
+        'instance_ids': list(instance_ids),
+        'class_ids': list(class_ids),
+        'names': list(names),
+        'skeleton_ids': list(skeleton_ids),
+        'neuron_ids': list(model_neuron_ids)
+    })
+
+    return models
+
+
+def _create_treenodes(project_id, user, nodes, cursor):
+    """Insert treenodes with a single statement. <nodes> is a list of (ID,
+    parent ID, skeleton ID, x, y, z, radius, confidence) tuples with IDs taken
+    from location_id_seq. Parents have to exist or be part of the same list,
+    the parent foreign key is checked only at the end of the transaction. The
+    insert trigger creates the treenode_edge entry of each node. Returns a
+    dictionary that maps the new IDs to their edition time.
+    """
+    if not nodes:
+        return {}
+    ids, parent_ids, skeleton_ids, xs, ys, zs, radii, confidences = \
+            (list(c) for c in zip(*nodes))
+    cursor.execute("""
+        INSERT INTO treenode (id, project_id, user_id, editor_id, parent_id,
+                skeleton_id, location_x, location_y, location_z, radius,
+                confidence)
+        SELECT n.id, %(project_id)s, %(user_id)s, %(user_id)s, n.parent_id,
+               n.skeleton_id, n.x, n.y, n.z, n.radius, n.confidence
+        FROM UNNEST(%(ids)s::bigint[], %(parent_ids)s::bigint[],
+                    %(skeleton_ids)s::integer[], %(xs)s::real[],
+                    %(ys)s::real[], %(zs)s::real[], %(radii)s::real[],
+                    %(confidences)s::smallint[])
+            n(id, parent_id, skeleton_id, x, y, z, radius, confidence)
+        RETURNING id, edition_time
+    """, {
+        'project_id': project_id,
+        'user_id': user.id,
+        'ids': ids,
+        'parent_ids': parent_ids,
+        'skeleton_ids': skeleton_ids,
+        'xs': xs,
+        'ys': ys,
+        'zs': zs,
+        'radii': radii,
+        'confidences': confidences
+    })
+    return dict(cursor.fetchall())
+
+
+def _check_connector_links(connector_ids, cursor):
+    """Make sure the links of all passed in connectors follow the same rules
+    that are enforced by create_link(): a single presynaptic link, at most two
+    gap junction links, no gap junction together with synaptic links and no
+    duplicate links. Raises a ValueError otherwise."""
+    cursor.execute("""
+        SELECT tc.connector_id, r.relation_name, count(*),
+               count(DISTINCT tc.treenode_id)
+        FROM treenode_connector tc
+        JOIN relation r ON r.id = tc.relation_id
+        WHERE tc.connector_id = ANY(%s::bigint[])
+        GROUP BY tc.connector_id, r.relation_name
+    """, (list(set(connector_ids)),))
+    counts = defaultdict(dict)
+    for connector_id, relation_name, n_links, n_nodes in cursor.fetchall():
+        if n_links != n_nodes:
+            raise ValueError("A relation '%s' between connector %s and a node "
+                    "exists more than once" % (relation_name, connector_id))
+        counts[connector_id][relation_name] = n_links
+    for connector_id, c in counts.iteritems():
+        n_synaptic = c.get('presynaptic_to', 0) + c.get('postsynaptic_to', 0)
+        if c.get('presynaptic_to', 0) > 1:
+            raise ValueError('Connector %s can only have one presynaptic '
+                    'connection.' % connector_id)
+        if c.get('gapjunction_with', 0) > 2:
+            raise ValueError('Connector %s can only have two gap junction '
+                    'connections.' % connector_id)
+        if c.get('gapjunction_with', 0) and n_synaptic:
+            raise ValueError('Connector %s cannot have both a gap junction '
+                    'and synaptic connections.' % connector_id)
+
+
+def _delete_treenodes(project_id, user, treenode_ids, cursor):
+    """Delete all passed in treenodes with a few set based statements. Children
+    of deleted nodes are connected to their closest remaining ancestor.
+    Connector links and reviews of deleted nodes are removed, skeletons without
+    nodes are deleted, as well as neurons that don't model any other skeleton.
+    Deleting a root node fails if it has remaining children. Permissions have
+    to be checked by the caller. Returned is the information needed to undo
+    the deletion: location, parent, radius, confidence, skeleton, connector
+    links and reconnected children of each deleted node.
+    """
+    result = {
+        'nodes': [],
+        'children': [],
+        'deleted_skeletons': [],
+        'deleted_neurons': []
+    }
+    if not treenode_ids:
+        return result
+
+    cursor.execute("""
+        SELECT id, location_x, location_y, location_z, parent_id, radius,
+               confidence, skeleton_id
+        FROM treenode
+        WHERE project_id = %s AND id = ANY(%s::bigint[])
+    """, (project_id, list(treenode_ids)))
+    nodes = {r[0]: {
+        'id': r[0],
+        'x': r[1],
+        'y': r[2],
+        'z': r[3],
+        'parent_id': r[4],
+        'radius': r[5],
+        'confidence': r[6],
+        'skeleton_id': r[7],
+        'children': [],
+        'links': []
+    } for r in cursor.fetchall()}
+    missing = set(treenode_ids) - set(nodes.keys())
+    if missing:
+        raise ValueError("Couldn't find treenodes " +
+                ", ".join(str(n) for n in missing))
+
+    # Find the closest remaining ancestor of every deleted node, None if there
+    # is none. Each node is visited once, also for long deleted paths.
+    ancestors = {}
+    for node_id in nodes:
+        path = []
+        ancestor = node_id
+        while ancestor in nodes and ancestor not in ancestors:
+            path.append(ancestor)
+            ancestor = nodes[ancestor]['parent_id']
+        ancestor = ancestors.get(ancestor, ancestor)
+        for n in path:
+            ancestors[n] = ancestor
+
+    deleted_ids = list(nodes.keys())
+    cursor.execute("""
+        UPDATE treenode t SET parent_id = a.ancestor_id, editor_id = %s
+        FROM UNNEST(%s::bigint[], %s::bigint[]) a(id, ancestor_id)
+        WHERE t.parent_id = a.id
+          AND t.id <> ALL(%s::bigint[])
+        RETURNING t.id, a.id, t.parent_id, t.edition_time
+    """, (user.id, deleted_ids, [ancestors[n] for n in deleted_ids],
+          deleted_ids))
+    children = cursor.fetchall()
+    orphans = [c[0] for c in children if c[2] is None]
+    if orphans:
+        raise ValueError("Can't delete root nodes that have remaining "
+                "children: " + ", ".join(str(o) for o in orphans))
+    for child_id, old_parent_id, parent_id, edition_time in children:
+        nodes[old_parent_id]['children'].append([child_id, edition_time])
+
+    cursor.execute("""
+        DELETE FROM treenode_connector
+        WHERE treenode_id = ANY(%s::bigint[])
+        RETURNING treenode_id, id, relation_id, connector_id, confidence
+    """, (deleted_ids,))
+    for link in cursor.fetchall():
+        nodes[link[0]]['links'].append(link[1:])
+
+    cursor.execute("""
+        DELETE FROM review WHERE treenode_id = ANY(%(ids)s::bigint[]);
+        DELETE FROM treenode WHERE id = ANY(%(ids)s::bigint[]);
+
+        SELECT s.id, cici.class_instance_b
+        FROM UNNEST(%(skeleton_ids)s::integer[]) s(id)
+        JOIN class_instance_class_instance cici
+          ON cici.class_instance_a = s.id
+        JOIN relation r
+          ON r.id = cici.relation_id AND r.relation_name = 'model_of'
+        WHERE NOT EXISTS (SELECT 1 FROM treenode t WHERE t.skeleton_id = s.id)
+    """, {
+        'ids': deleted_ids,
+        'skeleton_ids': list(set(n['skeleton_id'] for n in nodes.itervalues()))
+    })
+    empty_skeletons = cursor.fetchall()
+
+    if empty_skeletons:
+        # Deleting the skeletons also deletes their relations to neurons
+        deleted_skeleton_ids = list(set(s[0] for s in empty_skeletons))
+        ClassInstance.objects.filter(pk__in=deleted_skeleton_ids).delete()
+        deleted_neuron_ids = [n for n in set(s[1] for s in empty_skeletons)
+                if _delete_if_empty(n)]
+        for neuron_id in deleted_neuron_ids:
+            insert_into_log(project_id, user.id, 'remove_neuron', None,
+                    'Deleted neuron %s and its skeleton(s).' % neuron_id)
+        result['deleted_skeletons'] = deleted_skeleton_ids
+        result['deleted_neurons'] = deleted_neuron_ids
+
+    result['nodes'] = nodes.values()
+    result['children'] = children
+    return result
+
 
 def _treenode_info(project_id, treenode_id):
     c = connection.cursor()
@@ -908,61 +1624,122 @@ def update_confidence(request, project_id=None, treenode_id=None):
     else:
         raise ValueError('Failed to update confidence at treenode %s.' % tnid)
 
-def _skeleton_as_graph(skeleton_id):
-    # Fetch all nodes of the skeleton
-    cursor = connection.cursor()
+def _find_previous_branchnode_or_root(treenode_id, stop_at_interesting, cursor):
+    """ Walk upstream from the passed in treenode until finding a node with
+    more than one child or the root node and return its ID. If
+    <stop_at_interesting> is true, the walk also stops at the first node
+    that has a confidence lower than 5, a tag or a connector. The passed in
+    node is returned if it is the root. Only the nodes on the way are read.
+    """
     cursor.execute('''
-        SELECT id, parent_id
-        FROM treenode
-        WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
-
-
-def _find_first_interesting_node(sequence):
-    """ Find the first node that:
-    1. Has confidence lower than 5
-    2. Has a tag
-    3. Has any connector (e.g. receives/makes synapse, markes as abutting, ...)
-    Otherwise return the last node.
+        WITH RECURSIVE upstream (id, parent_id, step, stop) AS (
+          SELECT t.id, t.parent_id, 0, FALSE
+          FROM treenode t
+          WHERE t.id = %(treenode_id)s
+          UNION ALL
+          SELECT p.id, p.parent_id, u.step + 1,
+                 (SELECT count(*) FROM (
+                    SELECT 1 FROM treenode c WHERE c.parent_id = p.id LIMIT 2
+                  ) c) <> 1 OR
+                 (%(stop_at_interesting)s AND (p.confidence < 5 OR
+                  EXISTS (SELECT 1 FROM treenode_connector tc
+                          WHERE tc.treenode_id = p.id) OR
+                  EXISTS (SELECT 1 FROM treenode_class_instance tci
+                          WHERE tci.treenode_id = p.id)))
+          FROM upstream u
+          JOIN treenode p ON p.id = u.parent_id
+          WHERE NOT u.stop
+        )
+        SELECT id FROM upstream ORDER BY step DESC LIMIT 1
+    ''', {
+        'treenode_id': treenode_id,
+        'stop_at_interesting': stop_at_interesting
+    })
+    row = cursor.fetchone()
+    if not row:
+        raise ValueError('Could not find treenode %s' % treenode_id)
+    return row[0]
+
+
+def _find_next_branchnodes_or_ends(treenode_id, cursor):
+    """ Walk downstream from each child of the passed in treenode until
+    finding a node with more than one child or an end node. For each child, a
+    list with the child's ID, the ID of the first node on the way that has a
+    confidence lower than 5, a tag or a connector (or the last node if there
+    is none) and the ID of the last node is returned. Only the nodes on the
+    way are read. Branches are sorted by the size of the downstream arbor,
+    largest first. Arbors are counted up to branch_size_count_limit nodes.
     """
-    if not sequence:
-        raise Exception('No nodes ahead!')
-
-    if 1 == len(sequence):
-        return sequence[0]
-
-    cursor = connection.cursor()
     cursor.execute('''
-    SELECT t.id, t.confidence, tc.relation_id, tci.relation_id
-    FROM treenode t
-         LEFT OUTER JOIN treenode_connector tc ON (tc.treenode_id = t.id)
-         LEFT OUTER JOIN treenode_class_instance tci ON (tci.treenode_id = t.id)
-    WHERE t.id IN (%s)
-    ''' % ",".join(map(str, sequence)))
-
-    nodes = {row[0]: row for row in cursor.fetchall()}
-    for node_id in sequence:
-        if node_id in nodes:
-            props = nodes[node_id]
-            # [1]: confidence
-            # [2]: a treenode_connector.relation_id, e.g. presynaptic_to or postsynaptic_to
-            # [3]: a treenode_class_instance.relation_id, e.g. labeled_as
-            # 2 and 3 may be None
-            if props[1] < 5 or props[2] or props[3]:
-                return node_id
-        else:
-            raise Exception('Nodes of this skeleton changed while inspecting them.')
-
-    return sequence[-1]
+        WITH RECURSIVE downstream (branch_id, id, step, n_children,
+                                   interesting) AS (
+          SELECT c.id, c.id, 0,
+                 (SELECT count(*) FROM (
+                    SELECT 1 FROM treenode cc WHERE cc.parent_id = c.id LIMIT 2
+                  ) cc),
+                 c.confidence < 5 OR
+                 EXISTS (SELECT 1 FROM treenode_connector tc
+                         WHERE tc.treenode_id = c.id) OR
+                 EXISTS (SELECT 1 FROM treenode_class_instance tci
+                         WHERE tci.treenode_id = c.id)
+          FROM treenode c
+          WHERE c.parent_id = %(treenode_id)s
+          UNION ALL
+          SELECT d.branch_id, c.id, d.step + 1,
+                 (SELECT count(*) FROM (
+                    SELECT 1 FROM treenode cc WHERE cc.parent_id = c.id LIMIT 2
+                  ) cc),
+                 c.confidence < 5 OR
+                 EXISTS (SELECT 1 FROM treenode_connector tc
+                         WHERE tc.treenode_id = c.id) OR
+                 EXISTS (SELECT 1 FROM treenode_class_instance tci
+                         WHERE tci.treenode_id = c.id)
+          FROM downstream d
+          JOIN treenode c ON c.parent_id = d.id
+          WHERE d.n_children = 1
+        )
+        SELECT branch_id, id, interesting
+        FROM downstream
+        ORDER BY branch_id, step
+    ''', {'treenode_id': treenode_id})
+
+    branches = {}
+    for branch_id, node_id, interesting in cursor.fetchall():
+        branch = branches.get(branch_id)
+        if branch is None:
+            branch = branches[branch_id] = [branch_id, None, None]
+        if interesting and branch[1] is None:
+            branch[1] = node_id
+        branch[2] = node_id
+    for branch in branches.itervalues():
+        if branch[1] is None:
+            branch[1] = branch[2]
+
+    # If more than one branch exists, sort based on downstream arbor size.
+    # The recursion of each branch stops after the count limit is reached,
+    # which bounds the work near the root of large skeletons.
+    if len(branches) > 1:
+        cursor.execute('''
+            SELECT b.id, (
+              SELECT count(*) FROM (
+                WITH RECURSIVE subtree (id) AS (
+                  SELECT b.id
+                  UNION ALL
+                  SELECT t.id
+                  FROM subtree s
+                  JOIN treenode t ON t.parent_id = s.id
+                )
+                SELECT 1 FROM subtree LIMIT %(limit)s
+              ) s)
+            FROM unnest(%(branch_ids)s::bigint[]) b(id)
+        ''', {
+            'branch_ids': sorted(branches.keys()),
+            'limit': branch_size_count_limit
+        })
+        sizes = dict(cursor.fetchall())
+        return sorted((branches[b] for b in sorted(branches.keys())),
+                key=lambda b: sizes[b[0]], reverse=True)
+    return branches.values()
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -970,23 +1747,10 @@ def find_previous_branchnode_or_root(request, project_id=None, treenode_id=None)
     try:
         tnid = int(treenode_id)
         alt = 1 == int(request.POST['alt'])
-        skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
         # Travel upstream until finding a parent node with more than one child
-        # or reaching the root node
-        seq = [] # Does not include the starting node tnid
-        while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
-                seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
-                    break # Found a branch node
-            else:
-                break # Found the root node
-
-        if seq and alt:
-            tnid = _find_first_interesting_node(seq)
+        # or reaching the root node. In alt mode, stop at the first node of
+        # interest on the way.
+        tnid = _find_previous_branchnode_or_root(tnid, alt, connection.cursor())
 
         return HttpResponse(json.dumps(_fetch_location(tnid)))
     except Exception as e:
@@ -997,39 +1761,16 @@ def find_previous_branchnode_or_root(request, project_id=None, treenode_id=None)
 def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
     try:
         tnid = int(treenode_id)
-        skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
-
-        children = graph.successors(tnid)
-        branches = []
-        for child_node_id in children:
-            # Travel downstream until finding a child node with more than one
-            # child or reaching an end node
-            seq = [child_node_id] # Does not include the starting node tnid
-            branch_end = child_node_id
-            while True:
-                branchChildren = graph.successors(branch_end)
-                if 1 == len(branchChildren):
-                    branch_end = branchChildren[0]
-                    seq.append(branch_end)
-                else:
-                    break # Found an end node or a branch node
-
-            branches.append([child_node_id,
-                             _find_first_interesting_node(seq),
-                             branch_end])
-
-        # If more than one branch exists, sort based on downstream arbor size.
-        if len(children) > 1:
-            branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
-                   reverse=True)
+        cursor = connection.cursor()
+        branches = _find_next_branchnodes_or_ends(tnid, cursor)
 
         # Leaf nodes will have no branches
-        if len(children) > 0:
+        if branches:
             # Create a dict of node ID -> node location
             node_ids_flat = list(itertools.chain.from_iterable(branches))
             node_locations = {row[0]: row for row in _fetch_locations(node_ids_flat)}
+        elif not Treenode.objects.filter(pk=tnid).exists():
+            raise ValueError('Could not find treenode %s' % tnid)
 
         branches = [[node_locations[id] for id in branch] for branch in branches]
         return HttpResponse(json.dumps(branches))
@@ -1,20 +1,32 @@
+import copy
+import logging
 import os.path
-import shutil
 import tarfile
-import json
+
+from collections import defaultdict, OrderedDict
+from cStringIO import StringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from time import time
+
+import numpy as np
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import JsonResponse
 from django.db.models import Count
 
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.common import get_relation_to_id_map, id_generator
-from catmaid.control.cropping import CropJob, extract_substack, ImageRetrievalError
+from catmaid.control.common import get_relation_to_id_map, id_generator, \
+        json_error_response
+from catmaid.control.cropping import CropJob, ImageRetrievalError, \
+        TiffWriter, blit_image_part, decode_tile, get_pixel_per_nm, \
+        get_single_tile_part, get_stack_bounding_boxes, plan_slices, \
+        schedule_job, update_cropping_job, get_cropping_job_info
 from catmaid.models import ClassInstanceClassInstance, TreenodeConnector, \
-        Message, User, UserRole, Treenode
+        Message, User, UserRole, Treenode, Stack
 
-from celery.task import task
 
+logger = logging.getLogger(__name__)
 
 # The path were archive files get stored in
 treenode_output_path = os.path.join(settings.MEDIA_ROOT,
@@ -57,14 +69,64 @@ class SkeletonExportJob:
         self.z_radius = z_radius
         self.sample = sample
 
+class NodeCrop:
+    """ The planned crop around a single exported node: a crop job with the
+    bounding box of the node and the image parts of each of its slices. The
+    finished slices are collected until all of them are available.
+    """
+    def __init__(self, node, job, slices):
+        self.node = node
+        self.job = job
+        self.slices = slices
+        # Finished slices as (slice index, image) tuples
+        self.images = []
+        # The number of slices that still have to be cut
+        self.pending = 0
+        # An (error, path) tuple, if a tile of this node couldn't be read
+        self.error = None
+
+def decode_tile_data(path, img_data):
+    """ Returns the single channel image of the passed in tile data as
+    NumPy array. Retrieval errors are passed through and decoding errors are
+    returned as ImageRetrievalError as well.
+    """
+    if isinstance(img_data, ImageRetrievalError):
+        return img_data
+    try:
+        return decode_tile(img_data, single_channel=True)
+    except IOError as e:
+        return ImageRetrievalError(path, str(e))
+
+def cut_node_slice(crop, nz, bb, image_parts, tiles):
+    """ Copies all image parts of the slice <nz> of a node crop from the
+    decoded <tiles> of its section into a new image. A slice that lies within
+    a single tile is copied from it directly.
+    """
+    ip = get_single_tile_part(bb, image_parts)
+    if ip:
+        image = tiles[ip.path][ip.y_min_src:ip.y_min_src + ip.height,
+                               ip.x_min_src:ip.x_min_src + ip.width]
+        if image.shape[:2] == (bb.height, bb.width):
+            return crop, nz, image.copy()
+    image = np.zeros((bb.height, bb.width, 1), dtype=np.uint8)
+    for ip in image_parts:
+        blit_image_part(image, ip, tiles[ip.path])
+    return crop, nz, image
+
 class TreenodeExporter:
     def __init__(self, job):
         self.job = job
         # The name of entities that are exported
         self.entity_name = "treenode"
 
-        # Output path for this job will be initialized, when needed
-        self.output_path = None
+        # The archive for this job will be created, when needed. All files
+        # are added to a folder with the name of the archive.
+        self.archive = None
+        self.archive_path = None
+        self.archive_folder = None
+
+        # The ID of the CroppingJob that tracks this export, if any
+        self.record_id = None
 
         # Cache for neuron and relation folder names
         self.skid_to_neuron_folder = {}
@@ -85,48 +147,69 @@ class TreenodeExporter:
         msg.action = url
         msg.save()
 
-    def create_basic_output_path(self):
-        """ Will create a random output folder name prefixed with the entity
-        name as well as the actual directory.
+    def create_archive(self):
+        """ Will create a new gzipped tar archive with a random name prefixed
+        with the entity name. Files are added to it as they are created.
         """
-        # Find non-existing random folder name
+        # Find non-existing random archive name
         while True:
             folder_name = self.entity_name + '_archive_' + id_generator()
-            output_path = os.path.join(treenode_output_path, folder_name)
-            if not os.path.exists(output_path):
+            archive_path = os.path.join(treenode_output_path,
+                    folder_name + '.tar.gz')
+            if not os.path.exists(archive_path):
                 break
-        # Create folder and store path as field
-        os.makedirs(output_path)
-        self.output_path = output_path
+        self.archive = tarfile.open(archive_path, 'w:gz')
+        self.archive_path = archive_path
+        self.archive_folder = folder_name
+
+    def close_archive(self):
+        if self.archive:
+            self.archive.close()
+            self.archive = None
+
+    def discard_archive(self):
+        """ Closes and removes a partially written archive.
+        """
+        self.close_archive()
+        if self.archive_path and os.path.exists(self.archive_path):
+            os.remove(self.archive_path)
+
+    def add_file(self, path, data):
+        """ Adds a file with the passed in content to the archive. The path
+        is relative to the archive folder.
+        """
+        info = tarfile.TarInfo(os.path.join(self.archive_folder, path))
+        info.size = len(data)
+        info.mtime = time()
+        self.archive.addfile(info, StringIO(data))
+
+    def add_image(self, path, images, crop_job):
+        """ Adds a TIFF file with one page for each of the passed in images
+        to the archive.
+        """
+        data = StringIO()
+        writer = TiffWriter(None, software="Created with CATMAID",
+                resolution=get_pixel_per_nm(crop_job))
+        writer.open(data)
+        for image in images:
+            writer.write_page(image)
+        writer.close()
+        self.add_file(path, data.getvalue())
 
     def create_path(self, treenode):
-        """ Based on the output path, this function will create a folder
-        structure for a particular skeleton. Things that are supposedly
-        needed multiple times, will be cached. This function will also make
-        sure the path exists and is ready to be written to.
+        """ Returns the archive folder for a particular skeleton, which is
+        named after its neuron. Folder names are cached.
         """
         # Get (and create if needed) cache entry for string of neuron id
         treenode_path = self.skid_to_neuron_folder.get(treenode.skeleton_id)
-        if treenode_path:
-            return treenode_path
-        else:
+        if not treenode_path:
             neuron_cici = ClassInstanceClassInstance.objects.get(
                     relation_id=self.relation_map['model_of'],
                     project_id=self.job.project_id,
-                    class_instance_a=treenode.skeleton.id)
-            treenode_path = os.path.join(self.output_path,
-                    str(neuron_cici.class_instance_b_id))
-            self.skid_to_neuron_folder[treenode.skeleton.id] = treenode_path
-
-            # Create path output_path/neuron_id
-            try:
-                os.makedirs(treenode_path)
-                return treenode_path
-            except OSError as e:
-                # Everything is fine if the path exists and is writable
-                if not os.path.exists(treenode_path) or not \
-                        os.access(treenode_path, os.W_OK):
-                    raise e
+                    class_instance_a=treenode.skeleton_id)
+            treenode_path = str(neuron_cici.class_instance_b_id)
+            self.skid_to_neuron_folder[treenode.skeleton_id] = treenode_path
+        return treenode_path
 
     def get_entities_to_export(self):
         """ Returns a list of treenode links. If the job asks only for a
@@ -145,32 +228,120 @@ class TreenodeExporter:
             return Treenode.objects.filter(project_id=self.job.project_id,
                     skeleton_id__in=self.job.skeleton_ids)
 
-    def export_single_node(self, treenode):
-        """ Exports a treenode and expects the output path to be existing
-        and writable.
+    def get_location(self, treenode):
+        return treenode.location_x, treenode.location_y, treenode.location_z
+
+    def write_node(self, treenode, crop_job, images):
+        """ Adds the images of a treenode to the archive as a multi-page TIFF
+        file, named <treenode-id>.tiff.
         """
-        # Calculate bounding box for current connector
-        x_min = treenode.location_x - self.job.x_radius
-        x_max = treenode.location_x + self.job.x_radius
-        y_min = treenode.location_y - self.job.y_radius
-        y_max = treenode.location_y + self.job.y_radius
-        z_min = treenode.location_z - self.job.z_radius
-        z_max = treenode.location_z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
-
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
-        output_path = self.create_path(treenode)
-        for i, img in enumerate(cropped_stack):
-            # Save image in output path, named <treenode-id>.tiff
-            image_name = "%s.tiff" % treenode.id
-            treenode_image_path = os.path.join(output_path, image_name)
-            img.write(treenode_image_path)
+        image_path = os.path.join(self.create_path(treenode),
+                "%s.tiff" % treenode.id)
+        self.add_image(image_path, [img for nz, img in images], crop_job)
+
+    def plan_crops(self, nodes):
+        """ Returns a crop job, which is shared by all nodes, and a NodeCrop
+        for each passed in node. Stack and translation information is loaded
+        only once for all nodes.
+        """
+        shared_job = CropJob(self.job.user, self.job.project_id,
+                self.job.stack_id, 0, 0, 0, 0, 0, 0, 0, 0,
+                single_channel=True)
+        shared_job.initialize()
+        crops = []
+        for node in nodes:
+            x, y, z = self.get_location(node)
+            crop_job = copy.copy(shared_job)
+            crop_job.x_min = float(x - self.job.x_radius)
+            crop_job.x_max = float(x + self.job.x_radius)
+            crop_job.y_min = float(y - self.job.y_radius)
+            crop_job.y_max = float(y + self.job.y_radius)
+            crop_job.z_min = float(z - self.job.z_radius)
+            crop_job.z_max = float(z + self.job.z_radius)
+            s_to_bb, n_slices = get_stack_bounding_boxes(crop_job)
+            slices = plan_slices(crop_job, s_to_bb, n_slices)
+            crops.append(NodeCrop(node, crop_job, slices))
+        return shared_job, crops
+
+    def export_nodes(self, nodes):
+        """ Adds the images of all passed in nodes to the archive. The crops
+        of all nodes are planned first and grouped by section, so that every
+        tile is fetched and decoded only once, even if it is used by many
+        nodes. Sections are processed in order, the tiles of the next section
+        are fetched while the current one is processed. Decoding tiles and
+        cutting node images is done by a pool of worker threads. Returns a
+        dictionary that maps nodes that couldn't be exported to an (error,
+        path) tuple of a tile that couldn't be read.
+        """
+        shared_job, crops = self.plan_crops(nodes)
+
+        # Map section indices to the slices of all nodes they are needed for
+        sections = defaultdict(list)
+        for crop in crops:
+            for nz, channels in enumerate(crop.slices):
+                for bb, image_parts in channels:
+                    if image_parts:
+                        sections[bb.px_z_min + nz].append(
+                                (crop, nz, bb, image_parts))
+                        crop.pending += 1
+        section_ids = sorted(sections.keys())
+
+        def get_paths(section_id):
+            return list(OrderedDict.fromkeys(ip.path
+                    for crop, nz, bb, image_parts in sections[section_id]
+                    for ip in image_parts))
+
+        fetcher = shared_job.tile_fetcher
+        pool = ThreadPool(cpu_count())
+        n_written = 0
+        try:
+            if section_ids:
+                paths = get_paths(section_ids[0])
+                pending = fetcher.fetch_many_async(paths, catch_errors=True)
+            for n, section_id in enumerate(section_ids):
+                tile_data = pending.get()
+                if n + 1 < len(section_ids):
+                    next_paths = get_paths(section_ids[n + 1])
+                    pending = fetcher.fetch_many_async(next_paths,
+                            catch_errors=True)
+                tiles = dict(zip(paths, pool.map(lambda args:
+                        decode_tile_data(*args), zip(paths, tile_data))))
+
+                work = []
+                for crop, nz, bb, image_parts in sections[section_id]:
+                    if crop.error:
+                        continue
+                    for ip in image_parts:
+                        tile = tiles[ip.path]
+                        if isinstance(tile, ImageRetrievalError):
+                            crop.error = (tile.error, tile.path)
+                            crop.images = None
+                            break
+                    else:
+                        work.append((crop, nz, bb, image_parts, tiles))
+
+                for crop, nz, image in pool.map(lambda args:
+                        cut_node_slice(*args), work):
+                    crop.images.append((nz, image))
+                    crop.pending -= 1
+                    if 0 == crop.pending:
+                        self.write_node(crop.node, crop.job, crop.images)
+                        crop.images = None
+                        n_written += 1
+
+                if self.record_id is not None:
+                    update_cropping_job(self.record_id, slices_done=n_written)
+
+                if n + 1 < len(section_ids):
+                    paths = next_paths
+        finally:
+            pool.close()
+            pool.join()
+
+        logger.info("Export of %s: %s" % (self.archive_folder,
+                shared_job.fetch_metrics))
+
+        return dict((crop.node, crop.error) for crop in crops if crop.error)
 
     def post_process(self, nodes):
         """ Create a meta data file for all the nodes passed (usually all of the
@@ -200,11 +371,11 @@ class TreenodeExporter:
         # parent-id, nr. presynaptic sites, nr. postsynaptic sites, x, y, z
         skid_to_metadata = {}
         for n in nodes:
-            ls = skid_to_metadata.get(n.skeleton.id)
+            ls = skid_to_metadata.get(n.skeleton_id)
             if not ls:
                 ls = []
-                skid_to_metadata[n.skeleton.id] = ls
-            p = n.parent.id if n.parent else 'null'
+                skid_to_metadata[n.skeleton_id] = ls
+            p = n.parent_id if n.parent_id else 'null'
             n_pre = presynaptic_map.get(n.id, 0)
             n_post = postsynaptic_map.get(n.id, 0)
             x = n.location_x
@@ -213,16 +384,19 @@ class TreenodeExporter:
             line = ', '.join([str(e) for e in (n.id, p, n_pre, n_post, x, y, z)])
             ls.append(line)
 
-        # Save metdata for each skeleton to files
+        # Add metdata for each skeleton to the archive
         for skid, metadata in skid_to_metadata.items():
             path = self.skid_to_neuron_folder.get(skid)
-            with open(os.path.join(path, 'metadata.csv'), 'w') as f:
-                f.write("This CSV file contains meta data for CATMAID skeleton " \
-                        "%s. The columns represent the following data:\n" % skid)
-                f.write("treenode-id, parent-id, # presynaptic sites, " \
-                        "# postsynaptic sites, x, y, z\n")
-                for line in metadata:
-                    f.write("%s\n" % line)
+            if not path:
+                continue
+            f = StringIO()
+            f.write("This CSV file contains meta data for CATMAID skeleton " \
+                    "%s. The columns represent the following data:\n" % skid)
+            f.write("treenode-id, parent-id, # presynaptic sites, " \
+                    "# postsynaptic sites, x, y, z\n")
+            for line in metadata:
+                f.write("%s\n" % line)
+            self.add_file(os.path.join(path, 'metadata.csv'), f.getvalue())
 
 class ConnectorExporter(TreenodeExporter):
     """ Most of the infrastructure can be used for both treenodes and
@@ -234,20 +408,19 @@ class ConnectorExporter(TreenodeExporter):
         self.entity_name = "connector"
 
     def create_path(self, connector_link):
-        """ Based on the output path, this function will create a folder
-        structure for a particular connector. Things that are supposedly
-        needed multiple times, will be cached. This function will also make
-        sure the path exists and is ready to be written to.
+        """ Returns the archive folder for a particular connector, which is
+        made of its neuron, its relation and its ID. Things that are
+        supposedly needed multiple times, will be cached.
         """
         # Get (and create if needed) cache entry for string of neuron id
         if connector_link.skeleton_id not in self.skid_to_neuron_folder:
             neuron_cici = ClassInstanceClassInstance.objects.get(
                     relation_id=self.relation_map['model_of'],
                     project_id=self.job.project_id,
-                    class_instance_a=connector_link.skeleton.id)
-            self.skid_to_neuron_folder[connector_link.skeleton.id] = \
+                    class_instance_a=connector_link.skeleton_id)
+            self.skid_to_neuron_folder[connector_link.skeleton_id] = \
                     str(neuron_cici.class_instance_b_id)
-        neuron_folder = self.skid_to_neuron_folder[connector_link.skeleton.id]
+        neuron_folder = self.skid_to_neuron_folder[connector_link.skeleton_id]
 
         # get (and create if needed) cache entry for string of relation name
         if connector_link.relation_id not in self.relid_to_rel_folder:
@@ -260,18 +433,9 @@ class ConnectorExporter(TreenodeExporter):
             self.relid_to_rel_folder[connector_link.relation_id] = rel_folder
         relation_folder =  self.relid_to_rel_folder[connector_link.relation_id]
 
-        # Create path output_path/neuron_id/relation_name/connector_id
-        connector_path = os.path.join(self.output_path, neuron_folder,
-                relation_folder, str(connector_link.connector.id))
-        try:
-            os.makedirs(connector_path)
-        except OSError as e:
-            # Everything is fine if the path exists and is writable
-            if not os.path.exists(connector_path) or not \
-                    os.access(connector_path, os.W_OK):
-                raise e
-
-        return connector_path
+        # Path neuron_id/relation_name/connector_id
+        return os.path.join(neuron_folder, relation_folder,
+                str(connector_link.connector_id))
 
     def get_entities_to_export(self):
         """ Returns a list of connector links. If the job asks only for a
@@ -313,47 +477,33 @@ class ConnectorExporter(TreenodeExporter):
 
         return connector_links
 
-    def export_single_node(self, connector_link):
-        """ Exports a single connector and expects the output path to be existing
-        and writable.
-        """
+    def get_location(self, connector_link):
         connector = connector_link.connector
+        return connector.location_x, connector.location_y, connector.location_z
 
-        # Calculate bounding box for current connector
-        x_min = connector.location_x - self.job.x_radius
-        x_max = connector.location_x + self.job.x_radius
-        y_min = connector.location_y - self.job.y_radius
-        y_max = connector.location_y + self.job.y_radius
-        z_min = connector.location_z - self.job.z_radius
-        z_max = connector.location_z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
-
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
+    def write_node(self, connector_link, crop_job, images):
+        """ Adds a single file for each section (instead of a mulipage TIFF)
+        of a connector to the archive.
+        """
+        connector = connector_link.connector
         connector_path = self.create_path(connector_link)
-        for i, img in enumerate(cropped_stack):
-            # Save image in output path, named after the image center's coordinates,
-            # rounded to full integers.
+        for nz, img in images:
+            # Name the image after the image center's coordinates, rounded to
+            # full integers.
             x = int(connector.location_x + 0.5)
             y = int(connector.location_y + 0.5)
-            z = int(z_min + i * crop_self.stacks[0].resolution.z  + 0.5)
+            z = int(crop_job.z_min + nz * crop_job.ref_stack.resolution.z  + 0.5)
             image_name = "%s_%s_%s.tiff" % (x, y, z)
-            connector_image_path = os.path.join(connector_path, image_name)
-            img.write(connector_image_path)
+            self.add_image(os.path.join(connector_path, image_name), [img],
+                    crop_job)
 
     def post_process(self, nodes):
         pass
 
-@task()
 def process_export_job(exporter):
     """ This method does the actual archive creation. It controls the data
-    extraction and the creation of all sub-stacks. It can be executed as Celery
-    task.
+    extraction and the creation of all sub-stacks. It is run by the scheduler
+    of cropping jobs.
     """
     nodes = exporter.get_entities_to_export()
 
@@ -362,52 +512,56 @@ def process_export_job(exporter):
         msg = "No %ss matching the requirements have been found. Therefore, " \
                 "nothing was exported." % exporter.entity_name
         exporter.create_message("Nothing to export", msg, '#')
+        if exporter.record_id is not None:
+            update_cropping_job(exporter.record_id, status='finished')
         return msg
 
-    # Create a working directoy to create subfolders and images in
-    exporter.create_basic_output_path()
+    # Create the archive, images are added to it as soon as they are ready
+    exporter.create_archive()
 
     # Store error codes and URLs for unreachable images for each failed link
     error_urls = {}
     try:
-        # Export every node
-        for node in nodes:
-            try:
-                exporter.export_single_node(node)
-            except ImageRetrievalError as e:
-                error_urls[node] = (e.error, e.path)
+        # Export all nodes
+        error_urls = exporter.export_nodes(nodes)
         # Create error log, if needed
         if error_urls:
-            error_path = os.path.join(exporter.output_path, "error_log.txt")
-            with open(error_path, 'w') as f:
-                f.write("The following %ss couldn't be exported. At " \
-                        "least one image URL of each of them couldn't be " \
-                        "reached.\n" % exporter.entity_name)
-                f.write("%s-id http-error-code url\n" % exporter.entity_name)
-                for node, eu in error_urls.items():
-                    f.write("%s %s %s\n" % (node.id, eu[0], eu[1]))
-    except IOError as e:
+            f = StringIO()
+            f.write("The following %ss couldn't be exported. At " \
+                    "least one image URL of each of them couldn't be " \
+                    "reached.\n" % exporter.entity_name)
+            f.write("%s-id http-error-code url\n" % exporter.entity_name)
+            for node, eu in error_urls.items():
+                f.write("%s %s %s\n" % (node.id, eu[0], eu[1]))
+            exporter.add_file("error_log.txt", f.getvalue())
+
+        # Give an exporter the chance to do some postprocessing
+        exporter.post_process(nodes)
+        exporter.close_archive()
+    except Exception as e:
+        logger.exception("The %s export failed" % exporter.entity_name)
+        exporter.discard_archive()
         msg = "The export of the data set has been aborted, because an " \
                 "error occured: %s" % str(e)
         exporter.create_message("The %s export failed" % exporter.entity_name,
                 msg, '#')
+        if exporter.record_id is not None:
+            update_cropping_job(exporter.record_id, status='failed',
+                    error=str(e))
         return "An error occured during the %s export: %s" % \
                 (exporter.entity_name, str(e))
+    finally:
+        # Never leave a half-written archive open
+        exporter.close_archive()
 
-    # Give an exporter the chance to do some postprocessing
-    exporter.post_process(nodes)
-
-    # Make working directory an archive
-    tarfile_path = exporter.output_path.rstrip(os.sep) + '.tar.gz'
-    tar = tarfile.open(tarfile_path, 'w:gz')
-    tar.add(exporter.output_path, arcname=os.path.basename(exporter.output_path))
-    tar.close()
-
-    # Delete working directory
-    shutil.rmtree(exporter.output_path)
+    if exporter.record_id is not None:
+        update_cropping_job(exporter.record_id, status='finished',
+                output_path=exporter.archive_path,
+                slices_done=len(nodes) - len(error_urls),
+                bytes_written=os.path.getsize(exporter.archive_path))
 
     # Create message
-    tarfile_name = os.path.basename(tarfile_path)
+    tarfile_name = os.path.basename(exporter.archive_path)
     url = os.path.join(settings.CATMAID_URL, settings.MEDIA_URL,
             settings.MEDIA_TREENODE_SUBDIRECTORY, tarfile_name)
     if error_urls:
@@ -423,11 +577,50 @@ def process_export_job(exporter):
 
     return msg
 
-def start_asynch_process(exporter):
-    """ It launches the data extraction and sub-stack building as a separate
-    process. Celery is used for this and it it returns a AsyncResult object.
+def estimate_export_size(exporter):
+    """ Returns the number of nodes the passed in exporter would export and the
+    size in bytes of the uncompressed images of all of them.
+    """
+    job = exporter.job
+    nodes = exporter.get_entities_to_export()
+    n_nodes = len(nodes) if isinstance(nodes, list) else nodes.count()
+    stack = Stack.objects.get(id=job.stack_id)
+    width = int(2 * job.x_radius / stack.resolution.x) + 1
+    height = int(2 * job.y_radius / stack.resolution.y) + 1
+    depth = int(2 * job.z_radius / stack.resolution.z) + 1
+    return n_nodes, n_nodes * width * height * depth
+
+def schedule_export_job(exporter):
+    """ Creates a CroppingJob record for the passed in exporter, which is
+    started by the scheduler of cropping jobs once the current transaction is
+    committed. Exports count against the same quotas as cropping jobs, a
+    ValueError is raised if they are exceeded. Returns the new record.
+    """
+    job = exporter.job
+    n_nodes, estimated_size = estimate_export_size(exporter)
+    return schedule_job(job.user.id, job.project_id,
+            exporter.entity_name + '_export', {
+                'stack_id': job.stack_id,
+                'skeleton_ids': sorted(job.skeleton_ids),
+                'x_radius': job.x_radius,
+                'y_radius': job.y_radius,
+                'z_radius': job.z_radius,
+                'sample': job.sample,
+            }, estimated_size, n_nodes)
+
+def process_scheduled_export_job(record):
+    """ Runs the export tracked by the passed in CroppingJob record.
     """
-    return process_export_job.delay(exporter)
+    p = record.parameters
+    job = SkeletonExportJob(record.user, record.project_id, p['stack_id'],
+            p['skeleton_ids'], p['x_radius'], p['y_radius'], p['z_radius'],
+            p['sample'])
+    if 'connector_export' == record.job_type:
+        exporter = ConnectorExporter(job)
+    else:
+        exporter = TreenodeExporter(job)
+    exporter.record_id = record.id
+    return process_export_job(exporter)
 
 def create_request_based_export_job(request, project_id):
     """ This will get parameters for a new treenode exporting job from an HTTP
@@ -469,13 +662,14 @@ def export_connectors(request, project_id=None):
     Based on them this method will create and run a new exporting job.
     """
     job = create_request_based_export_job(request, project_id)
-    proc = start_asynch_process(ConnectorExporter(job))
-    if proc.failed():
-        raise Exception("Something went wrong while queuing the export: " + \
-                proc.result)
-    json_data = json.dumps({'message': 'The connector archive is currently ' \
-            'exporting. You will be notified once it is ready for download.'})
-    return HttpResponse(json_data, content_type='application/json')
+    try:
+        record = schedule_export_job(ConnectorExporter(job))
+    except (ValueError, RuntimeError) as e:
+        return json_error_response(str(e))
+    info = get_cropping_job_info(record)
+    info['message'] = 'The connector archive is currently exporting. You will ' \
+            'be notified once it is ready for download.'
+    return JsonResponse(info)
 
 @requires_user_role(UserRole.Browse)
 def export_treenodes(request, project_id=None):
@@ -483,10 +677,11 @@ def export_treenodes(request, project_id=None):
     Based on them this method will create and run a new exporting job.
     """
     job = create_request_based_export_job(request, project_id)
-    proc = start_asynch_process(TreenodeExporter(job))
-    if proc.failed():
-        raise Exception("Something went wrong while queuing the export: " + \
-                proc.result)
-    json_data = json.dumps({'message': 'The treenode archive is currently ' \
-            'exporting. You will be notified once it is ready for download.'})
-    return HttpResponse(json_data, content_type='application/json')
+    try:
+        record = schedule_export_job(TreenodeExporter(job))
+    except (ValueError, RuntimeError) as e:
+        return json_error_response(str(e))
+    info = get_cropping_job_info(record)
+    info['message'] = 'The treenode archive is currently exporting. You will ' \
+            'be notified once it is ready for download.'
+    return JsonResponse(info)
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from catmaid.control.skeleton import import_skeletons_swc
+from catmaid.models import Project, User
+
+
+class Command(BaseCommand):
+    help = 'Import SWC files as skeletons into a project. All files are ' \
+        'imported in a single transaction, each file as a new skeleton.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('project_id', type=int,
+            help='The project to import the skeletons into')
+        parser.add_argument('files', nargs='+',
+            help='The SWC files to import')
+        parser.add_argument('--user', dest='user', required=True,
+            help='The username of the owner of the imported skeletons')
+        parser.add_argument('--neuron-id', dest='neuron_id', type=int,
+            default=None, help='Let all skeletons model this neuron instead '
+            'of creating a new neuron for each skeleton')
+
+    def handle(self, *args, **options):
+        try:
+            project = Project.objects.get(pk=options['project_id'])
+        except Project.DoesNotExist:
+            raise CommandError('Project %s does not exist' % options['project_id'])
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('User "%s" does not exist' % options['user'])
+
+        swc_strings = []
+        for path in options['files']:
+            with open(path, 'r') as f:
+                swc_strings.append(f.read())
+
+        with transaction.atomic():
+            try:
+                imported = import_skeletons_swc(user, project.id, swc_strings,
+                        options['neuron_id'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        for path, import_info in zip(options['files'], imported):
+            self.stdout.write('Imported %s as skeleton %s (%s nodes) of neuron %s' % \
+                    (path, import_info['skeleton_id'],
+                     len(import_info['node_id_map']), import_info['neuron_id']))
@@ -0,0 +1,175 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+
+def parse_month(value):
+    try:
+        month = datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        raise CommandError('Expected month in format YYYY-MM, got "%s"' % value)
+    return month.replace(tzinfo=timezone.utc)
+
+def parse_date(value):
+    try:
+        date = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError('Expected date in format YYYY-MM-DD, got "%s"' % value)
+    return date.replace(tzinfo=timezone.utc)
+
+def next_month(month):
+    if 12 == month.month:
+        return month.replace(year=month.year + 1, month=1)
+    return month.replace(month=month.month + 1)
+
+
+class Command(BaseCommand):
+    help = 'Manage monthly partitions of history tables. Partitions contain ' \
+        'all row versions that stopped being valid in a particular month. ' \
+        'Old partitions can be detached, which removes them from the ' \
+        'history, so that they can be archived and dropped. Chains of ' \
+        'short lived consecutive versions of the same row can be compacted ' \
+        'into a single version. All changes are made in a single transaction.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action',
+            choices=('list', 'create', 'detach', 'attach', 'drop', 'compact'),
+            help='list: show partitions, create: add monthly partitions, '
+            'detach: remove partitions that end before --before from their '
+            'history table, attach: add detached partitions back, drop: '
+            'remove detached partitions that end before --before, compact: '
+            'merge chains of consecutive versions that ended before --before')
+        parser.add_argument('--table', dest='tables', nargs='+', default=[],
+            help='The live tables whose history to work with, all versioned '
+            'tables by default')
+        parser.add_argument('--from', dest='from_month', default=None,
+            help='create: first month (YYYY-MM) to create a partition for, '
+            'the month of the oldest history entry by default')
+        parser.add_argument('--until', dest='until_month', default=None,
+            help='create: last month (YYYY-MM) to create a partition for, '
+            'next month by default')
+        parser.add_argument('--before', dest='before', default=None,
+            help='detach, drop, compact: only handle partitions and row '
+            'versions that end before this date (YYYY-MM-DD)')
+        parser.add_argument('--min-duration', dest='min_duration', type=int,
+            default=60, help='compact: row versions that were valid for at '
+            'least this many seconds are kept')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        before = parse_date(options['before']) if options['before'] else None
+        if action in ('detach', 'drop', 'compact') and not before:
+            raise CommandError('Please specify a date with --before')
+
+        cursor = connection.cursor()
+        with transaction.atomic():
+            history_tables = self.get_history_tables(cursor, options['tables'])
+            if 'list' == action:
+                self.list_partitions(cursor, history_tables)
+            elif 'create' == action:
+                self.create_partitions(cursor, history_tables,
+                        options['from_month'], options['until_month'])
+            elif 'detach' == action:
+                self.change_partitions(cursor, history_tables,
+                        'detach_history_partition', 'Detached', False, before)
+            elif 'attach' == action:
+                self.change_partitions(cursor, history_tables,
+                        'attach_history_partition', 'Attached', True, before)
+            elif 'drop' == action:
+                self.change_partitions(cursor, history_tables,
+                        'drop_history_partition', 'Dropped', True, before)
+            elif 'compact' == action:
+                self.compact(cursor, history_tables, before,
+                        options['min_duration'])
+
+    def get_history_tables(self, cursor, live_tables):
+        """Return a list of (live table, history table) tuples for the passed
+        in live tables or all versioned tables if none are passed in.
+        """
+        cursor.execute("""
+            SELECT live_table::text, history_table::text
+            FROM catmaid_history_table
+            ORDER BY live_table::text
+        """)
+        history_tables = cursor.fetchall()
+        if not live_tables:
+            return history_tables
+
+        known = dict(history_tables)
+        unknown = [t for t in live_tables if t not in known]
+        if unknown:
+            raise CommandError('Tables without history: %s' % ', '.join(unknown))
+        return [(t, known[t]) for t in live_tables]
+
+    def get_partitions(self, cursor, history_tables, detached=None, before=None):
+        cursor.execute("""
+            SELECT partition_table::text, history_table::text, start_time,
+                end_time, detached
+            FROM catmaid_history_partition
+            WHERE history_table::text = ANY(%s::text[])
+            AND (%s::boolean IS NULL OR detached = %s::boolean)
+            AND (%s::timestamptz IS NULL OR end_time <= %s::timestamptz)
+            ORDER BY history_table::text, start_time
+        """, ([h[1] for h in history_tables], detached, detached, before, before))
+        return cursor.fetchall()
+
+    def list_partitions(self, cursor, history_tables):
+        for name, history_table, start, end, detached in \
+                self.get_partitions(cursor, history_tables):
+            self.stdout.write('%s: %s - %s%s' % (name, start.isoformat(),
+                    end.isoformat(), ' (detached)' if detached else ''))
+
+    def create_partitions(self, cursor, history_tables, from_month, until_month):
+        now = timezone.now()
+        current_month = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
+        end = next_month(parse_month(until_month) if until_month else
+                next_month(current_month))
+
+        for live_table, history_table in history_tables:
+            if from_month:
+                start = parse_month(from_month)
+            else:
+                cursor.execute("""
+                    SELECT min(upper(sys_period)) FROM ONLY {}
+                """.format(history_table))
+                oldest = cursor.fetchone()[0] or now
+                oldest = oldest.astimezone(timezone.utc)
+                start = datetime(oldest.year, oldest.month, 1,
+                        tzinfo=timezone.utc)
+
+            existing = set(p[2] for p in self.get_partitions(cursor,
+                    [(live_table, history_table)]))
+            while start < end:
+                month_end = next_month(start)
+                if start not in existing:
+                    cursor.execute("""
+                        SELECT create_history_partition(%s::regclass, %s, %s)::text
+                    """, (live_table, start, month_end))
+                    self.stdout.write('Created partition %s' % cursor.fetchone()[0])
+                start = month_end
+
+    def change_partitions(self, cursor, history_tables, function, verb,
+            detached, before):
+        for partition in self.get_partitions(cursor, history_tables, detached,
+                before):
+            cursor.execute("SELECT {}(%s::regclass)".format(function),
+                    (partition[0],))
+            self.stdout.write('%s partition %s' % (verb, partition[0]))
+
+    def compact(self, cursor, history_tables, before, min_duration):
+        for live_table, history_table in history_tables:
+            # Partitions are inheriting tables and are compacted on their own
+            tables = [history_table] + [p[0] for p in self.get_partitions(
+                    cursor, [(live_table, history_table)], False)
+                    if p[2] < before]
+            n_removed = 0
+            for table in tables:
+                cursor.execute("""
+                    SELECT compact_history(%s::regclass, %s,
+                        %s * interval '1 second')
+                """, (table, before, min_duration))
+                n_removed += cursor.fetchone()[0]
+            self.stdout.write('Removed %s versions from history of %s' % \
+                    (n_removed, live_table))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- Only the most recent review of a node by a particular reviewer is of
+    -- interest. Remove all older duplicates before the constraint is added.
+    DELETE FROM review r
+    USING review r2
+    WHERE r.treenode_id = r2.treenode_id
+      AND r.reviewer_id = r2.reviewer_id
+      AND (r.review_time < r2.review_time
+        OR (r.review_time = r2.review_time AND r.id < r2.id));
+
+    -- A unique constraint on treenode and reviewer allows to insert or update
+    -- many reviews in one statement using INSERT ... ON CONFLICT.
+    ALTER TABLE review
+    ADD CONSTRAINT review_treenode_reviewer_uniq UNIQUE (treenode_id, reviewer_id);
+"""
+
+backward = """
+    ALTER TABLE review
+    DROP CONSTRAINT review_treenode_reviewer_uniq;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0010_history_tracking_update'),
+    ]
+
+    operations = [
+            migrations.RunSQL(forward, backward, [
+                migrations.AlterUniqueTogether(
+                    name='review',
+                    unique_together=set([('treenode', 'reviewer')]),
+                ),
+            ]),
+    ]
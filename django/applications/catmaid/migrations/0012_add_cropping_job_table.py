@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    """Add a table to keep track of cropping, node export and ROI image jobs.
+    It is used to limit the number of jobs per user, to start large jobs only
+    if enough workers are available and to report progress. It has no history
+    table.
+    """
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catmaid', '0011_add_unique_review_constraint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CroppingJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('creation_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('edition_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('job_type', models.CharField(choices=[('crop', 'Crop'), ('treenode_export', 'Treenode export'), ('connector_export', 'Connector export'), ('roi_images', 'ROI images')], default='crop', max_length=32)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], db_index=True, default='queued', max_length=32)),
+                ('parameters', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('output_path', models.TextField()),
+                ('estimated_size', models.BigIntegerField()),
+                ('n_slices', models.IntegerField()),
+                ('slices_done', models.IntegerField(default=0)),
+                ('bytes_written', models.BigIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'cropping_job',
+            },
+        ),
+    ]
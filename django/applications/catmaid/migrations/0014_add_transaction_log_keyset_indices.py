@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+forward = """
+    -- Transactions of a project are listed newest first and paged through
+    -- by (execution_time, transaction_id). Filters on user and label are
+    -- common, they get their own index with the same order. A plain project
+    -- index, which might be left over from older databases, is a prefix of
+    -- these indices and not needed anymore.
+    CREATE INDEX catmaid_transaction_info_project_time_idx
+    ON catmaid_transaction_info (project_id, execution_time DESC,
+        transaction_id DESC);
+
+    CREATE INDEX catmaid_transaction_info_project_user_time_idx
+    ON catmaid_transaction_info (project_id, user_id, execution_time DESC,
+        transaction_id DESC);
+
+    CREATE INDEX catmaid_transaction_info_project_label_time_idx
+    ON catmaid_transaction_info (project_id, label, execution_time DESC,
+        transaction_id DESC);
+
+    DROP INDEX IF EXISTS catmaid_transaction_info_project_idx;
+"""
+
+backward = """
+    DROP INDEX catmaid_transaction_info_project_time_idx;
+    DROP INDEX catmaid_transaction_info_project_user_time_idx;
+    DROP INDEX catmaid_transaction_info_project_label_time_idx;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0012_add_cropping_job_table'),
+    ]
+
+    operations = [
+            migrations.RunSQL(forward, backward)
+    ]
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- History tables can optionally be split into partitions by the upper
+    -- bound of sys_period, i.e. the time a row version stopped being valid.
+    -- Partitions are child tables of a history table, which makes queries on
+    -- the history table include them. Old partitions can be detached from a
+    -- history table to archive them (e.g. with pg_dump) and then be dropped.
+    CREATE TABLE catmaid_history_partition (
+        partition_table     regclass PRIMARY KEY,
+        history_table       regclass NOT NULL
+            REFERENCES catmaid_history_table (history_table) ON DELETE CASCADE,
+        start_time          timestamptz NOT NULL,
+        end_time            timestamptz NOT NULL,
+        detached            boolean NOT NULL DEFAULT false,
+        creation_time       timestamptz NOT NULL DEFAULT current_timestamp,
+        CONSTRAINT catmaid_history_partition_range CHECK (start_time < end_time)
+    );
+    CREATE INDEX catmaid_history_partition_history_table_start_time_index
+        ON catmaid_history_partition (history_table, start_time);
+
+
+    -- Move new history rows of a history table into the attached partition
+    -- that covers the upper bound of their validity period. Rows without a
+    -- matching partition (including rows with an empty validity period) are
+    -- kept in the history table itself.
+    CREATE OR REPLACE FUNCTION route_history_row_to_partition()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        target_table regclass;
+    BEGIN
+        SELECT chp.partition_table
+        FROM catmaid_history_partition chp
+        WHERE chp.history_table = TG_RELID
+        AND NOT chp.detached
+        AND chp.start_time <= upper(NEW.sys_period)
+        AND chp.end_time > upper(NEW.sys_period)
+        INTO target_table;
+
+        IF target_table IS NULL THEN
+            RETURN NEW;
+        END IF;
+
+        EXECUTE format('INSERT INTO %s SELECT ($1).*', target_table) USING NEW;
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Create a new partition of the history table of the passed in live table
+    -- for all row versions that stopped being valid in [start_time, end_time).
+    -- Existing rows of this range are moved from the history table into the
+    -- new partition, unless <move_rows> is false. The partition is named after
+    -- the history table and the UTC date of its start time.
+    CREATE OR REPLACE FUNCTION create_history_partition(live_table regclass,
+            start_time timestamptz, end_time timestamptz,
+            move_rows boolean DEFAULT true)
+    RETURNS regclass
+    LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        history_info catmaid_history_table;
+        history_table_name text;
+        partition_name text;
+        partition_oid regclass;
+    BEGIN
+        SELECT * FROM catmaid_history_table cht
+        WHERE cht.live_table = $1
+        INTO history_info;
+
+        IF NOT FOUND THEN
+            RAISE EXCEPTION 'Table "%" has no history table', live_table;
+        END IF;
+
+        IF start_time >= end_time THEN
+            RAISE EXCEPTION 'The start time of a partition has to be before '
+                'its end time';
+        END IF;
+
+        IF EXISTS(SELECT 1 FROM catmaid_history_partition chp
+            WHERE chp.history_table = history_info.history_table
+            AND chp.start_time < $3
+            AND chp.end_time > $2)
+        THEN
+            RAISE EXCEPTION 'The range [%, %) overlaps with an existing '
+                'partition of history table "%"', start_time, end_time,
+                history_info.history_table;
+        END IF;
+
+        SELECT relname FROM pg_class
+        WHERE oid = history_info.history_table
+        INTO history_table_name;
+
+        partition_name = history_table_name || '__' ||
+            to_char(start_time AT TIME ZONE 'UTC', 'YYYYMMDD');
+
+        -- Make sure neither partition nor index names are shortened silently
+        -- by Postgres.
+        IF LENGTH(partition_name || '_sys_period') > 63 THEN
+            RAISE EXCEPTION 'Can''t create history partition with name longer '
+                'than 52 characters: %', partition_name;
+        END IF;
+
+        -- The check constraint lets the planner skip partitions in queries
+        -- that constrain upper(sys_period).
+        EXECUTE format(
+            'CREATE TABLE %I (CHECK (upper(sys_period) >= %L::timestamptz '
+            'AND upper(sys_period) < %L::timestamptz)) INHERITS (%s)',
+            partition_name, start_time, end_time, history_info.history_table);
+        partition_oid = to_regclass(partition_name::cstring);
+
+        EXECUTE format('CREATE INDEX %I ON %s (%I)',
+            partition_name || '_live_pk', partition_oid,
+            history_info.live_table_pkey_column);
+        EXECUTE format('CREATE INDEX %I ON %s USING gist(sys_period)',
+            partition_name || '_sys_period', partition_oid);
+        EXECUTE format('CREATE INDEX %I ON %s (exec_transaction_id)',
+            partition_name || '_txid', partition_oid);
+
+        IF move_rows THEN
+            EXECUTE format(
+                'WITH moved AS ('
+                '  DELETE FROM ONLY %1$s'
+                '  WHERE upper(sys_period) >= %2$L::timestamptz'
+                '  AND upper(sys_period) < %3$L::timestamptz'
+                '  RETURNING *'
+                ') '
+                'INSERT INTO %4$s SELECT * FROM moved',
+                history_info.history_table, start_time, end_time,
+                partition_oid);
+        END IF;
+
+        INSERT INTO catmaid_history_partition (partition_table, history_table,
+            start_time, end_time)
+        VALUES (partition_oid, history_info.history_table, start_time, end_time);
+
+        IF NOT EXISTS(SELECT 1 FROM pg_trigger
+            WHERE tgrelid = history_info.history_table
+            AND tgname = 'on_insert_route_to_partition')
+        THEN
+            EXECUTE format(
+                'CREATE TRIGGER on_insert_route_to_partition '
+                'BEFORE INSERT ON %s FOR EACH ROW '
+                'EXECUTE PROCEDURE route_history_row_to_partition()',
+                history_info.history_table);
+        END IF;
+
+        RETURN partition_oid;
+    END;
+    $$;
+
+
+    -- Remove a partition from its history table. Its rows aren't part of
+    -- the history table anymore and new rows of its range are kept in the
+    -- history table itself.
+    CREATE OR REPLACE FUNCTION detach_history_partition(partition_table regclass)
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        partition_info catmaid_history_partition;
+    BEGIN
+        SELECT * FROM catmaid_history_partition chp
+        WHERE chp.partition_table = $1
+        INTO partition_info;
+
+        IF NOT FOUND OR partition_info.detached THEN
+            RAISE EXCEPTION '"%" is no attached history partition', partition_table;
+        END IF;
+
+        EXECUTE format('ALTER TABLE %s NO INHERIT %s',
+            partition_table, partition_info.history_table);
+
+        UPDATE catmaid_history_partition chp SET detached = true
+        WHERE chp.partition_table = $1;
+    END;
+    $$;
+
+
+    -- Add a detached partition back to its history table, which makes its
+    -- rows part of the history again.
+    CREATE OR REPLACE FUNCTION attach_history_partition(partition_table regclass)
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        partition_info catmaid_history_partition;
+    BEGIN
+        SELECT * FROM catmaid_history_partition chp
+        WHERE chp.partition_table = $1
+        INTO partition_info;
+
+        IF NOT FOUND OR NOT partition_info.detached THEN
+            RAISE EXCEPTION '"%" is no detached history partition', partition_table;
+        END IF;
+
+        EXECUTE format('ALTER TABLE %s INHERIT %s',
+            partition_table, partition_info.history_table);
+
+        UPDATE catmaid_history_partition chp SET detached = false
+        WHERE chp.partition_table = $1;
+    END;
+    $$;
+
+
+    -- Remove a detached partition and all its rows.
+    CREATE OR REPLACE FUNCTION drop_history_partition(partition_table regclass)
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF NOT EXISTS(SELECT 1 FROM catmaid_history_partition chp
+            WHERE chp.partition_table = $1
+            AND chp.detached)
+        THEN
+            RAISE EXCEPTION 'Only detached history partitions can be dropped, '
+                '"%" isn''t one', partition_table;
+        END IF;
+
+        DELETE FROM catmaid_history_partition chp
+        WHERE chp.partition_table = $1;
+
+        EXECUTE format('DROP TABLE %s', partition_table);
+    END;
+    $$;
+
+
+    -- Merge chains of consecutive versions of the same row in a history table
+    -- or a partition of it. Consecutive versions follow each other without a
+    -- gap. Each version that was valid for less than <min_duration> and is
+    -- followed by another consecutive version is removed, and the validity
+    -- period of the last version of a chain is extended to the start of the
+    -- chain. Only versions that stopped being valid before <before_time> are
+    -- considered. Inheriting tables are compacted separately. Returns the
+    -- number of removed versions.
+    CREATE OR REPLACE FUNCTION compact_history(history_table regclass,
+            before_time timestamptz, min_duration interval)
+    RETURNS bigint
+    LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        live_table_pkey_column text;
+        n_removed bigint;
+    BEGIN
+        SELECT cht.live_table_pkey_column
+        FROM catmaid_history_table cht
+        LEFT JOIN catmaid_history_partition chp
+            ON chp.history_table = cht.history_table
+        WHERE cht.history_table = $1
+        OR chp.partition_table = $1
+        LIMIT 1
+        INTO live_table_pkey_column;
+
+        IF live_table_pkey_column IS NULL THEN
+            RAISE EXCEPTION '"%" is neither a history table nor a history '
+                'partition', history_table;
+        END IF;
+
+        EXECUTE format(
+            'WITH version AS ('
+            '  SELECT ctid AS version_ctid, %1$I AS live_pk, sys_period,'
+            '    lag(upper(sys_period)) OVER w IS DISTINCT FROM lower(sys_period)'
+            '    OR lag(upper(sys_period) - lower(sys_period)) OVER w >= $2'
+            '      AS starts_chain'
+            '  FROM ONLY %2$s'
+            '  WHERE upper(sys_period) < $1'
+            '  WINDOW w AS (PARTITION BY %1$I'
+            '    ORDER BY lower(sys_period), upper(sys_period))'
+            '), chain AS ('
+            '  SELECT version_ctid, live_pk, sys_period,'
+            '    sum(CASE WHEN starts_chain THEN 1 ELSE 0 END) OVER ('
+            '      PARTITION BY live_pk'
+            '      ORDER BY lower(sys_period), upper(sys_period)'
+            '      ROWS UNBOUNDED PRECEDING) AS chain_id'
+            '  FROM version'
+            '), chain_member AS ('
+            '  SELECT version_ctid, live_pk, sys_period,'
+            '    min(lower(sys_period)) OVER c AS chain_start,'
+            '    row_number() OVER (c ORDER BY lower(sys_period) DESC,'
+            '      upper(sys_period) DESC) AS position_from_end'
+            '  FROM chain'
+            '  WINDOW c AS (PARTITION BY live_pk, chain_id)'
+            '), removed AS ('
+            '  DELETE FROM ONLY %2$s h'
+            '  USING chain_member cm'
+            '  WHERE h.%1$I = cm.live_pk'
+            '  AND h.ctid = cm.version_ctid'
+            '  AND cm.position_from_end > 1'
+            '  RETURNING 1'
+            '), extended AS ('
+            '  UPDATE ONLY %2$s h'
+            '  SET sys_period = tstzrange(cm.chain_start, upper(cm.sys_period))'
+            '  FROM chain_member cm'
+            '  WHERE h.%1$I = cm.live_pk'
+            '  AND h.ctid = cm.version_ctid'
+            '  AND cm.position_from_end = 1'
+            '  AND cm.chain_start < lower(cm.sys_period)'
+            '  RETURNING 1'
+            ') '
+            'SELECT (SELECT count(*) FROM removed)',
+            live_table_pkey_column, history_table)
+        INTO n_removed
+        USING before_time, min_duration;
+
+        RETURN n_removed;
+    END;
+    $$;
+"""
+
+backward = """
+    -- Stop routing new history rows into partitions, move the rows of all
+    -- attached partitions back into their history table and remove the
+    -- partitions. Detached partitions are kept as regular tables.
+    DROP FUNCTION route_history_row_to_partition() CASCADE;
+
+    DO $$
+    DECLARE
+        partition_info record;
+    BEGIN
+        FOR partition_info IN
+            SELECT * FROM catmaid_history_partition
+        LOOP
+            IF partition_info.detached THEN
+                RAISE NOTICE 'Keeping detached history partition "%"',
+                    partition_info.partition_table;
+            ELSE
+                EXECUTE format('ALTER TABLE %s NO INHERIT %s',
+                    partition_info.partition_table, partition_info.history_table);
+                EXECUTE format('INSERT INTO %s SELECT * FROM %s',
+                    partition_info.history_table, partition_info.partition_table);
+                EXECUTE format('DROP TABLE %s', partition_info.partition_table);
+            END IF;
+        END LOOP;
+    END
+    $$;
+
+    DROP FUNCTION create_history_partition(regclass, timestamptz, timestamptz, boolean);
+    DROP FUNCTION detach_history_partition(regclass);
+    DROP FUNCTION attach_history_partition(regclass);
+    DROP FUNCTION drop_history_partition(regclass);
+    DROP FUNCTION compact_history(regclass, timestamptz, interval);
+
+    DROP TABLE catmaid_history_partition;
+"""
+
+
+class Migration(migrations.Migration):
+    """Allow history tables to be partitioned by the time row versions stopped
+    being valid. Postgres 9.5 has no declarative partitioning, partitions are
+    therefore inheriting tables, filled by an insert trigger on their history
+    table.
+    """
+
+    dependencies = [
+        ('catmaid', '0014_add_transaction_log_keyset_indices'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
@@ -430,6 +430,43 @@ class Message(models.Model):
         db_table = "message"
 
 
+class CroppingJob(models.Model):
+    """ The state of a job that creates images from stacks: a cropping job, a
+    node export or the rendering of ROI images. It is used to limit the number
+    of jobs of each user and to report progress.
+    """
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('finished', 'Finished'),
+        ('failed', 'Failed'),
+    )
+    JOB_TYPE_CHOICES = (
+        ('crop', 'Crop'),
+        ('treenode_export', 'Treenode export'),
+        ('connector_export', 'Connector export'),
+        ('roi_images', 'ROI images'),
+    )
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    job_type = models.CharField(max_length=32, choices=JOB_TYPE_CHOICES,
+            default='crop')
+    creation_time = models.DateTimeField(default=timezone.now)
+    edition_time = models.DateTimeField(default=timezone.now)
+    status = models.CharField(max_length=32, choices=STATUS_CHOICES,
+            default='queued', db_index=True)
+    parameters = JSONField()
+    output_path = models.TextField()
+    estimated_size = models.BigIntegerField()
+    n_slices = models.IntegerField()
+    slices_done = models.IntegerField(default=0)
+    bytes_written = models.BigIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        db_table = "cropping_job"
+
+
 class ClientDatastore(models.Model):
     name = models.CharField(max_length=255, unique=True, validators=[
             RegexValidator(r'^[\w-]+$',
@@ -607,6 +644,7 @@ class Review(models.Model):
 
     class Meta:
         db_table = "review"
+        unique_together = (('treenode', 'reviewer'),)
 
 
 class ReviewerWhitelist(models.Model):
@@ -653,6 +691,14 @@ class RegionOfInterest(UserFocusedModel):
         db_table = "region_of_interest"
 
 
+def on_roi_save(sender, instance, created, **kwargs):
+    from catmaid.control.roi import on_roi_save
+    on_roi_save(sender, instance, created, **kwargs)
+
+# Connect the ROI model's post save signal to ROI image creation
+post_save.connect(on_roi_save, sender=RegionOfInterest)
+
+
 class RegionOfInterestClassInstance(UserFocusedModel):
     # Repeat the columns inherited from 'relation_instance'
     relation = models.ForeignKey(Relation, on_delete=models.CASCADE)
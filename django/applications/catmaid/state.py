@@ -5,103 +5,129 @@ from django.db import connection
 
 
 class StateMatchingError(Exception):
-    """Indicates that a state check wasn't successful"""
-    def __init__(self, message, state):
+    """Indicates that a state check wasn't successful. The list of
+    (check, id) tuples <mismatches> contains the failed checks and the IDs of
+    the objects that didn't match."""
+    def __init__(self, message, state, mismatches=None):
         super(StateMatchingError, self).__init__(message)
         self.unmatched_state = state
+        self.mismatches = mismatches or []
 
 
 class SQL:
-    was_edited = """
-        SELECT 1 FROM location t
-        WHERE t.id = %s
-        AND t.edition_time >=(%s::timestamptz - '1 ms'::interval)
-        AND t.edition_time < (%s::timestamptz + '1 ms'::interval)
-        LIMIT 1
+    lock_nodes = """
+        SELECT id FROM treenode
+        WHERE id = ANY(%(lock_ids)s::bigint[])
+        ORDER BY id
+        FOR UPDATE;
     """
-    is_parent = """
-        SELECT 1 FROM treenode t
-        WHERE t.parent_id = %s AND t.id = %s
+    # Each part of this query returns the objects that don't match one kind of
+    # check. The expected state is passed in as arrays, which keeps the query
+    # the same, regardless of the number of checked nodes.
+    mismatches = """
+        SELECT 'edition_time', e.id
+        FROM UNNEST(%(node_ids)s::bigint[], %(node_times)s::timestamptz[])
+            e(id, edition_time)
+        LEFT JOIN location l
+            ON l.id = e.id
+            AND l.edition_time >= (e.edition_time - '1 ms'::interval)
+            AND l.edition_time < (e.edition_time + '1 ms'::interval)
+        WHERE l.id IS NULL
+        UNION ALL
+        SELECT 'link_edition_time', e.id
+        FROM UNNEST(%(link_ids)s::bigint[], %(link_times)s::timestamptz[])
+            e(id, edition_time)
+        LEFT JOIN treenode_connector l
+            ON l.id = e.id
+            AND l.edition_time >= (e.edition_time - '1 ms'::interval)
+            AND l.edition_time < (e.edition_time + '1 ms'::interval)
+        WHERE l.id IS NULL
+        UNION ALL
+        SELECT 'parent', e.child_id
+        FROM UNNEST(%(edge_child_ids)s::bigint[], %(edge_parent_ids)s::bigint[])
+            e(child_id, parent_id)
+        LEFT JOIN treenode t
+            ON t.id = e.child_id
+            AND t.parent_id = e.parent_id
+        WHERE t.id IS NULL
+        UNION ALL
+        SELECT 'root', r.id
+        FROM UNNEST(%(root_ids)s::bigint[]) r(id)
+        LEFT JOIN treenode t
+            ON t.id = r.id
+            AND t.parent_id IS NULL
+        WHERE t.id IS NULL
+        UNION ALL
+        SELECT 'children', t.parent_id
+        FROM UNNEST(%(child_set_ids)s::bigint[]) c(id)
+        JOIN treenode t
+            ON t.parent_id = c.id
+        LEFT JOIN UNNEST(%(edge_child_ids)s::bigint[], %(edge_parent_ids)s::bigint[])
+            e(child_id, parent_id)
+            ON e.child_id = t.id
+            AND e.parent_id = c.id
+        WHERE e.child_id IS NULL
+        UNION ALL
+        SELECT 'links', l.treenode_id
+        FROM UNNEST(%(link_set_ids)s::bigint[]) s(id)
+        JOIN treenode_connector l
+            ON l.treenode_id = s.id
+        LEFT JOIN UNNEST(%(link_owner_ids)s::bigint[], %(link_ids)s::bigint[])
+            e(owner_id, id)
+            ON e.owner_id = s.id
+            AND e.id = l.id
+        WHERE e.id IS NULL
+        UNION ALL
+        SELECT 'c_links', l.connector_id
+        FROM UNNEST(%(c_link_set_ids)s::bigint[]) s(id)
+        JOIN treenode_connector l
+            ON l.connector_id = s.id
+        LEFT JOIN UNNEST(%(link_owner_ids)s::bigint[], %(link_ids)s::bigint[])
+            e(owner_id, id)
+            ON e.owner_id = s.id
+            AND e.id = l.id
+        WHERE e.id IS NULL
     """
-    is_child = """
-        SELECT 1 FROM treenode t
-        WHERE t.id = %s AND t.parent_id = %s
-    """
-    is_root = """
-        SELECT 1 FROM treenode t
-        WHERE t.parent_id IS NULL AND t.id = %s
-    """
-    all_children = """
-        SELECT CASE WHEN sub.c=0 THEN 1 ELSE 0 END FROM (
-            SELECT COUNT(*) FROM treenode t %s WHERE t.parent_id = %s %s
-        ) sub(c)
-    """
-    all_links = """
-        SELECT CASE WHEN sub.c=0 THEN 1 ELSE 0 END FROM (
-            SELECT COUNT(*) FROM treenode_connector l %s WHERE l.treenode_id = %s %s
-        ) sub(c)
-    """
-    all_links_c = """
-        SELECT CASE WHEN sub.c=0 THEN 1 ELSE 0 END FROM (
-            SELECT COUNT(*) FROM treenode_connector l %s WHERE l.connector_id = %s %s
-        ) sub(c)
-    """
-
-    @staticmethod
-    def edited(table):
-        return """
-            SELECT 1 FROM {} t
-            WHERE t.id = %s
-            AND t.edition_time >=(%s::timestamptz - '1 ms'::interval)
-            AND t.edition_time < (%s::timestamptz + '1 ms'::interval)
-        """.format(table)
-
-class StateCheck:
-    """A simple wraper arround state check SQL and parameters for it"""
-
-    def __init__(self, sql, params):
-        if type(sql) not in (str, unicode):
-            raise ValueError("No SQL string")
-        self.sql = sql
-        self.params = params if type(params) in (list, tuple) else (params,)
-
-    def __str__(self):
-        return "SQL: {} Parameters: {}".format(self.sql, self.params)
-
-def make_all_children_query(child_ids, node_id):
-    if child_ids:
-        table_sql, table_args = list_to_table(child_ids, 1)
-        args = table_args
-        child_query = " LEFT JOIN {} p(id) ON t.id = p.id ".format(table_sql)
-        constraints = "AND p.id IS NULL"
-        args.append(node_id)
-        return StateCheck(SQL.all_children % (child_query, "%s", constraints), args)
-    else:
-        return StateCheck(SQL.all_children % ("", "%s", ""), [node_id])
-
-def make_all_links_query(link_ids, node_id, is_connector=False):
-    template = SQL.all_links_c if is_connector else SQL.all_links
-    if link_ids:
-        table_sql, table_args = list_to_table(link_ids, 1)
-        args = table_args
-        link_query = " LEFT JOIN {} p(id) ON l.id = p.id ".format(table_sql)
-        constraints = "AND p.id IS NULL"
-        args.append(node_id)
-        return StateCheck(template % (link_query, "%s", constraints), args)
-    else:
-        return StateCheck(template % ("", "%s", ""), [node_id])
-
-def list_to_table(l, n=1):
-    args = None
-    if n == 1:
-        args = [(e,) for e in l]
-    elif n == 2:
-        args = [(e[0], e[1]) for e in l]
-    if not args:
-        raise ValueError("Could't parse list argument in state check")
 
-    records_list_template = ','.join(['%s'] * len(args))
-    return ("(VALUES {0})".format(records_list_template), args)
+class StateChecks:
+    """Collects the expected state of multiple nodes, so that all of it can
+    be checked at once."""
+
+    def __init__(self):
+        # Expected (id, edition_time) of nodes and connectors
+        self.nodes = []
+        # Expected (id, edition_time) of links, owned by a treenode or
+        # connector: (owner_id, id, edition_time)
+        self.links = []
+        # Expected (child_id, parent_id) edges
+        self.edges = []
+        # Nodes that are expected to be root
+        self.roots = []
+        # Nodes whose expected children are all children
+        self.child_sets = []
+        # Treenodes and connectors whose expected links are all links
+        self.link_sets = []
+        self.c_link_sets = []
+
+    def __len__(self):
+        return len(self.nodes) + len(self.links) + len(self.edges) + \
+                len(self.roots) + len(self.child_sets) + \
+                len(self.link_sets) + len(self.c_link_sets)
+
+    def params(self):
+        return {
+            'node_ids': [n[0] for n in self.nodes],
+            'node_times': [n[1] for n in self.nodes],
+            'link_owner_ids': [l[0] for l in self.links],
+            'link_ids': [l[1] for l in self.links],
+            'link_times': [l[2] for l in self.links],
+            'edge_child_ids': [e[0] for e in self.edges],
+            'edge_parent_ids': [e[1] for e in self.edges],
+            'root_ids': self.roots,
+            'child_set_ids': self.child_sets,
+            'link_set_ids': self.link_sets,
+            'c_link_set_ids': self.c_link_sets,
+        }
 
 def has_only_truthy_values(element, n=2):
     return n == len(element) and all(element)
@@ -156,24 +182,23 @@ def parse_state(state):
 
 def collect_state_checks(node_id, state, cursor, node=False,
         parent_edittime=False, is_parent=False, children=False,
-        links=False, c_links=False, multinode=False):
-    """Collect state checks for a single node, but don't execute them.
+        links=False, c_links=False, multinode=False, state_checks=None):
+    """Collect state checks for a single node, but don't execute them. They are
+    added to <state_checks>, if passed in, and returned.
 
     If <children> is a list of node IDs, only these nodes will be checked if
     they are valid children. If <children> is the boolean True, a state check is
     added that tests if the state provided children represent *all* children.
     """
-    state_checks = []
+    if state_checks is None:
+        state_checks = StateChecks()
 
     if node:
         if 'edition_time' not in state:
             raise ValueError("No valid state provided, missing edition time")
-        node = [node_id, state['edition_time']]
 
         # Make sure the node itself is valid
-        state_checks = [StateCheck(SQL.was_edited, (node[0], node[1], node[1]))]
-    else:
-        node = [node_id]
+        state_checks.nodes.append((node_id, state['edition_time']))
 
     if parent_edittime or is_parent:
         parent = state.get('parent')
@@ -192,11 +217,10 @@ def collect_state_checks(node_id, state, cursor, node=False,
             if is_parent:
                 if parent_id == node_id:
                     raise ValueError("No valid state provided, parent is same as node ({})".format(parent_id))
-                state_checks.append(StateCheck(SQL.is_parent, (parent_id, node_id)))
-            state_checks.append(StateCheck(SQL.was_edited,
-                (parent_id, parent[1], parent[1])))
+                state_checks.edges.append((node_id, parent_id))
+            state_checks.nodes.append((parent_id, parent[1]))
         else:
-            state_checks.append(StateCheck(SQL.is_root, (node_id,)))
+            state_checks.roots.append(node_id)
 
     if children:
         child_nodes = state.get('children')
@@ -206,10 +230,9 @@ def collect_state_checks(node_id, state, cursor, node=False,
             raise ValueError("No valid state provided, invalid children")
 
         if type(children) == bool:
-            state_checks.append(make_all_children_query(
-                [int(c[0]) for c in child_nodes], node_id))
-        state_checks.extend(StateCheck(SQL.was_edited, (c[0], c[1], c[1])) for c in child_nodes)
-        state_checks.extend(StateCheck(SQL.is_child, (c[0], node_id)) for c in child_nodes)
+            state_checks.child_sets.append(node_id)
+        state_checks.nodes.extend((c[0], c[1]) for c in child_nodes)
+        state_checks.edges.extend((c[0], node_id) for c in child_nodes)
 
     if links:
         links = state.get('links')
@@ -218,10 +241,8 @@ def collect_state_checks(node_id, state, cursor, node=False,
         if not all(has_only_truthy_values(e) for e in links):
             raise ValueError("No valid state provided, invalid links")
 
-        state_checks.append(make_all_links_query(
-            [int(l[0]) for l in links], node_id))
-        state_checks.extend(StateCheck(SQL.edited('treenode_connector'),
-            (l[0], l[1], l[1])) for l in links)
+        state_checks.link_sets.append(node_id)
+        state_checks.links.extend((node_id, l[0], l[1]) for l in links)
 
     if c_links:
         c_links = state.get('c_links')
@@ -230,11 +251,8 @@ def collect_state_checks(node_id, state, cursor, node=False,
         if not all(has_only_truthy_values(e) for e in c_links):
             raise ValueError("No valid state provided, invalid links")
 
-        state_checks.append(make_all_links_query(
-            [int(l[0]) for l in c_links], node_id, True))
-        state_checks.extend(StateCheck(SQL.edited('treenode_connector'),
-            (l[0], l[1], l[1])) for l in c_links)
-
+        state_checks.c_link_sets.append(node_id)
+        state_checks.links.extend((node_id, l[0], l[1]) for l in c_links)
 
     return state_checks
 
@@ -271,7 +289,9 @@ def validate_state(node_ids, state, node=False, is_parent=False,
     children = children or neighborhood
     links = links or neighborhood
 
-    # Collect state checks and test them, if state checks are not disabled
+    # Collect state checks and test them, if state checks are not disabled.
+    # Locks are acquired in the same round trip, before the checks are made.
+    lock_ids = node_ids if lock else None
     if not is_disabled(state):
         cursor = cursor or connection.cursor()
         if multinode:
@@ -285,36 +305,29 @@ def validate_state(node_ids, state, node=False, is_parent=False,
             if len(unseen) > 0:
                 raise ValueError("Couldn't find state info on node(s) {}".format(
                     ", ".join(str(n) for n in unseen)))
-            state_checks = []
-            for node_state in state:
-                state_checks.append(StateCheck(SQL.was_edited,
-                    (node_state[0], node_state[1], node_state[1])))
-            check_state(state, state_checks, cursor)
+            state_checks = StateChecks()
+            state_checks.nodes.extend((n[0], n[1]) for n in state)
         else:
-            check_sets = [collect_state_checks(n, state, cursor, node=node,
-                    is_parent=is_parent, parent_edittime=parent_edittime,
-                    multinode=multinode, children=children, links=links,
-                    c_links=c_links) for n in node_ids]
-            state_checks = reduce(lambda x: x + y, check_sets)
-            check_state(state, state_checks, cursor)
-
-    # Acquire lock on treenode
-    if lock:
+            state_checks = StateChecks()
+            for n in node_ids:
+                collect_state_checks(n, state, cursor, node=node,
+                        is_parent=is_parent, parent_edittime=parent_edittime,
+                        multinode=multinode, children=children, links=links,
+                        c_links=c_links, state_checks=state_checks)
+        check_state(state, state_checks, cursor, lock_ids)
+    elif lock:
+        # Acquire lock on treenodes
         cursor = cursor or connection.cursor()
         lock_nodes(node_ids, cursor)
 
 def lock_node(node_id, cursor):
-    cursor.execute("""
-        SELECT id FROM treenode WHERE id=%s FOR UPDATE
-    """, (node_id,))
-    result = cursor.fetchall()
+    lock_nodes((node_id,), cursor)
 
 def lock_nodes(node_ids, cursor):
+    """Lock all passed in treenodes for update. Nodes are locked in order of
+    their ID to avoid dead locks between concurrent requests."""
     if node_ids:
-        node_template = ",".join(("%s",) * len(node_ids))
-        cursor.execute("""
-            SELECT id FROM treenode WHERE id IN ({}) FOR UPDATE
-        """.format(node_template), node_ids)
+        cursor.execute(SQL.lock_nodes, {'lock_ids': list(node_ids)})
     else:
         raise ValueError("No nodes to lock")
 
@@ -331,24 +344,29 @@ def make_nocheck_state(parsed=False):
         state = json.dumps(state)
     return state
 
-def check_state(state, state_checks, cursor):
-    """Raise an error if state checks can't be passed."""
+def check_state(state, state_checks, cursor, lock_ids=None):
+    """Raise an error if state checks can't be passed. All checks are made
+    with a single query. If <lock_ids> are passed in, these treenodes are
+    locked in the same round trip to the database, before the checks are
+    made."""
+    if lock_ids is not None and not lock_ids:
+        raise ValueError("No nodes to lock")
+
     # Skip actual tests if state checking is disabled in state
     if is_disabled(state):
+        if lock_ids:
+            lock_nodes(lock_ids, cursor)
         return
 
-    sql_checks = [sc.sql for sc in state_checks]
-    args = []
-    for sc in state_checks:
-        args.extend(p for p in sc.params)
-
-    if sql_checks:
-        cursor.execute("(" + ") INTERSECT (".join(sql_checks) + ")", args)
-    else:
-        cursor.execute("SELECT 1")
-    state_check_results = cursor.fetchall()
-
-    # Expect results to have a length of the number of checks made and that
-    # each result equals one.
-    if not state_check_results or 1 != len(state_check_results) or 1 != state_check_results[0][0]:
-        raise StateMatchingError("The provided state differs from the database state", state)
+    params = state_checks.params()
+    params['lock_ids'] = list(lock_ids or [])
+    sql = SQL.mismatches
+    if lock_ids:
+        sql = SQL.lock_nodes + sql
+    cursor.execute(sql, params)
+    mismatches = cursor.fetchall()
+
+    if mismatches:
+        raise StateMatchingError("The provided state differs from the "
+                "database state ({})".format(", ".join("{} of {}".format(*m)
+                for m in mismatches)), state, mismatches)
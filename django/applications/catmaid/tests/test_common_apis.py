@@ -864,6 +864,52 @@ class ViewPageTests(TestCase):
         parsed_response = json.loads(response.content)
         self.assertEqual(expected_result, parsed_response)
 
+    def test_stats_user_activity(self):
+        self.fake_authentication()
+        url = '/%d/stats/user-activity' % (self.test_project_id,)
+        response = self.client.get(url, {'username': 'test2',
+                'format': 'columnar'})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual('columnar', parsed_response['format'])
+        self.assertEqual(89, len(parsed_response['skeleton_nodes']))
+        # Deltas of sorted time stamps are never negative
+        self.assertTrue(all(d >= 0 for d in parsed_response['skeleton_nodes'][1:]))
+
+        # Decode time stamps and make sure a histogram of the same data
+        # matches.
+        timestamps = {}
+        for key in ('skeleton_nodes', 'presynaptic', 'postsynaptic'):
+            decoded, last = [], 0
+            for d in parsed_response[key]:
+                last += d
+                decoded.append(last)
+            timestamps[key] = decoded
+
+        bin_size = 86400
+        response = self.client.get(url, {'username': 'test2',
+                'format': 'histogram', 'bin_size': bin_size})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(bin_size, parsed_response['bin_size'])
+        for key, decoded in timestamps.iteritems():
+            expected_bins = {}
+            for ts in decoded:
+                b = (ts // 1000) // bin_size * bin_size
+                expected_bins[b] = expected_bins.get(b, 0) + 1
+            histogram = parsed_response[key]
+            self.assertEqual(sum(histogram['counts']), len(decoded))
+            self.assertEqual(expected_bins,
+                    dict(zip(histogram['bins'], histogram['counts'])))
+
+        # Only return entries after a particular point in time
+        last_node = timestamps['skeleton_nodes'][-1]
+        response = self.client.get(url, {'username': 'test2',
+                'format': 'columnar', 'since': (last_node + 1) / 1000.0})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual([], parsed_response['skeleton_nodes'])
+
     def test_list_treenode_table_simple(self):
         self.fake_authentication()
         response = self.client.post(
@@ -2142,6 +2188,139 @@ class ViewPageTests(TestCase):
             child_after_change = get_object_or_404(Treenode, id=child.id)
             self.assertEqual(parent, child_after_change.parent)
 
+    def test_treenode_batch(self):
+        self.fake_authentication()
+        operations = [
+            # A new skeleton with two nodes
+            {'type': 'create', 'id': 'a', 'x': 1, 'y': 2, 'z': 3},
+            {'type': 'create', 'id': 'b', 'x': 4, 'y': 5, 'z': 6,
+             'parent_id': 'a', 'radius': 2},
+            # A node inserted between 239 and its child 241
+            {'type': 'create', 'id': 'c', 'x': 7, 'y': 8, 'z': 9,
+             'parent_id': 239, 'child_ids': [241]},
+            {'type': 'move', 'id': 237, 'x': 10, 'y': 11, 'z': 12},
+            {'type': 'radius', 'id': 'a', 'radius': 3},
+            {'type': 'link', 'treenode_id': 'b', 'connector_id': 2458,
+             'relation': 'presynaptic_to'},
+            # Node 407 is connected to 377 and skeleton 2388 is removed
+            {'type': 'delete', 'id': 405},
+            {'type': 'delete', 'id': 2392},
+            {'type': 'delete', 'id': 2394},
+            {'type': 'delete', 'id': 2396},
+        ]
+        response = self.client.post(
+                '/%d/treenodes/batch' % self.test_project_id,
+                {'operations': json.dumps(operations),
+                 'state': make_nocheck_state()})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        id_map = parsed_response['id_map']
+        self.assertEqual(['a', 'b', 'c'], sorted(id_map.keys()))
+
+        a = Treenode.objects.get(id=id_map['a'])
+        b = Treenode.objects.get(id=id_map['b'])
+        c = Treenode.objects.get(id=id_map['c'])
+        self.assertEqual([[a.skeleton_id, ClassInstanceClassInstance.objects.get(
+                class_instance_a=a.skeleton_id).class_instance_b_id]],
+                parsed_response['created_skeletons'])
+        self.assertEqual(None, a.parent_id)
+        self.assertEqual(3, a.radius)
+        self.assertEqual(a.id, b.parent_id)
+        self.assertEqual(a.skeleton_id, b.skeleton_id)
+        self.assertTreenodeHasProperties(c.id, 239, 235)
+        self.assertTreenodeHasProperties(241, c.id, 235)
+        self.assertEqual((10, 11, 12), Treenode.objects.filter(id=237) \
+                .values_list('location_x', 'location_y', 'location_z')[0])
+        link = TreenodeConnector.objects.get(connector_id=2458, treenode_id=b.id)
+        self.assertEqual(b.skeleton_id, link.skeleton_id)
+
+        self.assertEqual([405, 2392, 2394, 2396],
+                sorted(parsed_response['deleted_nodes']))
+        self.assertTreenodeHasProperties(407, 377, 373)
+        self.assertEqual([2388], parsed_response['deleted_skeletons'])
+        self.assertEqual([2389], parsed_response['deleted_neurons'])
+        self.assertFalse(ClassInstance.objects.filter(id__in=[2388, 2389]).exists())
+
+        # Nothing is written if one operation fails
+        node_count = Treenode.objects.count()
+        response = self.client.post(
+                '/%d/treenodes/batch' % self.test_project_id,
+                {'operations': json.dumps([
+                    {'type': 'create', 'id': 'd', 'x': 1, 'y': 2, 'z': 3},
+                    {'type': 'delete', 'id': 377}]),
+                 'state': make_nocheck_state()})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('error', json.loads(response.content))
+        self.assertEqual(node_count, Treenode.objects.count())
+
+        # A state is only optional if no existing node is referenced
+        response = self.client.post(
+                '/%d/treenodes/batch' % self.test_project_id,
+                {'operations': json.dumps([
+                    {'type': 'create', 'id': 'e', 'x': 1, 'y': 2, 'z': 3}])})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('e', json.loads(response.content)['id_map'])
+        response = self.client.post(
+                '/%d/treenodes/batch' % self.test_project_id,
+                {'operations': json.dumps([
+                    {'type': 'move', 'id': 237, 'x': 1, 'y': 2, 'z': 3}])})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('error', json.loads(response.content))
+
+    def test_delete_treenodes(self):
+        self.fake_authentication()
+        Review.objects.create(project_id=self.test_project_id, reviewer_id=3,
+                skeleton_id=235, treenode_id=285)
+
+        # Delete two nodes of a path, the child of the lower one is connected
+        # to the parent of the upper one.
+        response = self.client.post(
+                '/%d/treenodes/delete' % self.test_project_id,
+                {'treenode_ids': [239, 241], 'state': make_nocheck_state()})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        nodes = {n['id']: n for n in parsed_response['nodes']}
+        self.assertEqual([239, 241], sorted(nodes.keys()))
+        self.assertEqual(237, nodes[239]['parent_id'])
+        self.assertEqual([], nodes[239]['children'])
+        self.assertEqual([243], [c[0] for c in nodes[241]['children']])
+        self.assertEqual([], parsed_response['deleted_skeletons'])
+        self.assertTreenodeHasProperties(243, 237, 235)
+
+        # Delete a subtree with connector links and reviews
+        response = self.client.post(
+                '/%d/treenodes/delete' % self.test_project_id,
+                {'treenode_ids': [263], 'include_subtrees': 'true',
+                 'state': make_nocheck_state()})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        nodes = {n['id']: n for n in parsed_response['nodes']}
+        self.assertEqual(sorted([263, 265, 267, 269, 271, 273, 275, 277, 279,
+                281, 283, 285, 289, 415, 417]), sorted(nodes.keys()))
+        self.assertEqual([360], [l[0] for l in nodes[285]['links']])
+        self.assertEqual([425], [l[0] for l in nodes[415]['links']])
+        self.assertEqual(11, Treenode.objects.filter(skeleton_id=235).count())
+        self.assertEqual([437], list(TreenodeConnector.objects.filter(
+                skeleton_id=235).values_list('id', flat=True)))
+        self.assertFalse(Review.objects.filter(treenode_id=285).exists())
+
+        # Root nodes can only be deleted along with all their children
+        response = self.client.post(
+                '/%d/treenodes/delete' % self.test_project_id,
+                {'treenode_ids': [2392], 'state': make_nocheck_state()})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('error', json.loads(response.content))
+        self.assertTrue(Treenode.objects.filter(id=2392).exists())
+
+        response = self.client.post(
+                '/%d/treenodes/delete' % self.test_project_id,
+                {'treenode_ids': [2392], 'include_subtrees': 'true',
+                 'state': make_nocheck_state()})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual([2388], parsed_response['deleted_skeletons'])
+        self.assertEqual([2389], parsed_response['deleted_neurons'])
+
     def test_search_with_no_nodes(self):
         self.fake_authentication()
 
@@ -2302,6 +2481,10 @@ class ViewPageTests(TestCase):
         self.fake_authentication()
 
         new_root = 407
+        # Edge confidences are stored on the child node and need to move
+        # along with the reversed edges.
+        Treenode.objects.filter(id=407).update(confidence=2)
+        Treenode.objects.filter(id=405).update(confidence=3)
 
         count_logs = lambda: Log.objects.all().count()
         log_count = count_logs()
@@ -2323,6 +2506,10 @@ class ViewPageTests(TestCase):
         assertHasParent(377, 405)
         assertHasParent(407, None)
 
+        confidences = dict(Treenode.objects.filter(id__in=(377, 405, 407)) \
+                .values_list('id', 'confidence'))
+        self.assertEqual({377: 3, 405: 2, 407: 5}, confidences)
+
     def assertTreenodeHasProperties(self, treenode_id, parent_id, skeleton_id):
         treenode = get_object_or_404(Treenode, id=treenode_id)
         self.assertEqual(parent_id, treenode.parent_id)
@@ -2373,6 +2560,38 @@ class ViewPageTests(TestCase):
 
         self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=2405).skeleton_id)
 
+    def test_join_skeletons_with_reroot(self):
+        self.fake_authentication()
+
+        # Skeleton 373 is rerooted at 407 while it is joined
+        Treenode.objects.filter(id=407).update(confidence=2)
+        Treenode.objects.filter(id=405).update(confidence=3)
+
+        response = self.client.post(
+                '/%d/skeleton/join' % self.test_project_id, {
+                    'from_id': 2394,
+                    'to_id': 407})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        expected_result = {
+                'message': 'success',
+                'fromid': 2394,
+                'result_skeleton_id': 2388,
+                'deleted_skeleton_id': 373,
+                'toid': 407}
+        self.assertEqual(expected_result, parsed_response)
+
+        self.assertTreenodeHasProperties(407, 2394, 2388)
+        self.assertTreenodeHasProperties(405, 407, 2388)
+        self.assertTreenodeHasProperties(377, 405, 2388)
+        confidences = dict(Treenode.objects.filter(id__in=(377, 405, 407)) \
+                .values_list('id', 'confidence'))
+        self.assertEqual({377: 3, 405: 2, 407: 5}, confidences)
+        self.assertEqual(3, Treenode.objects.get(id=407).editor_id)
+
+        self.assertEqual(0, ClassInstance.objects.filter(id=373).count())
+        self.assertEqual(0, TreenodeConnector.objects.filter(skeleton=373).count())
+
     def test_import_skeleton(self):
         self.fake_authentication()
 
@@ -2399,6 +2618,41 @@ class ViewPageTests(TestCase):
             self.assertEqual(tn.location_z, new_tn.location_z)
             self.assertEqual(max(tn.radius, 0), max(new_tn.radius, 0))
 
+    def test_import_multiple_skeletons(self):
+        self.fake_authentication()
+
+        swc_a = '# Comment\n1 0 10 20 30 -1 -1\n2 0 11 21 31 2 1\n3 0 12 22 32 3 1\n'
+        swc_b = '5 0 1 2 3 4 7\n7 0 4 5 6 -1 -1\n'
+        response = self.client.post('/%d/skeletons/import' % (self.test_project_id,),
+                                    {'file.swc': [StringIO.StringIO(swc_a),
+                                              StringIO.StringIO(swc_b)]})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        skeletons = parsed_response['skeletons']
+        self.assertEqual(2, len(skeletons))
+        self.assertNotEqual(skeletons[0]['neuron_id'], skeletons[1]['neuron_id'])
+
+        id_map = skeletons[0]['node_id_map']
+        self.assertTreenodeHasProperties(id_map['1'], None, skeletons[0]['skeleton_id'])
+        self.assertTreenodeHasProperties(id_map['2'], id_map['1'], skeletons[0]['skeleton_id'])
+        self.assertTreenodeHasProperties(id_map['3'], id_map['1'], skeletons[0]['skeleton_id'])
+        node = Treenode.objects.get(id=id_map['3'])
+        self.assertEqual((12, 22, 32, 3), (node.location_x, node.location_y,
+                node.location_z, node.radius))
+
+        id_map = skeletons[1]['node_id_map']
+        self.assertTreenodeHasProperties(id_map['7'], None, skeletons[1]['skeleton_id'])
+        self.assertTreenodeHasProperties(id_map['5'], id_map['7'], skeletons[1]['skeleton_id'])
+
+        # Nodes that don't form a tree are rejected
+        swc_cycle = '1 0 1 2 3 -1 -1\n2 0 1 2 3 -1 3\n3 0 1 2 3 -1 2\n'
+        response = self.client.post('/%d/skeletons/import' % (self.test_project_id,),
+                                    {'file.swc': [StringIO.StringIO(swc_cycle)]})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual('SWC skeleton is malformed: it contains a cycle.',
+                parsed_response['error'])
+
     def test_skeleton_contributor_statistics(self):
         self.fake_authentication()
 
@@ -2468,6 +2722,35 @@ class ViewPageTests(TestCase):
                 "error": "Can't split at the root node: it doesn't have a parent."}
         self.assertEqual(expected_result, parsed_response)
 
+    def test_split_skeleton_subtree(self):
+        self.fake_authentication()
+
+        # Split skeleton 235 at the first node of a branch that contains
+        # another branch point, connector links and a review.
+        old_skeleton_id = 235
+        Review.objects.create(project_id=self.test_project_id, reviewer_id=3,
+                skeleton_id=old_skeleton_id, treenode_id=285)
+        response = self.client.post(
+            '/%d/skeleton/split' % (self.test_project_id,),
+            {'treenode_id': 263, 'upstream_annotation_map': '{}', 'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        new_skeleton_id = parsed_response['new_skeleton_id']
+
+        downstream = [263, 265, 267, 269, 271, 273, 275, 277, 279, 281, 283,
+                285, 289, 415, 417]
+        self.assertTreenodeHasProperties(263, None, new_skeleton_id)
+        self.assertEqual(sorted(downstream), sorted(Treenode.objects.filter(
+                skeleton_id=new_skeleton_id).values_list('id', flat=True)))
+        self.assertEqual(13, Treenode.objects.filter(
+                skeleton_id=old_skeleton_id).count())
+        self.assertEqual([360, 425], sorted(TreenodeConnector.objects.filter(
+                skeleton_id=new_skeleton_id).values_list('id', flat=True)))
+        self.assertEqual([437], list(TreenodeConnector.objects.filter(
+                skeleton_id=old_skeleton_id).values_list('id', flat=True)))
+        self.assertEqual(new_skeleton_id,
+                Review.objects.get(treenode_id=285).skeleton_id)
+
     def test_split_skeleton_annotations(self):
         self.fake_authentication()
 
@@ -4134,6 +4417,34 @@ class ViewPageTests(TestCase):
         expected_result = {'2388': [3, 1]}
         self.assertJSONEqual(response.content, expected_result)
 
+    def test_batch_review(self):
+        self.fake_authentication()
+
+        skeleton_id = 2388
+        url = '/%d/nodes/reviewed' % (self.test_project_id,)
+        response = self.client.post(url, {'treenode_ids[0]': 2394,
+                'treenode_ids[1]': 2396})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(self.test_user_id, parsed_response['reviewer_id'])
+        self.assertItemsEqual([2394, 2396], parsed_response['reviewed_nodes'])
+        self.assertEqual({'2388': [3, 2]}, parsed_response['review_status'])
+        self.assertEqual(2, Review.objects.filter(skeleton_id=skeleton_id,
+                reviewer_id=self.test_user_id).count())
+
+        # Reviewing a node again only updates the existing review
+        first_review_time = Review.objects.get(treenode_id=2396,
+                reviewer_id=self.test_user_id).review_time
+        response = self.client.post(url, {'treenode_ids[0]': 2396,
+                'treenode_ids[1]': 2392})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual({'2388': [3, 3]}, parsed_response['review_status'])
+        self.assertEqual(3, Review.objects.filter(skeleton_id=skeleton_id,
+                reviewer_id=self.test_user_id).count())
+        review = Review.objects.get(treenode_id=2396, reviewer_id=self.test_user_id)
+        self.assertTrue(review.review_time > first_review_time)
+
     def test_export_review_skeleton(self):
         self.fake_authentication()
 
@@ -4165,18 +4476,16 @@ class ViewPageTests(TestCase):
                 {'y': 6080.0, 'x': 2370.0, 'z': 0.0, 'rids': [], 'sup': [], 'id': 2392}]}]
         self.assertJSONEqual(response.content, expected_result)
 
-        # Newer reviews of same nodes should duplicate reviewer ID
-        # NOTE: this duplication does not happen in practice because
-        # update_location_reviewer updates the timestamp of the existing
-        # review. This is just to demonstrate what edge case behavior is.
+        # Newer reviews of same nodes update the existing review, a reviewer
+        # can only review a node once.
         review_time = "2014-03-18T00:00:00Z"
-        Review.objects.create(project_id=self.test_project_id, reviewer_id=2,
-            review_time=review_time, skeleton_id=skeleton_id, treenode_id=2396)
-        Review.objects.create(project_id=self.test_project_id, reviewer_id=3,
-            review_time=review_time, skeleton_id=skeleton_id, treenode_id=2394)
+        Review.objects.filter(reviewer_id=2, treenode_id=2396).update(
+                review_time=review_time)
+        Review.objects.filter(reviewer_id=3, treenode_id=2394).update(
+                review_time=review_time)
         response = self.client.post(url)
-        expected_result[0]['sequence'][0]['rids'].append([2, review_time])
-        expected_result[0]['sequence'][1]['rids'].append([3, review_time])
+        expected_result[0]['sequence'][0]['rids'][1][1] = review_time
+        expected_result[0]['sequence'][1]['rids'][0][1] = review_time
         self.assertEqual(response.status_code, 200)
         self.assertJSONEqual(response.content, expected_result)
 
@@ -4390,6 +4699,46 @@ class ViewPageTests(TestCase):
             self.assertItemsEqual(parsed_response[3][k], v)
 
 
+    def test_transaction_paging(self):
+        self.fake_authentication()
+
+        # Two transactions share the same execution time
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO catmaid_transaction_info (transaction_id,
+                execution_time, user_id, project_id, change_type, label)
+            SELECT t.id, '2016-01-01T00:00:00Z'::timestamptz +
+                (least(t.id, 4) || ' minutes')::interval, 3, %s, 'Backend',
+                'tests.paging'
+            FROM generate_series(1, 5) t(id)
+        """, (self.test_project_id,))
+
+        transaction_ids = []
+        params = {'label': 'tests.paging', 'range_length': 2}
+        while True:
+            response = self.client.get('/%d/transactions/' % self.test_project_id,
+                    params)
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content)
+            self.assertEqual(5, parsed_response['total_count'])
+            transaction_ids.extend(t['transaction_id']
+                    for t in parsed_response['transactions'])
+            if not parsed_response['next_cursor']:
+                break
+            params['cursor'] = parsed_response['next_cursor']
+        self.assertEqual([5, 4, 3, 2, 1], transaction_ids)
+
+        response = self.client.get('/%d/transactions/' % self.test_project_id, {
+            'label': 'tests.paging',
+            'start_date': '2016-01-01T00:02:00Z',
+            'end_date': '2016-01-01T00:03:00Z',
+            'count': 'none'})
+        parsed_response = json.loads(response.content)
+        self.assertEqual([3, 2], [t['transaction_id']
+                for t in parsed_response['transactions']])
+        self.assertEqual(None, parsed_response['total_count'])
+        self.assertEqual(None, parsed_response['next_cursor'])
+
 class TreenodeTests(TestCase):
     fixtures = ['catmaid_testdata']
 
@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+
+from cStringIO import StringIO
+
+import numpy as np
+from PIL import Image
+
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from catmaid.control.cropping import TiffWriter, blit_image_part, \
+        get_rot90_count, ImagePart, CropJob, estimate_crop_size, \
+        schedule_crop_job, decode_tile, decode_tile_region, \
+        get_single_tile_part, process_crop_job, dispatch_crop_jobs, \
+        schedule_job, is_small_crop_job
+from catmaid.models import CroppingJob, Stack
+
+
+class CroppingTests(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rot90_count(self):
+        self.assertEqual(0, get_rot90_count(0.0))
+        self.assertEqual(1, get_rot90_count(90.0))
+        self.assertEqual(2, get_rot90_count(180.0))
+        self.assertEqual(3, get_rot90_count(270.0))
+        self.assertEqual(None, get_rot90_count(45.0))
+
+    def test_blit_image_part(self):
+        tile = np.arange(25, dtype=np.uint8).reshape(5, 5, 1)
+        target = np.zeros((2, 3, 1), dtype=np.uint8)
+        # A 3x2 part starting at (2, 1) in the tile, written to (1, 0). The
+        # part doesn't fit into the target completely.
+        ip = ImagePart('tile', 2, 5, 1, 3, 1, 0)
+        blit_image_part(target, ip, tile)
+        self.assertEqual([[0, 7, 8], [0, 12, 13]], target[:, :, 0].tolist())
+
+    def test_single_tile_fast_path(self):
+        class BB: pass
+        bb = BB()
+        bb.width, bb.height = 3, 2
+        ip = ImagePart('tile', 2, 5, 1, 3, 0, 0)
+        self.assertEqual(ip, get_single_tile_part(bb, [ip]))
+        self.assertEqual(None, get_single_tile_part(bb,
+                [ip, ImagePart('tile', 0, 1, 0, 1, 3, 0)]))
+        self.assertEqual(None, get_single_tile_part(bb,
+                [ImagePart('tile', 2, 5, 1, 3, 1, 0)]))
+
+        # The decoded region equals the region copied from the decoded tile,
+        # also if it isn't completely within the tile.
+        tile = np.random.randint(0, 255, (8, 10, 3)).astype(np.uint8)
+        buf = StringIO()
+        Image.fromarray(tile).save(buf, 'png')
+        img_data = buf.getvalue()
+        for ip in (ImagePart('tile', 2, 7, 1, 5, 0, 0),
+                   ImagePart('tile', 6, 12, 5, 11, 0, 0)):
+            for single_channel in (True, False):
+                expected = np.zeros((ip.height, ip.width,
+                        1 if single_channel else 3), dtype=np.uint8)
+                blit_image_part(expected, ip, decode_tile(img_data,
+                        single_channel))
+                self.assertEqual(expected.tolist(), decode_tile_region(
+                        img_data, ip, single_channel).tolist())
+
+    def test_streaming_tiff_writer(self):
+        path = os.path.join(self.tmp_dir, 'test.tiff')
+        pages = [np.random.randint(0, 255, (5, 7, 3)).astype(np.uint8),
+                 np.random.randint(0, 255, (5, 7, 3)).astype(np.uint8),
+                 np.rot90(np.random.randint(0, 255, (5, 7, 3)).astype(np.uint8))]
+        writer = TiffWriter(path, description="ImageJ=1.45p\nunit=nm\n",
+                software="Created with CATMAID", resolution=(0.25, 0.25))
+        expected_size = writer.get_file_size(
+                [(p.shape[1], p.shape[0], p.shape[2]) for p in pages])
+        writer.open()
+        for p in pages:
+            writer.write_page(p)
+        writer.close()
+
+        self.assertEqual(expected_size, os.path.getsize(path))
+        image = Image.open(path)
+        for n, p in enumerate(pages):
+            image.seek(n)
+            self.assertEqual(p.tolist(), np.asarray(image).tolist())
+
+        # Single channel images
+        path = os.path.join(self.tmp_dir, 'test-gray.tiff')
+        page = np.random.randint(0, 255, (4, 3, 1)).astype(np.uint8)
+        writer = TiffWriter(path)
+        writer.open()
+        writer.write_page(page)
+        writer.close()
+
+        self.assertEqual(writer.get_file_size([(3, 4, 1)]), os.path.getsize(path))
+        image = Image.open(path)
+        self.assertEqual('L', image.mode)
+        self.assertEqual(page[:, :, 0].tolist(), np.asarray(image).tolist())
+
+
+class CropSchedulingTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        self.user = User.objects.get(id=3)
+
+    def create_job(self, x_max=500, single_channel=True):
+        return CropJob(self.user, 3, [3], 0, x_max, 0, 250, 0, 18, 0, 0,
+                single_channel, '/tmp/crop_test.tiff')
+
+    def test_estimate_crop_size(self):
+        # 100 x 50 pixels in three sections of a single stack
+        self.assertEqual(15000, estimate_crop_size(self.create_job()))
+        self.assertEqual(45000, estimate_crop_size(self.create_job(
+            single_channel=False)))
+
+    @override_settings(CROPPING_MAX_JOBS_PER_USER=1)
+    def test_job_count_quota(self):
+        record = schedule_crop_job(self.create_job())
+        self.assertEqual('queued', record.status)
+        self.assertEqual(15000, record.estimated_size)
+        self.assertEqual(3, record.n_slices)
+        self.assertRaises(ValueError, schedule_crop_job, self.create_job())
+
+        # Finished jobs don't count
+        CroppingJob.objects.filter(id=record.id).update(status='finished')
+        schedule_crop_job(self.create_job())
+
+    @override_settings(CROPPING_MAX_ACTIVE_SIZE_PER_USER=20000)
+    def test_job_size_quota(self):
+        schedule_crop_job(self.create_job())
+        self.assertRaises(ValueError, schedule_crop_job, self.create_job())
+
+    @override_settings(CROPPING_MAX_JOBS_PER_USER=1, CROPPING_SMALL_JOB_SIZE=10)
+    def test_roi_images_skip_quotas(self):
+        schedule_crop_job(self.create_job())
+        record = schedule_job(self.user.id, 3, 'roi_images', {'roi_ids': [1]},
+                20000, 1, check_quotas=False)
+        self.assertEqual('roi_images', record.job_type)
+        self.assertTrue(is_small_crop_job(record.job_type, record.estimated_size))
+        self.assertFalse(is_small_crop_job('crop', record.estimated_size))
+
+        # ROI images don't count against the quotas of exports either
+        CroppingJob.objects.filter(job_type='crop').update(status='finished')
+        export = schedule_job(self.user.id, 3, 'treenode_export', {}, 100, 2)
+        self.assertEqual('treenode_export', export.job_type)
+        self.assertRaises(ValueError, schedule_job, self.user.id, 3,
+                'connector_export', {}, 100, 2)
+
+    def test_unexpected_errors_fail_job(self):
+        # Unsupported tile sources raise a StandardError
+        Stack.objects.filter(id=3).update(tile_source_type=2)
+        job = self.create_job()
+        record = schedule_crop_job(job)
+        job.record_id = record.id
+        self.assertNotEqual(None, process_crop_job(job, create_message=False))
+
+        record = CroppingJob.objects.get(id=record.id)
+        self.assertEqual('failed', record.status)
+        self.assertNotEqual('', record.error)
+        self.assertFalse(os.path.exists(job.output_path))
+
+    @override_settings(CROPPING_JOB_TIMEOUT=60)
+    def test_stale_jobs_fail(self):
+        stale = schedule_crop_job(self.create_job())
+        active = schedule_crop_job(self.create_job())
+        CroppingJob.objects.filter(id=stale.id).update(status='running',
+                edition_time=timezone.now() - timedelta(seconds=120))
+        CroppingJob.objects.filter(id=active.id).update(status='running')
+        dispatch_crop_jobs()
+
+        self.assertEqual('failed', CroppingJob.objects.get(id=stale.id).status)
+        self.assertEqual('running', CroppingJob.objects.get(id=active.id).status)
@@ -187,6 +187,8 @@ class HistoryTableTests(TransactionTestCase):
         'treenode_connector_edge',
         'connector_geom',
         'catmaid_transaction_info',
+        'cropping_job',
+        'catmaid_history_partition',
 
         # Regular unversioned non-CATMAID tables
         'djkombu_queue',
@@ -1092,3 +1094,101 @@ class HistoryTableTests(TransactionTestCase):
         expected_interval_2 = self.format_range(creation_time_2, truncate_timestamp)
         self.assertEqual(project_1_history_entry['sys_period'], expected_interval_1)
         self.assertEqual(project_2_history_entry['sys_period'], expected_interval_2)
+
+    def test_history_partitioning(self):
+        """Test if history rows are moved to and routed into a partition, can
+        still be queried through the history table and if chains of
+        consecutive versions in a partition can be compacted.
+        """
+        cursor = connection.cursor()
+
+        cursor.execute("""
+            INSERT INTO "class" (user_id, project_id, class_name)
+            VALUES (%(user_id)s, %(project_id)s, 'testclass')
+            RETURNING id, current_timestamp::text
+        """, {
+            'user_id': self.user.id,
+            'project_id': self.project.id
+        })
+        class_id, creation_time = cursor.fetchone()
+        transaction.commit()
+
+        cursor.execute("""
+            UPDATE "class" SET class_name='newname' WHERE id=%s
+        """, (class_id,))
+        transaction.commit()
+
+        try:
+            # Existing history rows are moved into the new partition
+            cursor.execute("""
+                SELECT create_history_partition('class'::regclass,
+                    current_timestamp - interval '1 day',
+                    current_timestamp + interval '1 day')::text
+            """)
+            partition_name = cursor.fetchone()[0]
+            transaction.commit()
+
+            cursor.execute("""
+                SELECT count(*) FROM ONLY class__history WHERE id = %s
+            """, (class_id,))
+            self.assertEqual(0, cursor.fetchone()[0])
+
+            # New history rows are routed into the partition
+            cursor.execute("""
+                UPDATE "class" SET class_name='newname2' WHERE id=%s
+            """, (class_id,))
+            transaction.commit()
+
+            cursor.execute("""
+                SELECT count(*) FROM {} WHERE id = %s
+            """.format(partition_name), (class_id,))
+            self.assertEqual(2, cursor.fetchone()[0])
+
+            # Point in time queries on the history table include partitions
+            cursor.execute("""
+                SELECT class_name FROM class__history
+                WHERE id = %s AND sys_period @> %s::timestamptz
+            """, (class_id, creation_time))
+            self.assertEqual([('testclass',)], cursor.fetchall())
+
+            # Both versions were valid for less than an hour and are merged
+            cursor.execute("""
+                SELECT compact_history(%s::regclass,
+                    current_timestamp + interval '1 day', interval '1 hour')
+            """, (partition_name,))
+            self.assertEqual(1, cursor.fetchone()[0])
+            transaction.commit()
+
+            cursor.execute("""
+                SELECT class_name, lower(sys_period) = %s::timestamptz
+                FROM class__history WHERE id = %s
+            """, (creation_time, class_id))
+            self.assertEqual([('newname', True)], cursor.fetchall())
+
+            # Detached partitions aren't part of the history anymore
+            cursor.execute("""
+                SELECT detach_history_partition(%s::regclass)
+            """, (partition_name,))
+            transaction.commit()
+            cursor.execute("""
+                SELECT count(*) FROM class__history WHERE id = %s
+            """, (class_id,))
+            self.assertEqual(0, cursor.fetchone()[0])
+
+            cursor.execute("""
+                SELECT drop_history_partition(%s::regclass)
+            """, (partition_name,))
+            transaction.commit()
+        finally:
+            # Don't leave partitions behind for other tests
+            cursor.execute("""
+                SELECT partition_table::text FROM catmaid_history_partition
+            """)
+            for row in cursor.fetchall():
+                cursor.execute("DROP TABLE {}".format(row[0]))
+            cursor.execute("""
+                DELETE FROM catmaid_history_partition;
+                DROP TRIGGER IF EXISTS on_insert_route_to_partition
+                    ON class__history;
+            """)
+            transaction.commit()
@@ -3,8 +3,11 @@ from django.contrib.auth.models import User
 from django.http.request import QueryDict
 from catmaid.control.common import get_request_list
 from catmaid.models import Project, Class, Relation, ClassInstance, \
-    ClassInstanceClassInstance
+    ClassInstanceClassInstance, Review
 from catmaid.control.neuron_annotations import delete_annotation_if_unused
+from catmaid.control.review import merge_treenode_reviews, \
+    get_packed_treenode_reviews
+from catmaid.control.skeletonexport import _skeleton_for_3d_viewer
 
 
 class InternalApiTestsNoDB(TestCase):
@@ -31,6 +34,21 @@ class InternalApiTestsNoDB(TestCase):
         self.assertEqual(get_request_list(q4, 'a'), [['1', '2', '3']])
         self.assertEqual(get_request_list(q4, 'a', map_fn=int), [[1, 2, 3]])
 
+    def test_treenode_review_merging(self):
+        treenodes = [(1, None), (2, 1), (4, 2), (7, 4)]
+        # Reviews can reference nodes that are not part of the treenode list
+        reviews = [(2, [3, 5]), (3, [1]), (7, [2])]
+        merged = list(merge_treenode_reviews(treenodes, reviews))
+        self.assertEqual(merged, [((1, None), []), ((2, 1), [3, 5]),
+                ((4, 2), []), ((7, 4), [2])])
+
+        reviews = [(4, [3, 5], ['t1', 't2'])]
+        merged = list(merge_treenode_reviews(treenodes, reviews, with_time=True))
+        self.assertEqual(merged, [((1, None), []), ((2, 1), []),
+                ((4, 2), [(3, 't1'), (5, 't2')]), ((7, 4), [])])
+
+        self.assertEqual(list(merge_treenode_reviews([], reviews)), [])
+
 class InternalApiTests(TestCase):
     fixtures = ['catmaid_testdata']
 
@@ -38,6 +56,31 @@ class InternalApiTests(TestCase):
         self.test_user = User.objects.get(username="test0")
         self.test_project = Project.objects.get(id=3)
 
+    def test_packed_treenode_reviews(self):
+        test2 = User.objects.get(username="test2")
+        for treenode_id, reviewer in ((253, self.test_user), (241, test2),
+                (253, test2), (2394, test2)):
+            Review.objects.create(project=self.test_project, reviewer=reviewer,
+                    skeleton_id=235 if treenode_id < 2000 else 2388,
+                    treenode_id=treenode_id)
+
+        # Reviews are read in batches from a server-side cursor
+        reviews = list(get_packed_treenode_reviews([235], batch_size=1))
+        self.assertEqual([(241, [test2.id]), (253, [self.test_user.id, test2.id])],
+                reviews)
+
+        reviews = list(get_packed_treenode_reviews([235, 2388], with_time=True))
+        self.assertEqual([241, 253, 2394], [r[0] for r in reviews])
+        self.assertEqual(2, len(reviews[1][2]))
+        self.assertEqual([], list(get_packed_treenode_reviews([])))
+
+        # Exported nodes carry their reviewers
+        name, nodes, tags, connectors = _skeleton_for_3d_viewer(235, 3)
+        reviewers = {n[0]: n[-1] for n in nodes}
+        self.assertEqual([test2.id], reviewers[241])
+        self.assertEqual([self.test_user.id, test2.id], reviewers[253])
+        self.assertEqual([], reviewers[237])
+
     def test_annotation_deletion(self):
         annotation_class = Class.objects.get(project=self.test_project,
                                              class_name='annotation')
@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from django.test import TestCase
+
+from catmaid.control.dvid import DVIDClient
+from catmaid.control.metadatacache import MetadataClient
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """ A local HTTP server that answers every request with a JSON document
+    after an optional delay and counts the requests per path.
+    """
+    daemon_threads = True
+
+    def __init__(self, documents, delay=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.documents = documents
+        self.delay = delay
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_port
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests[self.path] = \
+                    self.server.requests.get(self.path, 0) + 1
+        time.sleep(self.server.delay)
+        document = self.server.documents.get(self.path)
+        if document is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps(document)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetadataCacheTests(TestCase):
+
+    def start_server(self, documents, delay=0):
+        server = StandInServer(documents, delay)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_cached_requests(self):
+        server = self.start_server({'/stackIds': ['a', 'b']})
+        client = MetadataClient(ttl=60)
+        url = server.url + '/stackIds'
+        self.assertEqual(['a', 'b'], client.get_json(url))
+        self.assertEqual(['a', 'b'], client.get_json(url))
+        self.assertEqual(1, server.requests['/stackIds'])
+
+        # Expired entries are requested again
+        client = MetadataClient(ttl=0)
+        client.get_json(url)
+        client.get_json(url)
+        self.assertEqual(3, server.requests['/stackIds'])
+
+        self.assertRaises(ValueError, client.get_json, server.url + '/missing')
+
+    def test_request_coalescing(self):
+        server = self.start_server({'/stackIds': ['a']}, delay=0.2)
+        client = MetadataClient(ttl=60)
+        url = server.url + '/stackIds'
+        results = []
+        def fetch():
+            results.append(client.get_json(url))
+        threads = [threading.Thread(target=fetch) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([['a']] * 5, results)
+        self.assertEqual(1, server.requests['/stackIds'])
+
+    def test_dvid_client(self):
+        info = {
+            'repo1': {
+                'DataInstances': {
+                    'tiles': {'Base': {'TypeName': 'imagetile'}},
+                    'grayscale': {'Base': {'TypeName': 'imageblk'}},
+                }
+            }
+        }
+        server = self.start_server({'/api/repos/info': info})
+        DVIDClient(server.url)
+        client = DVIDClient(server.url)
+        self.assertEqual({
+            'imagetile': [{'instance': 'tiles', 'repo': 'repo1'}],
+            'imageblk': [{'instance': 'grayscale', 'repo': 'repo1'}],
+        }, client.get_instance_type_map())
+        # Both clients share the cached server info
+        self.assertEqual(1, server.requests['/api/repos/info'])
@@ -133,3 +133,26 @@ class PostGISTests(TestCase):
         self.assertEqual(1, len(to_edges_after))
         self.assertEqual(from_edges_before[0], from_edges_after[0])
         self.assertNotEqual(to_edges_before[0], to_edges_after[0])
+
+    def test_node_update_edges(self):
+        """Test if moving nodes updates their edges and those of their
+        children.
+        """
+        cursor = connection.cursor()
+        node._update_location('treenode', [[2394, 10, 20, 30]], None,
+                self.user, cursor)
+
+        cursor.execute("""
+            SELECT id, ST_AsText(edge) FROM treenode_edge
+            WHERE id IN (2394, 2396)
+        """)
+        edges = dict(cursor.fetchall())
+        cursor.execute("""
+            SELECT id, location_x, location_y, location_z FROM treenode
+            WHERE id IN (2392, 2396)
+        """)
+        locations = {r[0]: r[1:] for r in cursor.fetchall()}
+        self.assertEqual('LINESTRING Z (10 20 30,%g %g %g)' % locations[2392],
+                edges[2394])
+        self.assertEqual('LINESTRING Z (%g %g %g,10 20 30)' % locations[2396],
+                edges[2396])
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from catmaid.control.roi import get_roi_image_batch, queue_roi_image, \
+        evict_roi_images, mark_roi_image_pending, pending_roi_image_timeout
+from catmaid.models import RegionOfInterest
+
+
+class RoiImageTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        get_roi_image_batch().roi_ids.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def create_roi(self):
+        return RegionOfInterest.objects.create(user_id=3, editor_id=3,
+                project_id=3, stack_id=3, zoom_level=0, location_x=1000,
+                location_y=1000, location_z=0, width=100, height=100,
+                rotation_cw=0)
+
+    def test_roi_image_batch(self):
+        # Test cases run in a transaction, so no commit hook is called
+        batch = get_roi_image_batch()
+        queue_roi_image(1)
+        queue_roi_image(2)
+        queue_roi_image(1)
+        self.assertTrue(batch is get_roi_image_batch())
+        self.assertEqual(set([1, 2]), batch.roi_ids)
+
+    @override_settings(ROI_AUTO_CREATE_IMAGE=False)
+    def test_no_auto_create(self):
+        self.create_roi()
+        self.assertEqual(set(), get_roi_image_batch().roi_ids)
+
+    @override_settings(ROI_AUTO_CREATE_IMAGE=True)
+    def test_auto_create(self):
+        roi_1 = self.create_roi()
+        roi_2 = self.create_roi()
+        roi_1.width = 200
+        roi_1.save()
+        self.assertEqual(set([roi_1.id, roi_2.id]),
+                get_roi_image_batch().roi_ids)
+
+    def test_pending_roi_images(self):
+        file_path = os.path.join(self.tmp_dir, 'roi_1.png')
+        self.assertTrue(mark_roi_image_pending(file_path))
+        # Repeated requests don't queue the image again
+        self.assertFalse(mark_roi_image_pending(file_path))
+
+        # Unless the earlier request is outdated
+        mtime = os.path.getmtime(file_path + '.pending') - \
+                pending_roi_image_timeout - 1
+        os.utime(file_path + '.pending', (mtime, mtime))
+        self.assertTrue(mark_roi_image_pending(file_path))
+        self.assertFalse(mark_roi_image_pending(file_path))
+
+    @override_settings(ROI_IMAGE_CACHE_MAXIMUM_SIZE=25)
+    def test_evict_roi_images(self):
+        def create_file(name, size, mtime):
+            path = os.path.join(self.tmp_dir, name)
+            with open(path, 'wb') as f:
+                f.write('x' * size)
+            os.utime(path, (mtime, mtime))
+            return path
+
+        oldest = create_file('roi_1.png', 10, 1000)
+        old = create_file('roi_2.png', 10, 2000)
+        recent = create_file('roi_3.png', 10, 3000)
+        # Other files and images that are still written are kept
+        lock = create_file('roi_4.png.lock', 0, 0)
+        tmp = create_file('roi_4.png.tmp.png', 10, 0)
+
+        self.assertEqual(1, evict_roi_images(self.tmp_dir))
+        self.assertFalse(os.path.exists(oldest))
+        for path in (old, recent, lock, tmp):
+            self.assertTrue(os.path.exists(path))
+
+        # Nothing is removed if the cache is small enough
+        self.assertEqual(0, evict_roi_images(self.tmp_dir))
+        with self.settings(ROI_IMAGE_CACHE_MAXIMUM_SIZE=0):
+            self.assertEqual(2, evict_roi_images(self.tmp_dir))
+        self.assertEqual(['roi_4.png.lock', 'roi_4.png.tmp.png'],
+                sorted(os.listdir(self.tmp_dir)))
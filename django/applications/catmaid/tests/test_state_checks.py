@@ -189,6 +189,35 @@ class StateCheckingTest(CatmaidTestCase):
         self.assertRaises(ValueError,
                 lambda: state.validate_state([247, 249, 251], s3, multinode=True))
 
+    def test_mismatch_report(self):
+        ps1 = {
+            'edition_time': '2011-12-04T13:51:36.955Z',
+            'parent': [283, '1011-12-15T13:51:36.955Z'],
+            'children': [[289, '2011-11-06T13:51:36.955Z']],
+            'links': [[360, '3011-12-20T10:46:01.360Z']],
+        }
+        s1 = json.dumps(ps1)
+        try:
+            state.validate_state(285, s1, neighborhood=True)
+            self.fail("Expected state mismatch")
+        except state.StateMatchingError as e:
+            self.assertEqual([('edition_time', 283), ('link_edition_time', 360)],
+                    sorted(e.mismatches))
+
+        # Multiple nodes are checked at once and all mismatches are reported
+        ps2 = [
+            [247, '2011-12-05T13:51:36.955Z'],
+            [249, '3011-12-05T13:51:36.955Z'],
+            [251, '3011-12-05T13:51:36.955Z']
+        ]
+        s2 = json.dumps(ps2)
+        try:
+            state.validate_state([247, 249, 251], s2, multinode=True)
+            self.fail("Expected state mismatch")
+        except state.StateMatchingError as e:
+            self.assertEqual([('edition_time', 249), ('edition_time', 251)],
+                    sorted(e.mismatches))
+
     def test_correct_parent_state(self):
         ps1 = {
             'parent': [249, '2011-12-05T13:51:36.955Z']
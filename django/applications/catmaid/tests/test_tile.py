@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import closing
+
+import numpy as np
+
+from django.test import TestCase
+
+from catmaid.control.tile import get_label_dataset, write_label_patches, \
+        label_chunk_shape, queue_label_patch, process_label_queue, \
+        get_label_queue_path, HDF5FilePool, get_file_pool, read_tile, \
+        get_blank_tile, encode_tile
+
+import h5py
+
+
+class TileReadTests(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create_file(self, name, data=None):
+        fpath = os.path.join(self.tmp_dir, name)
+        with closing(h5py.File(fpath, 'w')) as hfile:
+            if data is not None:
+                hfile.create_dataset('/0/0/data', data=data)
+        return fpath
+
+    def test_file_pool_eviction(self):
+        pool = HDF5FilePool(2)
+        paths = [self.create_file('%s.hdf' % i) for i in range(3)]
+        with pool.lock:
+            a = pool.get(paths[0], 1)
+            b = pool.get(paths[1], 1)
+            # Files are reused as long as their mtime doesn't change
+            self.assertTrue(a is pool.get(paths[0], 1))
+            # The least recently used file is closed if there are too many
+            c = pool.get(paths[2], 1)
+            self.assertFalse(b)
+            self.assertTrue(a)
+            self.assertEqual([paths[0], paths[2]], list(pool.files.keys()))
+
+            # Changed files are reopened
+            a2 = pool.get(paths[0], 2)
+            self.assertFalse(a)
+            self.assertTrue(a2)
+
+        pool.invalidate(paths[2])
+        self.assertFalse(c)
+        self.assertEqual([paths[0]], list(pool.files.keys()))
+
+    def test_read_tile(self):
+        data = np.random.randint(0, 255, (300, 400)).astype(np.uint8)
+        fpath = self.create_file('tiles.hdf', data)
+
+        tile = read_tile(fpath, 0, 0, 256, 256, 256, 256, 'raw')
+        expected = np.zeros((256, 256), dtype=np.uint8)
+        expected[:44, :144] = data[256:, 256:]
+        self.assertEqual(expected.tostring(), tile)
+        # Encoded tiles are cached
+        self.assertTrue(tile is read_tile(fpath, 0, 0, 256, 256, 256, 256,
+                'raw'))
+
+        # Unknown scale levels return a blank tile, which is created once
+        blank = get_blank_tile(256, 256, 'png')
+        self.assertEqual(encode_tile(np.zeros((256, 256), dtype=np.uint8),
+                'png'), blank)
+        self.assertTrue(blank is get_blank_tile(256, 256, 'png'))
+        self.assertTrue(blank is read_tile(fpath, 1, 0, 0, 0, 256, 256, 'png'))
+
+    def test_label_writes_invalidate_open_files(self):
+        fpath = self.create_file('labels.hdf')
+        pool = get_file_pool()
+        with pool.lock:
+            pool.get(fpath, os.stat(fpath).st_mtime)
+        queue_label_patch(fpath, 0, 0, 0, 0, np.ones((2, 2), dtype=np.uint8))
+
+        self.assertEqual(1, process_label_queue(fpath))
+        self.assertFalse(fpath in pool.files)
+        with closing(h5py.File(fpath, 'r')) as hfile:
+            self.assertEqual(4, hfile['/labels/scale/0/data'][...].sum())
+
+
+class LabelWriteTests(TestCase):
+
+    def setUp(self):
+        self.hfile = h5py.File(uuid.uuid4().hex, 'w', driver='core',
+                backing_store=False)
+
+    def tearDown(self):
+        self.hfile.close()
+
+    def test_new_label_dataset(self):
+        dataset = get_label_dataset(self.hfile, 0, (10, 20, 2))
+        self.assertEqual((10, 20, 2), dataset.shape)
+        self.assertEqual(label_chunk_shape, dataset.chunks)
+
+        # Overlapping patches are applied in order
+        write_label_patches(dataset, [
+            (2, 1, 0, np.full((2, 3), 1, dtype=np.uint8)),
+            (3, 2, 0, np.full((2, 2), 2, dtype=np.uint8)),
+            (0, 0, 1, np.full((1, 1), 3, dtype=np.uint8))])
+        self.assertEqual([[0, 0, 0, 0, 0, 0],
+                          [0, 0, 1, 1, 1, 0],
+                          [0, 0, 1, 2, 2, 0],
+                          [0, 0, 0, 2, 2, 0]],
+                         dataset[0:4, 0:6, 0].tolist())
+        self.assertEqual(3, dataset[0, 0, 1])
+        self.assertEqual(3, dataset[:, :, 1].sum())
+
+        # Datasets grow if needed, patches can span multiple chunks
+        dataset = get_label_dataset(self.hfile, 0, (300, 5, 3))
+        self.assertEqual((300, 20, 3), dataset.shape)
+        write_label_patches(dataset, [
+            (0, 250, 2, np.full((20, 4), 4, dtype=np.uint8))])
+        self.assertEqual(80, (dataset[:, :, 2] == 4).sum())
+        self.assertEqual(1, dataset[1, 2, 0])
+
+    def test_contiguous_label_dataset(self):
+        labels = np.arange(40, dtype=np.uint8).reshape(4, 5, 2)
+        self.hfile.create_dataset('/labels/scale/0/data', data=labels)
+        self.hfile['/labels/scale/0/data'].attrs['source'] = 'test'
+
+        # Patches within the dataset are written in place
+        dataset = get_label_dataset(self.hfile, 0, (2, 2, 1))
+        self.assertEqual(None, dataset.chunks)
+        write_label_patches(dataset, [
+            (1, 1, 0, np.full((2, 2), 100, dtype=np.uint8))])
+        labels[1:3, 1:3, 0] = 100
+        self.assertEqual(labels.tolist(), dataset[...].tolist())
+
+        # Growing the dataset replaces it by a chunked copy
+        dataset = get_label_dataset(self.hfile, 0, (6, 5, 3))
+        self.assertEqual((6, 5, 3), dataset.shape)
+        self.assertEqual(label_chunk_shape, dataset.chunks)
+        self.assertEqual(labels.tolist(), dataset[:4, :, :2].tolist())
+        self.assertEqual(0, dataset[4:, :, :].sum() + dataset[:, :, 2].sum())
+        self.assertEqual('test', dataset.attrs['source'])
+        self.assertEqual(['data'], list(self.hfile['/labels/scale/0'].keys()))
+
+    def test_failed_label_writes_are_reported(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            # A group where the label dataset is expected can't be written to
+            fpath = os.path.join(tmp_dir, 'labels.hdf')
+            with closing(h5py.File(fpath, 'w')) as hfile:
+                hfile.create_group('/labels/scale/0/data')
+            token = queue_label_patch(fpath, 0, 0, 0, 0,
+                    np.ones((2, 2), dtype=np.uint8))
+
+            self.assertEqual(1, process_label_queue(fpath))
+            queue_path = get_label_queue_path(fpath)
+            self.assertTrue(os.path.exists(os.path.join(queue_path,
+                    token + '.failed')))
+            self.assertEqual([], [n for n in os.listdir(queue_path)
+                    if n.endswith('.npz')])
+        finally:
+            shutil.rmtree(tmp_dir)
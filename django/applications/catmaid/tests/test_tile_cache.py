@@ -0,0 +1,85 @@
+import os
+import shutil
+import socket
+import tempfile
+from contextlib import closing
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from catmaid.control.tilecache import TileCache, TileFetcher, \
+        TileFetchMetrics, ImageRetrievalError
+
+
+class TileCacheTests(TestCase):
+
+    def setUp(self):
+        self.disk_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.disk_path)
+
+    def test_memory_lru_eviction(self):
+        cache = TileCache(10)
+        cache.put('a', '12345')
+        cache.put('b', '12345')
+        # Access a to make b the least recently used entry
+        self.assertEqual(cache.get('a'), ('12345', 'memory'))
+        cache.put('c', '12345')
+        self.assertEqual(cache.get('b'), (None, None))
+        self.assertEqual(cache.get('a'), ('12345', 'memory'))
+        self.assertEqual(cache.get('c'), ('12345', 'memory'))
+        self.assertEqual(10, cache.memory_size)
+
+    def test_disk_spilling(self):
+        cache = TileCache(10, 10, self.disk_path)
+        cache.put('a', '12345')
+        cache.put('b', '12345')
+        cache.put('c', '12345')
+        # Entry a was moved to disk
+        self.assertEqual(1, len(os.listdir(self.disk_path)))
+        self.assertEqual(5, cache.disk_size)
+        # Reading it moves it back to memory and b to disk
+        self.assertEqual(cache.get('a'), ('12345', 'disk'))
+        self.assertEqual(cache.get('a'), ('12345', 'memory'))
+        self.assertEqual(cache.get('b'), ('12345', 'disk'))
+
+        # The disk size is limited as well
+        cache.put('d', '1234567890')
+        cache.put('e', '1234567890')
+        self.assertTrue(cache.disk_size <= 10)
+        self.assertEqual(len(cache.disk_entries),
+                len(os.listdir(self.disk_path)))
+
+        cache.clear()
+        self.assertEqual(0, cache.memory_size)
+        self.assertEqual(0, cache.disk_size)
+        self.assertEqual([], os.listdir(self.disk_path))
+
+    def test_fetch_metrics(self):
+        tile_path = os.path.join(self.disk_path, 'tile.png')
+        with open(tile_path, 'wb') as f:
+            f.write('tile data')
+
+        metrics = TileFetchMetrics()
+        fetcher = TileFetcher(TileCache(100), metrics)
+        url = 'file://' + tile_path
+        self.assertEqual(['tile data'] * 3, fetcher.fetch_many([url] * 3))
+        self.assertEqual('tile data', fetcher.fetch(url))
+        self.assertEqual(4, metrics.requests)
+        self.assertTrue(metrics.misses >= 1)
+        self.assertEqual(metrics.requests - metrics.misses, metrics.memory_hits)
+        self.assertEqual(len('tile data') * metrics.misses, metrics.bytes_fetched)
+
+    @override_settings(CROPPING_TILE_FETCH_TIMEOUT=0.2)
+    def test_fetch_timeout(self):
+        # A server that accepts connections, but never responds
+        with closing(socket.socket()) as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            url = 'http://127.0.0.1:%s/tile.png' % server.getsockname()[1]
+            fetcher = TileFetcher(TileCache(100))
+            self.assertRaises(ImageRetrievalError, fetcher.fetch, url)
+            errors = fetcher.fetch_many_async([url], catch_errors=True).get()
+            self.assertTrue(isinstance(errors[0], ImageRetrievalError))
+            self.assertEqual(url, errors[0].path)
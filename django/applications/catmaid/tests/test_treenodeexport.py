@@ -0,0 +1,87 @@
+import os
+import shutil
+import tarfile
+import tempfile
+
+from cStringIO import StringIO
+
+import numpy as np
+from PIL import Image
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from catmaid.control.treenodeexport import SkeletonExportJob, TreenodeExporter
+from catmaid.models import Stack, Treenode
+
+
+class TreenodeExportTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # Serve the tiles of stack 3 from the temporary folder. Only the tile
+        # that contains the nodes 237 and 239 is available.
+        Stack.objects.filter(id=3).update(tile_source_type=1,
+                image_base='file://' + self.tmp_dir + '/',
+                file_extension='png')
+        self.tile = np.random.randint(0, 255, (256, 256, 3)).astype(np.uint8)
+        os.mkdir(os.path.join(self.tmp_dir, '0'))
+        Image.fromarray(self.tile).save(os.path.join(self.tmp_dir, '0',
+                '2_0_0.png'))
+
+        job = SkeletonExportJob(User.objects.get(id=3), 3, 3, [235, 2388],
+                10, 10, 0, 0)
+        self.exporter = TreenodeExporter(job)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_plan_crops(self):
+        nodes = [Treenode.objects.get(id=237), Treenode.objects.get(id=239)]
+        shared_job, crops = self.exporter.plan_crops(nodes)
+        self.assertFalse(shared_job.needs_initialization)
+        self.assertEqual(nodes, [c.node for c in crops])
+
+        # The crop jobs share the stack information, but not their bounds
+        crop = crops[0]
+        self.assertEqual(shared_job.stacks, crop.job.stacks)
+        self.assertEqual((1055.0, 1075.0, 3025.0, 3045.0, 0.0, 0.0),
+                (crop.job.x_min, crop.job.x_max, crop.job.y_min,
+                 crop.job.y_max, crop.job.z_min, crop.job.z_max))
+        self.assertEqual(1065.0, crops[1].job.x_min)
+
+        # A single slice of a single stack, cut from a single tile
+        self.assertEqual(1, len(crop.slices))
+        self.assertEqual(1, len(crop.slices[0]))
+        bb, image_parts = crop.slices[0][0]
+        self.assertEqual((4, 4, 0), (bb.width, bb.height, bb.px_z_min))
+        self.assertEqual(1, len(image_parts))
+        ip = image_parts[0]
+        self.assertEqual('file://' + self.tmp_dir + '/0/2_0_0.png', ip.path)
+        self.assertEqual((211, 215, 93, 97), (ip.x_min_src, ip.x_max_src,
+                ip.y_min_src, ip.y_max_src))
+
+    def test_export_nodes(self):
+        archive_path = os.path.join(self.tmp_dir, 'export.tar')
+        self.exporter.archive = tarfile.open(archive_path, 'w')
+        self.exporter.archive_path = archive_path
+        self.exporter.archive_folder = 'export'
+
+        nodes = Treenode.objects.filter(id__in=(237, 239, 2392)).order_by('id')
+        errors = self.exporter.export_nodes(nodes)
+        self.exporter.close_archive()
+
+        # The tile of node 2392 isn't available
+        self.assertEqual([2392], [n.id for n in errors])
+        error, path = errors.values()[0]
+        self.assertEqual('file://' + self.tmp_dir + '/0/4_1_0.png', path)
+
+        with tarfile.open(archive_path) as archive:
+            self.assertEqual(['export/233/237.tiff', 'export/233/239.tiff'],
+                    sorted(archive.getnames()))
+            data = archive.extractfile('export/233/237.tiff').read()
+        image = Image.open(StringIO(data))
+        self.assertEqual('L', image.mode)
+        self.assertEqual(self.tile[93:97, 211:215, 0].tolist(),
+                np.asarray(image).tolist())
@@ -104,6 +104,7 @@ urlpatterns += [
 urlpatterns += [
     url(r'^(?P<project_id>\d+)/stack/(?P<stack_id>\d+)/tile$', tile.get_tile),
     url(r'^(?P<project_id>\d+)/stack/(?P<stack_id>\d+)/put_tile$', tile.put_tile),
+    url(r'^(?P<project_id>\d+)/stack/(?P<stack_id>\d+)/put_tile/(?P<token>[0-9a-f]+)$', tile.put_tile_status),
 ]
 
 # Tracing general
@@ -198,6 +199,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/node/get_location$', node.get_location),
     url(r'^(?P<project_id>\d+)/node/user-info$', node.user_info),
     url(r'^(?P<project_id>\d+)/nodes/find-labels$', node.find_labels),
+    url(r'^(?P<project_id>\d+)/nodes/reviewed$', record_view("nodes.add_or_update_review")(node.update_location_reviewer_batch)),
 ]
 
 # Treenode access
@@ -206,12 +208,14 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/treenode/create$', record_view("treenodes.create")(treenode.create_treenode)),
     url(r'^(?P<project_id>\d+)/treenode/insert$', record_view("treenodes.insert")(treenode.insert_treenode)),
     url(r'^(?P<project_id>\d+)/treenode/delete$', record_view("treenodes.remove")(treenode.delete_treenode)),
+    url(r'^(?P<project_id>\d+)/treenodes/delete$', record_view("treenodes.remove")(treenode.delete_treenodes)),
     url(r'^(?P<project_id>\d+)/treenodes/(?P<treenode_id>\d+)/info$', treenode.treenode_info),
     url(r'^(?P<project_id>\d+)/treenodes/(?P<treenode_id>\d+)/children$', treenode.find_children),
     url(r'^(?P<project_id>\d+)/treenodes/(?P<treenode_id>\d+)/confidence$', record_view("treenodes.update_confidence")(treenode.update_confidence)),
     url(r'^(?P<project_id>\d+)/treenodes/(?P<treenode_id>\d+)/parent$', record_view("treenodes.update_parent")(treenode.update_parent)),
     url(r'^(?P<project_id>\d+)/treenode/(?P<treenode_id>\d+)/radius$', record_view("treenodes.update_radius")(treenode.update_radius)),
     url(r'^(?P<project_id>\d+)/treenodes/radius$', record_view("treenodes.update_radius")(treenode.update_radii)),
+    url(r'^(?P<project_id>\d+)/treenodes/batch$', record_view("treenodes.batch")(treenode.apply_batch)),
     url(r'^(?P<project_id>\d+)/treenodes/(?P<treenode_id>\d+)/previous-branch-or-root$', treenode.find_previous_branchnode_or_root),
     url(r'^(?P<project_id>\d+)/treenodes/(?P<treenode_id>\d+)/next-branch-or-end$', treenode.find_next_branchnode_or_end),
 ]
@@ -280,7 +284,9 @@ urlpatterns += [
 # Cropping
 urlpatterns += [
     url(r'^(?P<project_id>\d+)/stack/(?P<stack_ids>%s)/crop/(?P<x_min>%s),(?P<x_max>%s)/(?P<y_min>%s),(?P<y_max>%s)/(?P<z_min>%s),(?P<z_max>%s)/(?P<zoom_level>\d+)/(?P<single_channel>[0|1])/$' % (intlist, num, num, num, num, num, num), cropping.crop),
-    url(r'^crop/download/(?P<file_path>.*)/$', cropping.download_crop)
+    url(r'^crop/download/(?P<file_path>.*)/$', cropping.download_crop),
+    url(r'^crop/jobs/$', cropping.cropping_jobs),
+    url(r'^crop/jobs/(?P<job_id>\d+)/$', cropping.cropping_job)
 ]
 
 # Tagging
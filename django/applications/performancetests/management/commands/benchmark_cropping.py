@@ -0,0 +1,105 @@
+import numpy as np
+
+from timeit import default_timer
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.control.cropping import CropJob, extract_substack, \
+        extract_substack_arrays, get_single_tile_part, \
+        get_stack_bounding_boxes, plan_slices
+from catmaid.models import ProjectStack
+
+
+class Command(BaseCommand):
+    help = "Compare the time needed to crop a region that lies within a " \
+           "single tile with the fast path and with the general path."
+
+    def add_arguments(self, parser):
+        parser.add_argument('project_id', type=int)
+        parser.add_argument('stack_id', type=int)
+        parser.add_argument('--center', default=None,
+            help='Center of the region in stack pixel coordinates at zoom '
+                 'level zero as "x,y,z", defaults to the center of the stack')
+        parser.add_argument('--size', type=int, default=64,
+            help='Width and height of the region in pixels at the zoom level')
+        parser.add_argument('--zoom-level', type=int, default=0)
+        parser.add_argument('--slices', type=int, default=1,
+            help='Number of sections to crop')
+        parser.add_argument('--single-channel', default=False,
+            action='store_true')
+        parser.add_argument('--repeat', type=int, default=20,
+            help='Number of timed runs for each path')
+
+    def handle(self, *args, **options):
+        try:
+            ps = ProjectStack.objects.select_related('stack').get(
+                    project_id=options['project_id'],
+                    stack_id=options['stack_id'])
+        except ProjectStack.DoesNotExist:
+            raise CommandError("Stack %s is not linked to project %s" % \
+                    (options['stack_id'], options['project_id']))
+        stack = ps.stack
+
+        if options['center']:
+            try:
+                x, y, z = (float(v) for v in options['center'].split(','))
+            except ValueError:
+                raise CommandError("The center needs to be passed as x,y,z")
+        else:
+            x = stack.dimension.x * 0.5
+            y = stack.dimension.y * 0.5
+            z = stack.dimension.z * 0.5
+
+        # Convert the region into project space
+        half_size = 0.5 * options['size'] * 2**options['zoom_level']
+        x_min = (x - half_size) * stack.resolution.x + ps.translation.x
+        x_max = (x + half_size) * stack.resolution.x + ps.translation.x
+        y_min = (y - half_size) * stack.resolution.y + ps.translation.y
+        y_max = (y + half_size) * stack.resolution.y + ps.translation.y
+        z_min = int(z) * stack.resolution.z + ps.translation.z
+        z_max = z_min + (options['slices'] - 1) * stack.resolution.z
+
+        job = CropJob(None, options['project_id'], [stack.id], x_min, x_max,
+                y_min, y_max, z_min, z_max, 0, options['zoom_level'],
+                options['single_channel'])
+        job.initialize()
+
+        s_to_bb, n_slices = get_stack_bounding_boxes(job)
+        slices = plan_slices(job, s_to_bb, n_slices)
+        if not all(get_single_tile_part(bb, image_parts)
+                for channels in slices for bb, image_parts in channels):
+            self.stdout.write("Warning: not all slices of the region lie "
+                    "within a single tile, the fast path is used only for "
+                    "some of them")
+
+        variants = (
+            ('pgmagick fast path', lambda: extract_substack(job, True)),
+            ('pgmagick general path', lambda: extract_substack(job, False)),
+            ('numpy fast path', lambda: list(extract_substack_arrays(job,
+                    slices, True))),
+            ('numpy general path', lambda: list(extract_substack_arrays(job,
+                    slices, False))),
+        )
+
+        # Tiles are only loaded once, all timed runs use the tile cache. This
+        # makes sure only decoding and composing is compared.
+        for name, run in variants:
+            run()
+
+        timings = {}
+        for name, run in variants:
+            times = []
+            for n in range(options['repeat']):
+                start = default_timer()
+                run()
+                times.append((default_timer() - start) * 1000.0)
+            timings[name] = np.mean(times)
+            self.stdout.write("%s: Time: %.3fms N: %s SD: %.3f" % (name,
+                    timings[name], len(times), np.std(times, ddof=1)
+                    if len(times) > 1 else 0))
+
+        for prefix in ('pgmagick', 'numpy'):
+            fast = timings['%s fast path' % prefix]
+            general = timings['%s general path' % prefix]
+            self.stdout.write("%s speedup: %.2fx" % (prefix,
+                    general / fast if fast else float('inf')))
@@ -174,10 +174,17 @@ PROFILE_SHOW_ONTOLOGY_TOOL = False
 PROFILE_SHOW_ROI_TOOL = False
 
 # Defines if a cropped image of a ROI should be created
-# automatically when the ROI is created. If set to False
-# such an image will be created when requested.
+# automatically when the ROI is created or updated. If set to False
+# such an image will be created when requested. Eager rendering loads image
+# tiles for every edited ROI and needs a running Celery worker, it is
+# therefore disabled by default.
 ROI_AUTO_CREATE_IMAGE = False
 
+# ROI images are kept in a cache folder, which holds up to this many bytes
+# (default 1 GB). If more space is needed, the least recently used images are
+# removed.
+ROI_IMAGE_CACHE_MAXIMUM_SIZE = 1073741824
+
 # A limit on the size of the result returned by a single spatial query. This
 # determines the maximum number of nodes shown in the tracing overlay, so has
 # severe worst-case performance implications for the database, web server, and
@@ -206,6 +213,48 @@ MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
 # than this. This defaults to 50 Megabyte.
 GENERATED_FILES_MAXIMUM_SIZE = 52428800
 
+# Cropping jobs and treenode/connector exports are limited per user: at most
+# CROPPING_MAX_JOBS_PER_USER jobs can be queued or running at the same time and
+# their estimated size can't exceed CROPPING_MAX_ACTIVE_SIZE_PER_USER bytes
+# (default 100 MB) in total. Jobs larger than CROPPING_SMALL_JOB_SIZE bytes
+# (default 5 MB) are only started if less than CROPPING_MAX_LARGE_JOBS of them
+# are running, which keeps Celery workers available for other tasks. ROI images
+# are rendered by the same scheduler, they don't count against these limits and
+# are started before all other jobs. Running jobs that didn't report
+# progress for CROPPING_JOB_TIMEOUT seconds (default 1 hour), e.g. because
+# their worker was stopped, are marked as failed.
+CROPPING_MAX_JOBS_PER_USER = 2
+CROPPING_MAX_ACTIVE_SIZE_PER_USER = 104857600
+CROPPING_SMALL_JOB_SIZE = 5242880
+CROPPING_MAX_LARGE_JOBS = 1
+CROPPING_JOB_TIMEOUT = 3600
+
+# Image tiles used by the cropping tool, ROI images and treenode exports are
+# loaded by a pool of threads with the size below. Loaded tiles are kept in a
+# cache that is shared by all jobs of a worker process. It holds up to
+# CROPPING_TILE_CACHE_MEMORY_SIZE bytes in memory (default 100 MB), older
+# tiles are moved to a folder on disk that holds up to
+# CROPPING_TILE_CACHE_DISK_SIZE bytes (default 1 GB, 0 disables it). If no
+# path is set, a folder in the system's temporary directory is used. Tiles
+# that can't be loaded within CROPPING_TILE_FETCH_TIMEOUT seconds are treated
+# as missing.
+CROPPING_TILE_FETCH_THREADS = 8
+CROPPING_TILE_FETCH_TIMEOUT = 30
+CROPPING_TILE_CACHE_MEMORY_SIZE = 104857600
+CROPPING_TILE_CACHE_DISK_SIZE = 1073741824
+CROPPING_TILE_CACHE_PATH = None
+
+# HDF5 tiles are read through a pool of open files of each worker process,
+# which keeps at most HDF5_FILE_HANDLE_POOL_SIZE files open. Encoded tiles are
+# cached in memory, up to HDF5_TILE_CACHE_SIZE bytes (default 32 MB).
+HDF5_FILE_HANDLE_POOL_SIZE = 16
+HDF5_TILE_CACHE_SIZE = 33554432
+
+# Labels sent to HDF5 files are queued and written asynchronously. Whether
+# they have been written can be queried for this many seconds (default one
+# day).
+HDF5_LABEL_STATUS_RETENTION = 86400
+
 # The maximum allowed size in bytes for files uploaded for import as skeletons.
 # The default is 5 megabytes.
 IMPORTED_SKELETON_FILE_MAXIMUM_SIZE = 5242880
@@ -221,6 +270,7 @@ NEW_USER_DEFAULT_GROUPS = []
 CELERY_IMPORTS = (
     'catmaid.control.cropping',
     'catmaid.control.roi',
+    'catmaid.control.tile',
     'catmaid.control.treenodeexport',
 )
 
@@ -266,6 +316,12 @@ VERSION = utils.get_version()
 # FLYTEM_STACK_TILE_WIDTH = 512
 # FLYTEM_STACK_TILE_HEIGHT = 512
 
+# Metadata of FlyTEM and DVID projects and stacks is cached for this many
+# seconds by each worker process. Requests to these services time out after
+# REMOTE_METADATA_TIMEOUT seconds.
+REMOTE_METADATA_CACHE_TTL = 60
+REMOTE_METADATA_TIMEOUT = 30
+
 # DVID auto-discovery. To activate add the following lines to your settings.py
 # file:
 # MIDDLEWARE_CLASSES += ('catmaid.middleware.DVIDMiddleware',)
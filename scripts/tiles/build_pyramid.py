@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+#
+# Builds the tiled scale pyramid of an image stack for CATMAID, using all
+# available CPU cores. Every input file is one section of the stack, sections
+# are numbered in the order the files are passed in. Call it e.g. this way:
+#
+#   build_pyramid.py --output /data/stack --tile-size 256 --format jpg \
+#       --tile-source-type 5 --processes 16 sections/*.tif
+#
+# Sections are processed in parallel by a pool of worker processes. Each
+# section is available as memory-mapped array: NumPy (.npy) files are mapped
+# directly, other images are decoded once into a temporary .npy file. Zoom
+# levels are computed by averaging blocks of 2x2 pixels of the previous level,
+# a few rows of tiles at a time, and are memory-mapped as well. This keeps
+# memory use low even for very large sections. All tiles of a zoom level are
+# padded with black to the full tile size.
+#
+# Finished sections are recorded in a manifest file in the output folder. If
+# the script is run again with the same parameters, sections that didn't
+# change since they were recorded are skipped, which makes it possible to
+# resume an interrupted run. Tiles that are newer than their section file are
+# not written again.
+#
+# Depending on the tile source type, tiles are stored as:
+#
+#   1: <section>/<row>_<col>_<zoom>.<format>
+#   4: <section>/<zoom>/<row>_<col>.<format>
+#   5: <zoom>/<section>/<row>/<col>.<format>
+#
+# Requires NumPy and Pillow.
+
+from __future__ import print_function, division
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from PIL import Image
+
+
+MANIFEST_NAME = 'pyramid-manifest.json'
+
+
+def get_tile_path(output_path, tile_source_type, section, zoom, row, col, fmt):
+    """ Returns the path of a tile, following the layout of the passed in tile
+    source type.
+    """
+    if 1 == tile_source_type:
+        return os.path.join(output_path, str(section),
+                "%s_%s_%s.%s" % (row, col, zoom, fmt))
+    elif 4 == tile_source_type:
+        return os.path.join(output_path, str(section), str(zoom),
+                "%s_%s.%s" % (row, col, fmt))
+    elif 5 == tile_source_type:
+        return os.path.join(output_path, str(zoom), str(section), str(row),
+                "%s.%s" % (col, fmt))
+    raise ValueError("Unsupported tile source type: %s" % tile_source_type)
+
+
+def get_zoom_levels(width, height, tile_size):
+    """ Returns the number of zoom levels needed until a level fits into a
+    single tile.
+    """
+    n_levels = 1
+    while width > tile_size or height > tile_size:
+        width, height = width // 2, height // 2
+        n_levels += 1
+    return n_levels
+
+
+def open_section(path, work_dir):
+    """ Returns a memory-mapped array of shape (height, width) or (height,
+    width, 3) for the section image at <path>. Images that aren't NumPy files
+    are decoded into a temporary file in <work_dir> first.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    image = Image.open(path)
+    if image.mode not in ('L', 'RGB'):
+        image = image.convert('L' if image.mode in ('1', 'I', 'I;16') else 'RGB')
+    data = np.asarray(image, dtype=np.uint8)
+    del image
+    mapped = np.lib.format.open_memmap(os.path.join(work_dir, 'level-0.npy'),
+            mode='w+', dtype=np.uint8, shape=data.shape)
+    mapped[:] = data
+    del data
+    mapped.flush()
+    return mapped
+
+
+def downsample(level, work_dir, zoom, strip_height):
+    """ Returns a memory-mapped array of half the size of <level>, in which
+    each pixel is the rounded mean of a 2x2 block. The result is computed in
+    strips of <strip_height> output rows.
+    """
+    height, width = level.shape[0] // 2, level.shape[1] // 2
+    result = np.lib.format.open_memmap(
+            os.path.join(work_dir, 'level-%s.npy' % zoom), mode='w+',
+            dtype=np.uint8, shape=(height, width) + level.shape[2:])
+    for row in range(0, height, strip_height):
+        rows = min(strip_height, height - row)
+        block = np.asarray(level[2 * row:2 * (row + rows), :2 * width],
+                dtype=np.uint16)
+        block = block.reshape((rows, 2, width, 2) + level.shape[2:])
+        result[row:row + rows] = (block.sum(axis=(1, 3)) + 2) // 4
+    result.flush()
+    return result
+
+
+def is_up_to_date(tile_path, source_mtime):
+    try:
+        return os.path.getmtime(tile_path) >= source_mtime
+    except OSError:
+        return False
+
+
+def write_tiles(level, section, zoom, source_mtime, options):
+    """ Writes all tiles of a zoom level of a section, one row of tiles at a
+    time. Tiles that are newer than the section file are skipped. Returns the
+    number of written tiles.
+    """
+    tile_size = options['tile_size']
+    n_rows = (level.shape[0] + tile_size - 1) // tile_size
+    n_cols = (level.shape[1] + tile_size - 1) // tile_size
+    n_written = 0
+    for row in range(n_rows):
+        strip = None
+        for col in range(n_cols):
+            tile_path = get_tile_path(options['output_path'],
+                    options['tile_source_type'], section, zoom, row, col,
+                    options['format'])
+            if is_up_to_date(tile_path, source_mtime):
+                continue
+            if strip is None:
+                strip = np.asarray(level[row * tile_size:(row + 1) * tile_size])
+            tile = np.zeros((tile_size, tile_size) + level.shape[2:],
+                    dtype=np.uint8)
+            data = strip[:, col * tile_size:(col + 1) * tile_size]
+            tile[:data.shape[0], :data.shape[1]] = data
+            tile_dir = os.path.dirname(tile_path)
+            if not os.path.isdir(tile_dir):
+                try:
+                    os.makedirs(tile_dir)
+                except OSError:
+                    # Another worker might have created it in the meantime
+                    if not os.path.isdir(tile_dir):
+                        raise
+            Image.fromarray(tile).save(tile_path, quality=options['quality'])
+            n_written += 1
+    return n_written
+
+
+def write_thumbnail(level, section, options):
+    """ Writes an overview image named small.<format> into the section folder,
+    whose longer side has the thumbnail size.
+    """
+    if options['tile_source_type'] not in (1, 4):
+        return
+    thumbnail = Image.fromarray(np.asarray(level))
+    size = options['thumbnail_size']
+    thumbnail.thumbnail((size, size), Image.LANCZOS)
+    thumbnail.save(os.path.join(options['output_path'], str(section),
+            'small.%s' % options['format']), quality=options['quality'])
+
+
+def build_section(args):
+    """ Builds all zoom levels of a single section. Runs in a worker process
+    and returns the manifest entry of the section.
+    """
+    section, path, options = args
+    source_mtime = os.path.getmtime(path)
+    work_dir = tempfile.mkdtemp(prefix='catmaid-pyramid-',
+            dir=options['temp_dir'])
+    level = None
+    try:
+        level = open_section(path, work_dir)
+        height, width = level.shape[:2]
+        n_levels = get_zoom_levels(width, height, options['tile_size'])
+        n_written = 0
+        for zoom in range(n_levels):
+            if zoom > 0:
+                level = downsample(level, work_dir, zoom, options['tile_size'])
+            n_written += write_tiles(level, section, zoom, source_mtime, options)
+        if options['thumbnail_size']:
+            write_thumbnail(level, section, options)
+    finally:
+        del level
+        shutil.rmtree(work_dir)
+
+    return {
+        'section': section,
+        'path': os.path.abspath(path),
+        'mtime': source_mtime,
+        'size': os.path.getsize(path),
+        'width': width,
+        'height': height,
+        'zoom_levels': n_levels,
+        'tiles_written': n_written,
+    }
+
+
+def load_manifest(manifest_path, options):
+    """ Returns a dictionary that maps section indices to the manifest entries
+    of finished sections. If the manifest was created with different
+    parameters, it is ignored.
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        lines = f.read().splitlines()
+    if not lines or json.loads(lines[0]) != get_manifest_header(options):
+        print("Ignoring manifest, it was created with different parameters",
+                file=sys.stderr)
+        return {}
+    sections = {}
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # The last line might be incomplete after an interruption
+            continue
+        sections[entry['section']] = entry
+    return sections
+
+
+def get_manifest_header(options):
+    return {
+        'tile_size': options['tile_size'],
+        'tile_source_type': options['tile_source_type'],
+        'format': options['format'],
+    }
+
+
+def is_section_done(entry, path):
+    return entry is not None and \
+            entry['path'] == os.path.abspath(path) and \
+            entry['mtime'] == os.path.getmtime(path) and \
+            entry['size'] == os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a tiled scale "
+            "pyramid for CATMAID from a list of section images.")
+    parser.add_argument('sections', nargs='+',
+            help="Image files, one per section, in section order")
+    parser.add_argument('--output', required=True, help="Output folder")
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--tile-source-type', type=int, default=1,
+            choices=(1, 4, 5))
+    parser.add_argument('--format', default='jpg',
+            help="File extension of tiles, e.g. jpg or png")
+    parser.add_argument('--quality', type=int, default=85,
+            help="JPEG quality of tiles")
+    parser.add_argument('--thumbnail-size', type=int, default=192,
+            help="Size of the overview image of each section, 0 disables it")
+    parser.add_argument('--first-section', type=int, default=0,
+            help="The index of the first passed in section")
+    parser.add_argument('--processes', type=int, default=cpu_count(),
+            help="Number of worker processes")
+    parser.add_argument('--temp-dir', default=None,
+            help="Folder for memory-mapped zoom levels")
+    args = parser.parse_args()
+
+    options = {
+        'output_path': args.output,
+        'tile_size': args.tile_size,
+        'tile_source_type': args.tile_source_type,
+        'format': args.format,
+        'quality': args.quality,
+        'thumbnail_size': args.thumbnail_size,
+        'temp_dir': args.temp_dir,
+    }
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    manifest_path = os.path.join(args.output, MANIFEST_NAME)
+    done = load_manifest(manifest_path, options)
+
+    tasks = []
+    for n, path in enumerate(args.sections):
+        section = args.first_section + n
+        if is_section_done(done.get(section), path):
+            continue
+        tasks.append((section, path, options))
+
+    print("%s of %s sections are up to date, building %s" % \
+            (len(args.sections) - len(tasks), len(args.sections), len(tasks)))
+
+    # Rewrite the manifest with the entries that are still valid, new entries
+    # are appended as soon as a section is finished.
+    pending = set(t[0] for t in tasks)
+    with open(manifest_path, 'w') as manifest:
+        manifest.write(json.dumps(get_manifest_header(options)) + '\n')
+        for section, entry in sorted(done.items()):
+            if section not in pending:
+                manifest.write(json.dumps(entry) + '\n')
+        manifest.flush()
+
+        pool = Pool(args.processes)
+        try:
+            for entry in pool.imap_unordered(build_section, tasks):
+                manifest.write(json.dumps(entry) + '\n')
+                manifest.flush()
+                print("Section %s: %s zoom levels, %s tiles written" % \
+                        (entry['section'], entry['zoom_levels'],
+                         entry['tiles_written']))
+        finally:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    main()